@@ -0,0 +1,152 @@
+"""Assembly of the OPTIMADE API app with CSD-specific extensions.
+
+The optimade-python-tools server reads its config and creates its database
+collections on import, so everything here is imported lazily from within
+`create_app`, which must only be called after the config has been set
+(e.g., by `OptimakeServer`).
+
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from fastapi import FastAPI
+
+
+def _replace_entry_collections() -> None:
+    """Replace the default structures and references collections in the
+    optimade-python-tools routers with their CSD-specific counterparts.
+
+    """
+    from optimade.models import ReferenceResource, StructureResource
+    from optimade.server import routers
+    from optimade.server.config import CONFIG
+    from optimade.server.mappers import ReferenceMapper, StructureMapper
+    from optimade.server.routers import references, structures
+
+    from csd_optimade.entry_collections import CSDMongoCollection
+
+    structures.structures_coll = CSDMongoCollection(
+        name=CONFIG.structures_collection,
+        resource_cls=StructureResource,
+        resource_mapper=StructureMapper,
+    )
+    references.references_coll = CSDMongoCollection(
+        name=CONFIG.references_collection,
+        resource_cls=ReferenceResource,
+        resource_mapper=ReferenceMapper,
+    )
+    routers.ENTRY_COLLECTIONS["structures"] = structures.structures_coll
+    routers.ENTRY_COLLECTIONS["references"] = references.references_coll
+
+
+def _passthrough_streaming_responses(app: FastAPI, paths: tuple[str, ...]) -> None:
+    """Replace the OPTIMADE `AddWarnings` middleware with one that does not touch
+    the responses of the given (non-JSON, streaming) endpoints, as it would
+    otherwise read each response fully into memory to add any warnings.
+
+    """
+    from optimade.server.middleware import AddWarnings
+    from starlette.middleware import Middleware
+
+    class StreamingAwareAddWarnings(AddWarnings):
+        async def dispatch(self, request, call_next):
+            if request.url.path.endswith(paths):
+                return await call_next(request)
+            return await super().dispatch(request, call_next)
+
+    app.user_middleware = [
+        Middleware(StreamingAwareAddWarnings)
+        if middleware.cls is AddWarnings
+        else middleware
+        for middleware in app.user_middleware
+    ]
+
+
+def create_app(entry_cache_size: int = 0) -> FastAPI:
+    """Create the OPTIMADE API app, using the CSD-specific entry collections
+    and adding the CSD extension endpoints.
+
+    The JSONL file that the database is then loaded from, if any, should be
+    recorded as `app.state.inserted_from`, so that the export endpoint can
+    serve it directly.
+
+    Parameters:
+        entry_cache_size: The maximum size (in bytes) of the cache of
+            precompressed single-entry responses; 0 disables the cache.
+
+    """
+    _replace_entry_collections()
+
+    # Importing the app may also insert data into the (replaced) collections
+    from optimade.server.main import app
+    from optimade.server.routers.utils import BASE_URL_PREFIXES
+
+    from csd_optimade import export, metrics, stats
+    from csd_optimade.compression import CompressionMiddleware, EntryCache
+
+    app.state.inserted_from = None
+
+    stats_router = stats.create_router()
+    for prefix in ("", *BASE_URL_PREFIXES.values()):
+        app.include_router(export.router, prefix=prefix)
+        app.include_router(metrics.router, prefix=prefix)
+        app.include_router(stats_router, prefix=prefix)
+
+    _passthrough_streaming_responses(app, (export.EXPORT_PATH, metrics.METRICS_PATH))
+    app.add_middleware(
+        CompressionMiddleware,
+        entry_cache=EntryCache(entry_cache_size) if entry_cache_size > 0 else None,
+    )
+    # Added last, so that it wraps (and times) all other middleware
+    app.add_middleware(metrics.RequestTimingMiddleware)
+
+    return app
+
+
+def close_database() -> None:
+    """Close the MongoDB connections of all entry collections, e.g., in the
+    parent process before forking workers, as connections cannot be shared
+    with (or safely closed from) a forked process.
+
+    """
+    from optimade.server.config import CONFIG, SupportedBackend
+    from optimade.server.routers import ENTRY_COLLECTIONS
+
+    if CONFIG.database_backend != SupportedBackend.MONGODB:
+        return
+
+    clients = {
+        id(client): client
+        for client in (
+            collection.collection.database.client  # type: ignore[attr-defined]
+            for collection in ENTRY_COLLECTIONS.values()
+        )
+    }
+    for client in clients.values():
+        client.close()
+
+
+def reconnect_database() -> None:
+    """Re-open the MongoDB connections of all entry collections, e.g., in a
+    freshly-forked worker process.
+
+    The in-memory (mongomock) database lives in the process itself and is
+    shared across forks, so is left untouched.
+
+    """
+    from optimade.server.config import CONFIG, SupportedBackend
+    from optimade.server.routers import ENTRY_COLLECTIONS
+
+    if CONFIG.database_backend != SupportedBackend.MONGODB:
+        return
+
+    from pymongo import MongoClient
+
+    client: MongoClient = MongoClient(CONFIG.mongo_uri)
+    for collection in ENTRY_COLLECTIONS.values():
+        collection.collection = client[CONFIG.mongo_database][  # type: ignore[attr-defined]
+            collection.collection.name  # type: ignore[attr-defined]
+        ]
@@ -0,0 +1,161 @@
+"""Writing the serialised entries of an ingest chunk to a gzip-compressed
+JSONL file.
+
+By default, lines are handed (in batches) over a bounded queue to a writer
+thread that compresses and writes them, so that compression and file I/O
+(which release the GIL) overlap with mapping entries in the worker's main
+thread. If the writer falls behind, the queue fills up and the mapping loop
+blocks until there is space (back-pressure), keeping memory bounded.
+
+The time spent by each stage is recorded, to show which stage limits the
+throughput of a worker.
+
+"""
+
+from __future__ import annotations
+
+import gzip
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+QUEUE_SIZE = 4
+"""The maximum number of batches waiting to be written."""
+BATCH_SIZE = 1000
+"""The number of lines handed to the writer thread at a time."""
+COMPRESSLEVEL = 6
+
+_DONE = object()
+
+
+class ChunkWriter:
+    """Write lines to `<path>.gz`, either pipelined through a writer thread, or
+    sequentially (writing the plain file, then compressing it on close).
+
+    Parameters:
+        path: The path of the uncompressed chunk; `.gz` is appended.
+        pipelined: Whether to compress and write in a separate thread.
+        queue_size: The maximum number of batches waiting to be written.
+        batch_size: The number of lines per batch.
+
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        pipelined: bool = True,
+        queue_size: int = QUEUE_SIZE,
+        batch_size: int = BATCH_SIZE,
+    ):
+        self.path = Path(f"{path}.gz")
+        self.plain_path = Path(path)
+        self.pipelined = pipelined
+        self.batch_size = batch_size
+        self.stats: dict[str, Any] = {}
+
+        self._batch: list[str] = []
+        self._blocked = 0.0
+        self._writer_busy = 0.0
+        self._writer_exception: BaseException | None = None
+        self._start = time.perf_counter()
+
+        if pipelined:
+            self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(
+                target=self._write_batches, name="chunk-writer", daemon=True
+            )
+            self._thread.start()
+        else:
+            self._file = open(self.plain_path, "w")
+
+    def __enter__(self) -> ChunkWriter:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close(abort=exc_type is not None)
+
+    def write(self, line: str) -> None:
+        if not self.pipelined:
+            self._file.write(line + "\n")
+            return
+        self._batch.append(line + "\n")
+        if len(self._batch) >= self.batch_size:
+            self._put(self._batch)
+            self._batch = []
+
+    def _put(self, item: Any) -> None:
+        """Hand an item to the writer thread, waiting while the queue is full
+        (unless the writer has died).
+
+        """
+        start = time.perf_counter()
+        while True:
+            self._check()
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self._blocked += time.perf_counter() - start
+
+    def _check(self) -> None:
+        if self._writer_exception is not None:
+            raise RuntimeError(
+                f"Writer thread for {self.path} failed"
+            ) from self._writer_exception
+
+    def _write_batches(self) -> None:
+        try:
+            with gzip.open(self.path, "wb", compresslevel=COMPRESSLEVEL) as f:
+                while (batch := self._queue.get()) is not _DONE:
+                    start = time.perf_counter()
+                    # A single large write lets zlib release the GIL for longer
+                    f.write("".join(batch).encode("utf-8"))
+                    self._writer_busy += time.perf_counter() - start
+        except BaseException as exc:
+            self._writer_exception = exc
+            # Keep draining so that the producer is never blocked forever
+            while self._queue.get() is not _DONE:
+                pass
+
+    def close(self, abort: bool = False) -> dict[str, Any]:
+        """Finish writing the chunk and return the time spent by each stage:
+        `producer` (e.g., mapping), `blocked` (waiting for the writer) and
+        `writer` (compressing and writing), with the total `elapsed` time.
+
+        """
+        if self.stats:
+            return self.stats
+        producer_end = time.perf_counter()
+        if self.pipelined:
+            if self._batch and not abort:
+                self._put(self._batch)
+            self._queue.put(_DONE)
+            self._thread.join()
+            if not abort:
+                self._check()
+        else:
+            self._file.close()
+            if not abort:
+                start = time.perf_counter()
+                with open(self.plain_path, "rb") as f_in:
+                    with gzip.open(
+                        self.path, "wb", compresslevel=COMPRESSLEVEL
+                    ) as f_out:
+                        f_out.writelines(f_in)
+                self._writer_busy = time.perf_counter() - start
+            self.plain_path.unlink()
+
+        elapsed = time.perf_counter() - self._start
+        producer = producer_end - self._start - self._blocked
+        self.stats = {
+            "elapsed": elapsed,
+            "producer": producer,
+            "blocked": self._blocked,
+            "writer": self._writer_busy,
+            "producer_utilisation": producer / elapsed if elapsed else 0.0,
+            "writer_utilisation": self._writer_busy / elapsed if elapsed else 0.0,
+        }
+        return self.stats
@@ -0,0 +1,317 @@
+"""Adaptive sizing of the chunks dispatched to ingest workers.
+
+Each ingest worker loads all the entries of its chunk into memory at once,
+so its peak memory grows with the chunk size, at a rate that varies between
+CSD releases and is hard to estimate up front. Instead of relying on a static
+estimate, the `AdaptiveChunker` starts with small chunks, measures the
+baseline and peak RSS and the throughput of each worker as its chunks
+complete, and sizes the subsequently dispatched chunks (and the number of
+workers active at once) to stay within a memory ceiling.
+
+If a worker is killed regardless (e.g., by the OOM killer), its chunk is split
+in half and retried, and the memory estimate is doubled.
+
+"""
+
+from __future__ import annotations
+
+import collections
+import logging
+import math
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator
+
+LOG = logging.getLogger(__name__)
+
+INITIAL_CHUNK_SIZE = 1_000
+"""The size of the first chunks, used to calibrate the memory model."""
+MIN_CHUNK_SIZE = 500
+"""Below this, per-chunk overheads dominate, so workers are removed instead."""
+MAX_CHUNK_SIZE = 50_000
+MAX_GROWTH = 2.0
+"""The maximum factor by which the chunk size can grow between chunks."""
+MEMORY_SAFETY_FACTOR = 0.85
+"""The fraction of the per-worker memory budget that chunks are sized to use."""
+DEFAULT_BASE_MEMORY = 0.5 * 1024**3
+DEFAULT_MEMORY_PER_ENTRY = 2.5 / 10_000 * 1024**3
+"""Prior estimates (in bytes) used before any chunk has completed."""
+
+
+@dataclass
+class ChunkStats:
+    """The measurements reported by a worker for a completed chunk."""
+
+    size: int
+    """The number of CSD indices in the chunk."""
+    entries: int
+    """The number of entries (good or bad) processed."""
+    start_rss: int
+    """The RSS of the worker before loading the chunk, in bytes."""
+    peak_rss: int
+    """The peak sampled RSS of the worker while processing the chunk, in bytes."""
+    elapsed: float
+    """The wall-clock time taken by the chunk, in seconds."""
+
+
+class AdaptiveChunker:
+    """Hands out the ranges of CSD indices to ingest, in index order, adapting
+    the chunk size and number of active workers to the measured memory usage.
+
+    Parameters:
+        start: The first index to ingest.
+        end: The (exclusive) last index to ingest. The final chunk is not
+            clamped to this if `open_ended` is set, as for the last node of a
+            distributed ingest.
+        memory_limit: The total memory (in bytes) that all workers may use.
+        max_workers: The maximum number of workers active at once.
+        chunk_size: A fixed chunk size to use, disabling adaptive sizing
+            (the number of workers is still adapted).
+        open_ended: Whether to extend the final chunk to a full chunk size.
+
+    """
+
+    def __init__(
+        self,
+        start: int,
+        end: int,
+        memory_limit: float,
+        max_workers: int,
+        chunk_size: int | None = None,
+        open_ended: bool = False,
+    ):
+        self.next_start = start
+        self.end = end
+        self.memory_limit = memory_limit
+        self.max_workers = max_workers
+        self.fixed_chunk_size = chunk_size
+        self.open_ended = open_ended
+
+        self.base_memory = DEFAULT_BASE_MEMORY
+        self.memory_per_entry = DEFAULT_MEMORY_PER_ENTRY
+        self.calibrated = False
+        self.retries: collections.deque[range] = collections.deque()
+        self.skipped: list[int] = []
+
+        self.completed_entries = 0
+        self.busy_time = 0.0
+
+        self.active_workers = max_workers
+        self.chunk_size = chunk_size or INITIAL_CHUNK_SIZE
+        self._fit_workers()
+
+    @property
+    def remaining(self) -> int:
+        return max(self.end - self.next_start, 0) + sum(len(r) for r in self.retries)
+
+    @property
+    def done(self) -> bool:
+        return not self.retries and self.next_start >= self.end
+
+    @property
+    def throughput(self) -> float:
+        """The mean number of entries processed per second per worker."""
+        return self.completed_entries / self.busy_time if self.busy_time else 0.0
+
+    def expected_peak(self, size: int) -> float:
+        """The expected peak RSS of a worker processing a chunk of `size`."""
+        return self.base_memory + self.memory_per_entry * size
+
+    def _budget_chunk_size(self, workers: int) -> int:
+        """The largest chunk size that fits in the memory budget of each of
+        `workers` workers.
+
+        """
+        budget = MEMORY_SAFETY_FACTOR * self.memory_limit / workers
+        return max(int((budget - self.base_memory) / self.memory_per_entry), 0)
+
+    def _fit_workers(self) -> None:
+        """Use as many workers as possible while keeping chunks above the
+        minimum size (or the fixed size, if set) within the memory budget.
+
+        """
+        wanted = self.fixed_chunk_size or MIN_CHUNK_SIZE
+        workers = self.max_workers
+        while workers > 1 and self._budget_chunk_size(workers) < wanted:
+            workers -= 1
+        if workers != self.active_workers:
+            LOG.info(
+                "Using %d of %d workers to fit chunks of >= %d entries within %.1f GB",
+                workers,
+                self.max_workers,
+                wanted,
+                self.memory_limit / 1024**3,
+            )
+        self.active_workers = workers
+
+    def _next_chunk_size(self) -> int:
+        if self.fixed_chunk_size:
+            return self.fixed_chunk_size
+        size = self._budget_chunk_size(self.active_workers)
+        if self.calibrated:
+            size = min(size, int(self.chunk_size * MAX_GROWTH))
+        else:
+            size = min(size, INITIAL_CHUNK_SIZE)
+        # Share out the tail of the run between the active workers
+        tail = math.ceil(self.remaining / self.active_workers)
+        size = min(size, max(tail, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+        return max(size, 1)
+
+    def next_range(self) -> range | None:
+        """Return the next range of indices to ingest, or `None` if finished."""
+        if self.retries:
+            return self.retries.popleft()
+        if self.next_start >= self.end:
+            return None
+        size = self._next_chunk_size()
+        if size != self.chunk_size:
+            LOG.info(
+                "Chunk size %d -> %d (expected peak RSS %.2f GB per worker, %d workers)",
+                self.chunk_size,
+                size,
+                self.expected_peak(size) / 1024**3,
+                self.active_workers,
+            )
+            self.chunk_size = size
+        stop = self.next_start + size
+        if stop >= self.end and not self.open_ended:
+            stop = self.end
+        range_ = range(self.next_start, stop)
+        self.next_start = stop
+        return range_
+
+    def fits(self, range_: range, available_memory: float) -> bool:
+        """Whether a chunk can be dispatched given the currently available
+        system memory, to back off if other processes have claimed memory.
+
+        """
+        return self.memory_per_entry * len(range_) < available_memory
+
+    def record(self, stats: ChunkStats) -> None:
+        """Update the memory model and throughput from a completed chunk."""
+        self.completed_entries += stats.entries
+        self.busy_time += stats.elapsed
+        if stats.size > 0:
+            per_entry = max(stats.peak_rss - stats.start_rss, 0) / stats.size
+            base = float(stats.start_rss)
+            if not self.calibrated:
+                self.memory_per_entry = per_entry or self.memory_per_entry
+                self.base_memory = base
+                self.calibrated = True
+            else:
+                # Track the upper envelope, decaying slowly towards recent chunks
+                self.memory_per_entry = max(
+                    per_entry, 0.9 * self.memory_per_entry + 0.1 * per_entry
+                )
+                self.base_memory = max(base, self.base_memory)
+        LOG.info(
+            "Chunk of %d entries took %.1f s (peak RSS %.2f GB); estimate %.2f GB + %.1f kB/entry, %.1f entries/s/worker",
+            stats.size,
+            stats.elapsed,
+            stats.peak_rss / 1024**3,
+            self.base_memory / 1024**3,
+            self.memory_per_entry / 1024,
+            self.throughput,
+        )
+        self._fit_workers()
+
+    def record_failure(self, ranges: list[range], pending: range | None = None) -> None:
+        """Requeue the ranges of the chunks that failed because a worker died
+        (e.g., was killed for running out of memory), split in half, and double
+        the memory estimate. Single entries that kill their worker are skipped.
+
+        A `pending` range that was handed out but not yet dispatched is also
+        requeued in halves, but never skipped.
+
+        """
+        self.memory_per_entry *= 2
+        LOG.warning(
+            "Worker died; retrying chunks %s in halves with %.1f kB/entry",
+            ranges,
+            self.memory_per_entry / 1024,
+        )
+        requeued = ranges + ([pending] if pending is not None else [])
+        for range_ in sorted(requeued, key=lambda r: r.start):
+            if len(range_) <= 1:
+                if range_ is pending:
+                    self.retries.append(range_)
+                    continue
+                LOG.error("Skipping chunk %s, which killed its worker", range_)
+                self.skipped.extend(range_)
+                continue
+            middle = range_.start + len(range_) // 2
+            self.retries.append(range(range_.start, middle))
+            self.retries.append(range(middle, range_.stop))
+        self.chunk_size = max(min(len(r) for r in requeued) // 2, 1)
+        self._fit_workers()
+
+
+def run_chunks(
+    chunker: AdaptiveChunker,
+    worker: Callable[[tuple[int, range]], Any],
+    pool_size: int,
+    available_memory: Callable[[], float],
+) -> Iterator[tuple[range, Any]]:
+    """Dispatch the ranges handed out by the chunker to `worker` (called with
+    the start of the range, as the chunk ID, and the range itself) on a pool
+    of `pool_size` processes, yielding each range and its result as it
+    completes.
+
+    Chunks are only dispatched while there are active workers free and (once
+    any are in flight) `available_memory()` fits them. If a worker dies, the
+    pool is replaced and the chunks in flight are retried via
+    `AdaptiveChunker.record_failure`; their results are never yielded, so any
+    partial output they wrote should be discarded by the caller.
+
+    The caller is expected to `AdaptiveChunker.record` each completed chunk.
+
+    """
+    from concurrent.futures import (
+        FIRST_COMPLETED,
+        Future,
+        ProcessPoolExecutor,
+        wait,
+    )
+    from concurrent.futures.process import BrokenProcessPool
+
+    in_flight: dict[Future, range] = {}
+    executor = ProcessPoolExecutor(pool_size)
+    try:
+        next_range = chunker.next_range()
+        while next_range is not None or in_flight:
+            # Dispatch chunks while there are free workers and memory
+            while (
+                next_range is not None
+                and len(in_flight) < chunker.active_workers
+                and (not in_flight or chunker.fits(next_range, available_memory()))
+            ):
+                future = executor.submit(worker, (next_range.start, next_range))
+                in_flight[future] = next_range
+                next_range = chunker.next_range()
+
+            finished, _ = wait(in_flight, timeout=10, return_when=FIRST_COMPLETED)
+            if any(
+                isinstance(future.exception(), BrokenProcessPool) for future in finished
+            ):
+                # A worker was killed (e.g., out of memory), failing all the
+                # chunks in flight, so collect them all and retry any that
+                # failed in smaller pieces on a fresh pool
+                finished, _ = wait(in_flight)
+                failed = [
+                    in_flight.pop(future)
+                    for future in finished
+                    if isinstance(future.exception(), BrokenProcessPool)
+                ]
+                executor.shutdown(wait=True, cancel_futures=True)
+                executor = ProcessPoolExecutor(pool_size)
+                chunker.record_failure(failed, pending=next_range)
+                next_range = chunker.next_range()
+
+            for future in finished:
+                if future not in in_flight:
+                    continue
+                yield in_flight.pop(future), future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
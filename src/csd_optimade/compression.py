@@ -0,0 +1,387 @@
+"""Negotiated response compression for the API, with an optional cache of
+precompressed single-entry responses.
+
+Responses are compressed with brotli (if the `brotli` package is installed,
+e.g., with the `server` extra) or gzip, depending on the client's
+`Accept-Encoding`. Single structure responses (`/structures/<id>`) can be
+large for big unit cells, so successful ones can additionally be cached in
+memory and served directly from the cache (least-recently-used entries are
+evicted once the cache reaches its size limit). A cache miss is compressed at
+the usual level, so as not to slow down the request, and the cached body is
+then replaced by one compressed at a higher level in a background thread.
+
+Compressing a large body takes long enough to stall every other request
+handled by the worker, so bodies (or streamed chunks) above
+`THREADED_COMPRESSION_SIZE` are compressed in a thread instead of on the
+event loop.
+
+"""
+
+from __future__ import annotations
+
+import re
+import zlib
+from collections import OrderedDict, deque
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MINIMUM_SIZE = 1024
+"""Responses smaller than this (in bytes) are not compressed."""
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+CACHED_GZIP_LEVEL = 9
+CACHED_BROTLI_QUALITY = 11
+"""Cached entries are recompressed once, so can afford slower, smaller compression."""
+MAX_PENDING_RECOMPRESSIONS = 64
+"""Cached entries beyond this many awaiting recompression are left as they are."""
+THREADED_COMPRESSION_SIZE = 64 * 1024
+"""Bodies (or chunks) larger than this (in bytes) are compressed in a thread."""
+
+SINGLE_ENTRY_PATH = re.compile(r"/structures/[^/]+$")
+
+UNCOMPRESSIBLE_MEDIA_TYPES = ("application/gzip",)
+
+
+def supported_encodings() -> tuple[str, ...]:
+    """The content encodings supported by the server, in order of preference."""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """Pick the preferred supported encoding from an `Accept-Encoding` header,
+    respecting any `q=0` exclusions.
+
+    """
+    accepted: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        accepted[coding.strip().lower()] = quality
+    encodings = [
+        encoding
+        for encoding in supported_encodings()
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0
+    ]
+    return encodings[0] if encodings else None
+
+
+def _compressor(encoding: str, cached: bool = False) -> tuple[Callable, Callable]:
+    """Return `(compress, flush)` functions for a streaming compressor."""
+    if encoding == "br":
+        compressor = brotli.Compressor(
+            quality=CACHED_BROTLI_QUALITY if cached else BROTLI_QUALITY
+        )
+        return compressor.process, compressor.finish
+    gzip_compressor = zlib.compressobj(
+        CACHED_GZIP_LEVEL if cached else GZIP_LEVEL, wbits=31
+    )
+    return gzip_compressor.compress, gzip_compressor.flush
+
+
+async def _compress(function: Callable[[bytes], bytes], data: bytes) -> bytes:
+    """Apply a compression function to the data, in a thread if the data is
+    large enough to block the event loop for long (zlib and brotli release the
+    GIL while compressing).
+
+    """
+    if len(data) < THREADED_COMPRESSION_SIZE:
+        return function(data)
+    import anyio.to_thread
+
+    return await anyio.to_thread.run_sync(function, data)
+
+
+class EntryCache:
+    """An LRU cache of (compressed) response bodies, bounded by their total size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[int, list, bytes]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: tuple) -> tuple[int, list, bytes] | None:
+        if (cached := self._entries.get(key)) is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return cached
+
+    def replace(self, key: tuple, headers: list, body: bytes) -> None:
+        """Replace the headers and body of a cached entry, if still cached,
+        without counting as a use.
+
+        """
+        if (cached := self._entries.get(key)) is None:
+            return
+        self.size += len(body) - len(cached[2])
+        self._entries[key] = (cached[0], headers, body)
+        while self.size > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def put(self, key: tuple, status: int, headers: list, body: bytes) -> None:
+        if len(body) > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= len(self._entries.pop(key)[2])
+        self._entries[key] = (status, headers, body)
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class CompressionMiddleware:
+    """ASGI middleware that compresses responses according to the client's
+    `Accept-Encoding`, and serves single-entry responses from an `EntryCache`
+    of precompressed bodies, if one is provided.
+
+    Responses that already have a `Content-Encoding`, are already compressed
+    files (e.g., the export endpoint) or are partial (range) responses are
+    passed through untouched.
+
+    """
+
+    def __init__(
+        self,
+        app,
+        minimum_size: int = MINIMUM_SIZE,
+        entry_cache: EntryCache | None = None,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.entry_cache = entry_cache
+        self._entry_endpoint = None
+        # Created on first use, i.e., in each worker process after forking
+        self._recompressor: ThreadPoolExecutor | None = None
+        self._pending: set[tuple] = set()
+        self._recompressed: deque[tuple[tuple, list | None, bytes]] = deque()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_headers = dict(scope["headers"])
+        encoding = negotiate_encoding(
+            request_headers.get(b"accept-encoding", b"").decode("latin-1")
+        )
+
+        if (
+            self.entry_cache is not None
+            and scope["method"] == "GET"
+            and SINGLE_ENTRY_PATH.search(scope["path"])
+        ):
+            return await self._cached_entry(scope, receive, send, encoding)
+
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        await _CompressingResponder(self.app, encoding, self.minimum_size)(
+            scope, receive, send
+        )
+
+    async def _cached_entry(self, scope, receive, send, encoding: str | None):
+        assert self.entry_cache is not None
+        self._apply_recompressed()
+        key = (scope["path"], scope.get("query_string", b""), encoding)
+        if (cached := self.entry_cache.get(key)) is not None:
+            # Label cache hits with the endpoint that would have served them
+            scope.setdefault("endpoint", self._entry_endpoint)
+        else:
+            status, headers, body = await _collect_response(self.app, scope, receive)
+            self._entry_endpoint = scope.get("endpoint")
+            if (
+                encoding is not None
+                and len(body) >= self.minimum_size
+                and not _skip_compression(status, headers)
+            ):
+                compress, flush = _compressor(encoding)
+                compressed = await _compress(
+                    lambda data: compress(data) + flush(), body
+                )
+                encoded_headers = _encoded_headers(headers, encoding, len(compressed))
+                if status == 200:
+                    self.entry_cache.put(key, status, encoded_headers, compressed)
+                    self._recompress(key, headers, body, encoding)
+                cached = (status, encoded_headers, compressed)
+            else:
+                if status == 200:
+                    self.entry_cache.put(key, status, headers, body)
+                cached = (status, headers, body)
+
+        status, headers, body = cached
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    def _recompress(
+        self, key: tuple, headers: list, body: bytes, encoding: str
+    ) -> None:
+        """Recompress the (uncompressed) body of a cached entry at the higher,
+        cached compression level in a background thread, to be swapped into
+        the cache by the event loop.
+
+        """
+        if key in self._pending or len(self._pending) >= MAX_PENDING_RECOMPRESSIONS:
+            return
+        if self._recompressor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._recompressor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="recompress"
+            )
+
+        def _run() -> None:
+            # Always report back, so that the key is no longer pending
+            encoded_headers, data = None, b""
+            try:
+                compress, flush = _compressor(encoding, cached=True)
+                data = compress(body) + flush()
+                encoded_headers = _encoded_headers(headers, encoding, len(data))
+            finally:
+                self._recompressed.append((key, encoded_headers, data))
+
+        self._pending.add(key)
+        self._recompressor.submit(_run)
+
+    def _apply_recompressed(self) -> None:
+        """Swap any recompressed bodies into the cache."""
+        assert self.entry_cache is not None
+        while self._recompressed:
+            key, headers, body = self._recompressed.popleft()
+            self._pending.discard(key)
+            if headers is not None:
+                self.entry_cache.replace(key, headers, body)
+
+
+def _skip_compression(status: int, headers: list[tuple[bytes, bytes]]) -> bool:
+    header_names = {name.lower() for name, _ in headers}
+    content_type = dict(headers).get(b"content-type", b"").decode("latin-1")
+    return (
+        status == 206
+        or b"content-encoding" in header_names
+        or b"content-range" in header_names
+        or content_type.startswith(UNCOMPRESSIBLE_MEDIA_TYPES)
+    )
+
+
+def _encoded_headers(
+    headers: list[tuple[bytes, bytes]], encoding: str, length: int | None
+) -> list[tuple[bytes, bytes]]:
+    """Update the response headers for a compressed body of the given length
+    (or `None`, if streamed).
+
+    """
+    headers = [
+        (name, value)
+        for name, value in headers
+        if name.lower() not in (b"content-length", b"vary")
+    ]
+    headers.append((b"content-encoding", encoding.encode("latin-1")))
+    headers.append((b"vary", b"Accept-Encoding"))
+    if length is not None:
+        headers.append((b"content-length", str(length).encode("latin-1")))
+    return headers
+
+
+async def _collect_response(app, scope, receive) -> tuple[int, list, bytes]:
+    """Run the app and collect its full response."""
+    status = 500
+    headers: list[tuple[bytes, bytes]] = []
+    chunks: list[bytes] = []
+
+    async def _send(message):
+        nonlocal status, headers
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            headers = list(message.get("headers", []))
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, _send)
+    return status, headers, b"".join(chunks)
+
+
+class _CompressingResponder:
+    """Compress a single (possibly streamed) response on the fly."""
+
+    def __init__(self, app, encoding: str, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send: Callable
+        self.start_message: dict | None = None
+        self.started = False
+        self.passthrough = False
+        self.compress, self.flush = _compressor(encoding)
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        await self.app(scope, receive, self._send)
+
+    async def _send(self, message):
+        if message["type"] == "http.response.start":
+            # Delay sending the headers until the first body chunk is known
+            self.start_message = message
+            self.passthrough = _skip_compression(
+                message["status"], list(message.get("headers", []))
+            )
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            if self.start_message is not None:
+                await self.send(self.start_message)
+                self.start_message = None
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start_message is not None:
+            start_message = self.start_message
+            self.start_message = None
+            headers = list(start_message.get("headers", []))
+            if not more_body and len(body) < self.minimum_size:
+                self.passthrough = True
+                await self.send(start_message)
+                await self.send(message)
+                return
+            if not more_body:
+                body = await _compress(
+                    lambda data: self.compress(data) + self.flush(), body
+                )
+                headers = _encoded_headers(headers, self.encoding, len(body))
+                await self.send({**start_message, "headers": headers})
+                await self.send({"type": "http.response.body", "body": body})
+                return
+            headers = _encoded_headers(headers, self.encoding, None)
+            await self.send({**start_message, "headers": headers})
+
+        data = await _compress(self.compress, body)
+        if not more_body:
+            data += self.flush()
+        if data or not more_body:
+            await self.send(
+                {"type": "http.response.body", "body": data, "more_body": more_body}
+            )
@@ -0,0 +1,175 @@
+"""A bounded-memory index of the entries already emitted, for deduplication.
+
+Combining the ingested chunks keeps only the first copy of each `(type, id)`.
+Holding every ID of the CSD (and its references) in Python sets takes hundreds
+of MB, so the `DedupIndex` only keeps them in memory up to a configurable
+limit, after which it spills them to an SQLite table on disk (whose page cache
+is bounded by the same limit) and answers all further lookups from there.
+
+An index can also be opened on a persistent path, so that a later run (e.g.,
+an incremental or resumed ingest) can ask whether an entry has already been
+emitted without re-reading the output.
+
+"""
+
+from __future__ import annotations
+
+import collections
+import sqlite3
+import tempfile
+from pathlib import Path
+
+DEFAULT_MEMORY_LIMIT = 256 * 1024**2
+"""The default memory limit (in bytes) of a dedup index."""
+ENTRY_OVERHEAD = 100
+"""The approximate memory (in bytes) used per ID held in memory, beyond the
+length of the ID itself (i.e., the `str` object and its slot in a `set`).
+
+"""
+COMMIT_INTERVAL = 100_000
+"""The number of IDs added to an on-disk index between commits."""
+
+
+class DedupIndex:
+    """A set of `(type, id)` pairs that spills to disk beyond a memory limit.
+
+    Parameters:
+        path: A persistent SQLite file to keep the index in, which is created
+            if it does not exist and is kept on close. If not given, IDs are
+            held in memory until the limit is reached, and then spilled to a
+            temporary file that is removed on close.
+        memory_limit: The approximate memory (in bytes) that the index may use.
+        tmp_dir: The directory for the temporary file (DEFAULT: the system
+            temporary directory).
+
+    """
+
+    def __init__(
+        self,
+        path: Path | None = None,
+        memory_limit: int = DEFAULT_MEMORY_LIMIT,
+        tmp_dir: Path | None = None,
+    ):
+        self.path = path
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.counts: collections.Counter[str] = collections.Counter()
+        self._ids: dict[str, set[str]] = {}
+        self._memory = 0
+        self._uncommitted = 0
+        self._tmp_file: tempfile._TemporaryFileWrapper | None = None
+        self._connection: sqlite3.Connection | None = None
+        if path is not None:
+            self._connection = self._connect(path, persistent=True)
+            self.counts.update(
+                dict(
+                    self._connection.execute(
+                        "SELECT type, COUNT(*) FROM seen GROUP BY type"
+                    ).fetchall()
+                )
+            )
+
+    @property
+    def spilled(self) -> bool:
+        """Whether the IDs are held on disk."""
+        return self._connection is not None
+
+    def _connect(self, path: Path, persistent: bool) -> sqlite3.Connection:
+        connection = sqlite3.connect(path, isolation_level=None)
+        # The page cache is given in KiB when negative
+        connection.execute(f"PRAGMA cache_size = {-max(self.memory_limit // 1024, 1)}")
+        if not persistent:
+            # A temporary index is discarded if anything fails, so needs no journal
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute("PRAGMA synchronous = OFF")
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS seen (
+                type TEXT NOT NULL,
+                id TEXT NOT NULL,
+                PRIMARY KEY (type, id)
+            ) WITHOUT ROWID
+            """
+        )
+        connection.execute("BEGIN")
+        return connection
+
+    def _spill(self) -> None:
+        """Move the IDs held in memory into a temporary on-disk index."""
+        self._tmp_file = tempfile.NamedTemporaryFile(
+            prefix="csd-optimade-dedup-", suffix=".sqlite", dir=self.tmp_dir
+        )
+        self._connection = self._connect(Path(self._tmp_file.name), persistent=False)
+        for entry_type, ids in self._ids.items():
+            self._connection.executemany(
+                "INSERT INTO seen VALUES (?, ?)",
+                ((entry_type, entry_id) for entry_id in ids),
+            )
+        self._ids = {}
+        self._memory = 0
+
+    def add(self, entry_type: str, entry_id: str) -> bool:
+        """Add an entry to the index, returning whether it was not already
+        present.
+
+        """
+        if self._connection is None:
+            ids = self._ids.setdefault(entry_type, set())
+            if entry_id in ids:
+                return False
+            ids.add(entry_id)
+            self.counts[entry_type] += 1
+            self._memory += len(entry_id) + ENTRY_OVERHEAD
+            if self._memory > self.memory_limit:
+                self._spill()
+            return True
+
+        cursor = self._connection.execute(
+            "INSERT OR IGNORE INTO seen VALUES (?, ?)", (entry_type, entry_id)
+        )
+        if not cursor.rowcount:
+            return False
+        self.counts[entry_type] += 1
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_INTERVAL:
+            self.commit()
+        return True
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        entry_type, entry_id = key
+        if self._connection is None:
+            return entry_id in self._ids.get(entry_type, ())
+        return (
+            self._connection.execute(
+                "SELECT 1 FROM seen WHERE type = ? AND id = ?", (entry_type, entry_id)
+            ).fetchone()
+            is not None
+        )
+
+    def __len__(self) -> int:
+        return sum(self.counts.values())
+
+    def commit(self) -> None:
+        """Commit the IDs added to an on-disk index."""
+        if self._connection is not None:
+            self._connection.execute("COMMIT")
+            self._connection.execute("BEGIN")
+            self._uncommitted = 0
+
+    def close(self) -> None:
+        """Close the index, keeping it only if it has a persistent path."""
+        if self._connection is not None:
+            self._connection.execute("COMMIT")
+            self._connection.close()
+            self._connection = None
+        if self._tmp_file is not None:
+            self._tmp_file.close()
+            self._tmp_file = None
+        self._ids = {}
+        self._memory = 0
+
+    def __enter__(self) -> DedupIndex:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
@@ -0,0 +1,257 @@
+"""CSD-specific extensions of the optimade-python-tools MongoDB collection.
+
+Note that this module must only be imported *after* the optimade-python-tools
+config has been set (e.g., by `OptimakeServer`), as importing the underlying
+MongoDB collection also creates the database client.
+
+"""
+
+from __future__ import annotations
+
+import copy
+import time
+from typing import TYPE_CHECKING, Any
+
+from optimade.exceptions import BadRequest
+from optimade.models import StructureResource
+from optimade.server.config import CONFIG
+from optimade.server.entry_collections.entry_collections import PaginationMechanism
+from optimade.server.entry_collections.mongo import MongoCollection
+from optimade.server.query_params import SingleEntryQueryParams
+
+from csd_optimade import lookup, stats
+from csd_optimade.metrics import record_explain, record_stage, should_explain
+from csd_optimade.symmetry import SITE_FIELDS, expand_attributes
+
+if TYPE_CHECKING:
+    from optimade.server.query_params import EntryListingQueryParams
+
+
+class CSDMongoCollection(MongoCollection):
+    """A MongoDB collection that uses keyset pagination on `id` by default, and
+    expands structures stored in the compact asymmetric unit representation.
+
+    Paging through large result sets with `page_offset` turns into a MongoDB
+    `skip()`, which gets linearly slower with depth. Instead, the results are
+    sorted by `id` and the `next` link carries a `page_above=<last id>` cursor,
+    so that each page is a seek on the unique `id` index regardless of depth.
+
+    Offset-based pagination is still used if requested explicitly by the client
+    (via `page_offset` or `page_number`), or if the results are sorted by any
+    field other than `id`.
+
+    """
+
+    pagination_mechanism = PaginationMechanism("page_above")
+
+    def _use_keyset_pagination(
+        self, params: EntryListingQueryParams | SingleEntryQueryParams
+    ) -> bool:
+        """Whether the given query can (and should) be paginated by `id`."""
+        if isinstance(params, SingleEntryQueryParams):
+            return False
+        if getattr(params, "page_offset", None) or isinstance(
+            getattr(params, "page_number", None), int
+        ):
+            return False
+        return getattr(params, "sort", "") in ("", "id")
+
+    def __len__(self) -> int:
+        """Return the total number of entries in the collection (i.e., the
+        `meta.data_available` of each response), from the precomputed dataset
+        statistics if available.
+
+        """
+        if (
+            stats.STATS is not None
+            and self.resource_mapper.ENDPOINT in stats.STATS.entries
+        ):
+            return stats.STATS.entries[self.resource_mapper.ENDPOINT]
+        return super().__len__()
+
+    def find(self, params: EntryListingQueryParams | SingleEntryQueryParams):
+        """Find the entries matching the query, materialising the sites of any
+        structures stored as their asymmetric unit (see `csd_optimade.symmetry`).
+
+        As this expansion can be expensive for large cells, it is only done
+        for single-entry responses, or if the site fields are explicitly
+        requested via `response_fields`.
+
+        """
+        results, data_returned, more_data_available, exclude_fields, include_fields = (
+            super().find(params)
+        )
+        requested = set((getattr(params, "response_fields", None) or "").split(","))
+        if results and (
+            SITE_FIELDS & requested
+            or (
+                isinstance(params, SingleEntryQueryParams)
+                and SITE_FIELDS & include_fields
+            )
+        ):
+            for result in results if isinstance(results, list) else [results]:
+                expand_attributes(result["attributes"])
+        return (
+            results,
+            data_returned,
+            more_data_available,
+            exclude_fields,
+            include_fields,
+        )
+
+    def handle_query_params(
+        self, params: EntryListingQueryParams | SingleEntryQueryParams
+    ) -> dict[str, Any]:
+        """Add keyset pagination to the MongoDB interpretation of the query
+        parameters, where possible.
+
+        Raises:
+            BadRequest: If `page_above` is combined with a sort on any other
+                field than `id`, or with `page_offset` or `page_number`.
+
+        """
+        start = time.perf_counter()
+        try:
+            return self._handle_query_params(params)
+        finally:
+            record_stage("filter_parse", time.perf_counter() - start)
+
+    def _handle_query_params(
+        self, params: EntryListingQueryParams | SingleEntryQueryParams
+    ) -> dict[str, Any]:
+        page_above: str | None = getattr(params, "page_above", None)
+        if page_above is not None and (
+            getattr(params, "page_offset", None)
+            or isinstance(getattr(params, "page_number", None), int)
+        ):
+            raise BadRequest(
+                detail="`page_above` cannot be combined with `page_offset` or `page_number`."
+            )
+        if page_above is not None:
+            # The parent class refuses to handle `page_above`, so hide it and apply it below
+            params = copy.copy(params)
+            params.page_above = None  # type: ignore[union-attr]
+
+        criteria = super().handle_query_params(params)
+
+        if (
+            lookup.LOOKUP_INDEX is not None
+            and criteria["filter"]
+            and issubclass(self.resource_cls, StructureResource)
+        ):
+            # Short-circuit equality filters on identifiers to a filter on `id`
+            criteria["filter"] = lookup.rewrite_filter(
+                criteria["filter"],
+                lookup.LOOKUP_INDEX,
+                id_field=self.resource_mapper.get_backend_field("id"),
+            )
+
+        if not self._use_keyset_pagination(params):
+            if page_above is not None and getattr(params, "sort", None):
+                raise BadRequest(
+                    detail="`page_above` can only be used when sorting by `id`."
+                )
+            return criteria
+
+        id_field = self.resource_mapper.get_backend_field("id")
+        criteria["sort"] = [(id_field, 1)]
+        criteria["keyset_filter"] = criteria["filter"]
+        if page_above is not None:
+            id_criterion = {id_field: {"$gt": page_above}}
+            criteria["filter"] = (
+                {"$and": [criteria["filter"], id_criterion]}
+                if criteria["filter"]
+                else id_criterion
+            )
+
+        return criteria
+
+    def _run_db_query(
+        self, criteria: dict[str, Any], single_entry: bool = False
+    ) -> tuple[list[dict[str, Any]], int | None, bool]:
+        """Run the query on the backend, avoiding any `skip()` for keyset-paginated
+        queries, and record how long it took.
+
+        """
+        start = time.perf_counter()
+        if "keyset_filter" in criteria:
+            results = self._run_keyset_db_query(criteria)
+        else:
+            results = super()._run_db_query(criteria, single_entry)
+        elapsed = time.perf_counter() - start
+        record_stage("database_query", elapsed)
+        if should_explain(elapsed):
+            record_explain(self._explain(criteria))
+        return results
+
+    def _explain(self, criteria: dict[str, Any]) -> dict[str, Any]:
+        """Return a summary of the MongoDB query plan and execution statistics for
+        the query, which is run again to collect them.
+
+        """
+        criteria = {k: v for k, v in criteria.items() if k != "keyset_filter"}
+        try:
+            explain = self.collection.find(**criteria).explain()
+        except Exception as exc:
+            # e.g., not supported by mongomock
+            return {"filter": criteria.get("filter"), "error": repr(exc)}
+        stats = explain.get("executionStats", {})
+        return {
+            "filter": criteria.get("filter"),
+            "sort": criteria.get("sort"),
+            "winning_plan": explain.get("queryPlanner", {}).get("winningPlan"),
+            "execution_time_ms": stats.get("executionTimeMillis"),
+            "keys_examined": stats.get("totalKeysExamined"),
+            "docs_examined": stats.get("totalDocsExamined"),
+            "n_returned": stats.get("nReturned"),
+        }
+
+    def _run_keyset_db_query(
+        self, criteria: dict[str, Any]
+    ) -> tuple[list[dict[str, Any]], int | None, bool]:
+        """Run a keyset-paginated query on the backend.
+
+        One more document than the page limit is requested to decide whether
+        more data is available, and `data_returned` is counted against the
+        original filter (without the `page_above` cursor).
+
+        """
+        criteria = criteria.copy()
+        base_filter = criteria.pop("keyset_filter")
+        limit = criteria["limit"]
+        results = list(self.collection.find(**{**criteria, "limit": limit + 1}))
+        more_data_available = len(results) > limit
+        results = results[:limit]
+
+        if criteria.get("projection", {}).get("_id"):
+            for doc in results:
+                doc["_id"] = str(doc["_id"])
+
+        data_returned: int | None
+        if not base_filter:
+            data_returned = len(self)
+        else:
+            count_kwargs: dict[str, Any] = {"filter": base_filter}
+            # If we're on the first page, set a much higher timeout for counting the results (10 s)
+            if criteria["filter"] is base_filter:
+                count_kwargs["maxTimeMS"] = 1000 * 10
+            else:
+                count_kwargs["maxTimeMS"] = int(1000 * CONFIG.mongo_count_timeout)
+            data_returned = self.count(**count_kwargs)
+
+        return results, data_returned, more_data_available
+
+    def get_next_query_params(
+        self,
+        params: EntryListingQueryParams,
+        results: dict[str, Any] | list[dict[str, Any]] | None,
+    ) -> dict[str, list[str]]:
+        """Provides a `page_above` cursor for the next link of keyset-paginated
+        queries, falling back to the parent implementation otherwise.
+
+        """
+        if self._use_keyset_pagination(params) and isinstance(results, list):
+            if results:
+                return {"page_above": [results[-1]["id"]]}
+            return {}
+        return super().get_next_query_params(params, results)
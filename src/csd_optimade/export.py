@@ -0,0 +1,199 @@
+"""A bulk export endpoint that streams (filtered) entries as gzip-compressed
+OPTIMADE JSONL, in the same format as written by `csd-ingest`.
+
+Without a filter, the compressed JSONL file that the database was loaded
+from is served directly from disk (with support for HTTP range requests), if
+available, or otherwise the plain JSONL file is compressed on the fly; if the
+data was not loaded from a file by this process (e.g., from stdin, or into a
+MongoDB populated beforehand), all entries are read from the database.
+With a filter, the matching entries are streamed from a database cursor in
+batches and compressed on the fly, so that memory usage does not depend on
+the size of the result.
+
+Entries read from the database are serialised as by `csd-ingest`, i.e.,
+with dates (stored as datetimes, after being read from MongoDB extended
+JSON) written back as `{"$date": "<ISO 8601>"}`, so that the export can be
+loaded again by `csd-serve`.
+
+"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import zlib
+from typing import TYPE_CHECKING, Any
+
+from fastapi import APIRouter, Request
+from fastapi.responses import FileResponse, StreamingResponse
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+    from pathlib import Path
+
+    from optimade.server.entry_collections import EntryCollection
+
+EXPORT_PATH = "/extensions/export"
+EXPORT_FILENAME = "csd-optimade.jsonl.gz"
+EXPORT_BATCH_SIZE = 1000
+FILE_CHUNK_SIZE = 1024**2
+"""The number of bytes of a plain JSONL file compressed at a time."""
+
+router = APIRouter(redirect_slashes=True)
+
+
+def find_compressed_jsonl(jsonl_path: Path | None) -> Path | None:
+    """Return the path to a gzip-compressed version of the given JSONL file,
+    i.e., the file itself or a `.gz` file alongside it, if one exists.
+
+    """
+    if jsonl_path is None:
+        return None
+    if jsonl_path.suffix == ".gz" and jsonl_path.is_file():
+        return jsonl_path
+    compressed_path = jsonl_path.with_name(jsonl_path.name + ".gz")
+    if compressed_path.is_file():
+        return compressed_path
+    return None
+
+
+def find_plain_jsonl(jsonl_path: Path | None) -> Path | None:
+    """Return the given path if it is an uncompressed JSONL file."""
+    if (
+        jsonl_path is not None
+        and jsonl_path.suffix == ".jsonl"
+        and jsonl_path.is_file()
+    ):
+        return jsonl_path
+    return None
+
+
+def _json_default(value: Any) -> Any:
+    """Serialise the datetimes in a database document as MongoDB extended
+    JSON, in the ISO 8601 format written by pydantic (i.e., by the mappers).
+
+    """
+    if isinstance(value, datetime.datetime):
+        iso = value.isoformat()
+        if value.utcoffset() == datetime.timedelta(0):
+            iso = iso.replace("+00:00", "Z")
+        return {"$date": iso}
+    if isinstance(value, datetime.date):
+        return {"$date": value.isoformat()}
+    import bson.json_util
+
+    return bson.json_util.default(value)
+
+
+def to_jsonl_line(entry: dict[str, Any]) -> str:
+    """Serialise an entry read from the database as a line of OPTIMADE JSONL,
+    in the same format as written by `csd-ingest`.
+
+    """
+    return json.dumps(entry, default=_json_default, separators=(",", ":"))
+
+
+def iter_collection_jsonl(
+    collection: EntryCollection,
+    mongo_filter: dict | None = None,
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> Iterator[str]:
+    """Yield the entries in the collection matching the (already transformed)
+    MongoDB filter as JSONL lines, reading them from the database in batches.
+
+    """
+    cursor = collection.collection.find(  # type: ignore[attr-defined]
+        mongo_filter or {}, projection={"_id": False}, batch_size=batch_size
+    )
+    for doc in cursor:
+        yield to_jsonl_line(collection.resource_mapper.map_back(doc))
+
+
+def gzip_lines(
+    lines: Iterable[str], batch_size: int = EXPORT_BATCH_SIZE
+) -> Iterator[bytes]:
+    """Compress the given lines into a gzip stream, yielding the compressed
+    data after every `batch_size` lines.
+
+    """
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    batch: list[str] = []
+    for line in lines:
+        batch.append(line + "\n")
+        if len(batch) >= batch_size:
+            if data := compressor.compress("".join(batch).encode("utf-8")):
+                yield data
+            batch = []
+    yield compressor.compress("".join(batch).encode("utf-8")) + compressor.flush()
+
+
+def gzip_file(path: Path, chunk_size: int = FILE_CHUNK_SIZE) -> Iterator[bytes]:
+    """Compress the given file into a gzip stream, `chunk_size` bytes at a time."""
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    with open(path, "rb") as handle:
+        while chunk := handle.read(chunk_size):
+            if data := compressor.compress(chunk):
+                yield data
+    yield compressor.flush()
+
+
+@router.get(EXPORT_PATH, tags=["Extensions"])
+def export(request: Request, filter: str = "", entry_type: str = ""):
+    """Download entries as a gzip-compressed OPTIMADE JSONL file.
+
+    Without any parameters, the full dataset (structures and references) is
+    returned. Otherwise, only the entries of `entry_type` (default: structures)
+    that match the OPTIMADE `filter` are returned.
+
+    """
+    from optimade.exceptions import BadRequest
+    from optimade.server.routers import ENTRY_COLLECTIONS
+
+    from csd_optimade.fields import generate_jsonl_headers
+
+    if entry_type:
+        if entry_type not in ("structures", "references"):
+            raise BadRequest(
+                detail=f"Cannot export entry type {entry_type!r}; must be one of 'structures' or 'references'."
+            )
+        entry_types = [entry_type]
+    elif filter:
+        entry_types = ["structures"]
+    else:
+        jsonl_path = getattr(request.app.state, "inserted_from", None)
+        if compressed_path := find_compressed_jsonl(jsonl_path):
+            return FileResponse(
+                compressed_path, media_type="application/gzip", filename=EXPORT_FILENAME
+            )
+        if plain_path := find_plain_jsonl(jsonl_path):
+            return StreamingResponse(
+                gzip_file(plain_path),
+                media_type="application/gzip",
+                headers={
+                    "Content-Disposition": f'attachment; filename="{EXPORT_FILENAME}"'
+                },
+            )
+        entry_types = ["structures", "references"]
+
+    # Parse the filters (and raise any errors) before the response starts streaming
+    mongo_filters = {}
+    for _type in entry_types:
+        collection = ENTRY_COLLECTIONS[_type]
+        mongo_filters[_type] = (
+            collection.transformer.transform(collection.parser.parse(filter))
+            if filter
+            else {}
+        )
+
+    def _export_lines() -> Iterator[str]:
+        yield from generate_jsonl_headers()
+        for _type in entry_types:
+            yield from iter_collection_jsonl(
+                ENTRY_COLLECTIONS[_type], mongo_filters[_type]
+            )
+
+    return StreamingResponse(
+        gzip_lines(_export_lines()),
+        media_type="application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{EXPORT_FILENAME}"'},
+    )
@@ -1,9 +1,14 @@
-from optimade import __api_version__
-from optimade import __version__ as __tools_version__
-from optimade.models.baseinfo import BaseInfoAttributes, BaseInfoResource
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
 
 from csd_optimade import __version__
 
+# optimade-python-tools is only imported by the functions that need it, so
+# that the CLIs can import this module (e.g., to print `--help`) cheaply
+if TYPE_CHECKING:
+    from optimade.models.baseinfo import BaseInfoResource
+
 
 def generate_csd_provider_fields():
     return {
@@ -107,6 +112,11 @@ def generate_csd_provider_fields():
                 "type": "string",
                 "description": "Free-text remarks about the structure.",
             },
+            {
+                "name": "_csd_asymmetric_unit",
+                "type": "dictionary",
+                "description": "A compact representation of the crystal structure (if ingested with `--compact`): the `fractional_site_positions` and `species_at_sites` of the asymmetric unit, and the `symmetry_operations_xyz` that generate the unit cell from it. The `cartesian_site_positions`, `species_at_sites` and `lattice_vectors` fields are generated from this for single-entry responses, or when explicitly requested in `response_fields`.",
+            },
         ]
     }
 
@@ -121,6 +131,8 @@ def generate_csd_provider_info():
 
 
 def generate_implementation_info():
+    from optimade import __version__ as __tools_version__
+
     return {
         "name": f"CSD OPTIMADE (based on optimade-python-tools {__tools_version__})",
         "version": __version__,
@@ -135,6 +147,9 @@ def generate_license_link():
 
 
 def generate_csd_info_endpoint() -> dict[str, BaseInfoResource]:
+    from optimade import __api_version__
+    from optimade.models.baseinfo import BaseInfoAttributes, BaseInfoResource
+
     return {
         "data": BaseInfoResource(
             attributes=BaseInfoAttributes(
@@ -149,3 +164,35 @@ def generate_csd_info_endpoint() -> dict[str, BaseInfoResource]:
             )
         )
     }
+
+
+def generate_jsonl_headers() -> list[str]:
+    """Return the header lines of a CSD OPTIMADE JSONL file, i.e., the
+    `x-optimade` header, followed by the info endpoint and the entry info
+    endpoints for structures and references.
+
+    """
+    import json
+
+    from optimade import __api_version__
+    from optimade_maker.convert import _construct_entry_type_info
+
+    provider = generate_csd_provider_info()
+    info = generate_csd_info_endpoint()
+
+    return [
+        json.dumps({"x-optimade": {"meta": {"api_version": __api_version__}}}),
+        json.dumps(
+            {"data": info["data"].model_dump(exclude_unset=True, exclude_none=False)}
+        ),
+        _construct_entry_type_info(
+            "structures",
+            properties=generate_csd_provider_fields()["structures"],
+            provider_prefix=provider["prefix"],
+        ).model_dump_json(),
+        _construct_entry_type_info(
+            "references",
+            properties=[],
+            provider_prefix=provider["prefix"],
+        ).model_dump_json(),
+    ]
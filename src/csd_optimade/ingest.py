@@ -1,113 +1,216 @@
-from __future__ import annotations
+"""Ingestion of the CSD into OPTIMADE JSONL files, and the `csd-ingest` CLI.
+
+The CSD Python API, the OPTIMADE models and the other heavy dependencies are
+only imported on the code paths that need them, so that `csd-ingest --help`,
+argument errors and the `merge`/`verify` subcommands start quickly (and do
+not need the CSD Python API at all). They are imported once in the main
+process before the worker pool is created, so that forked workers inherit
+them rather than importing them again.
 
-from optimade import __api_version__
+"""
 
-from csd_optimade.fields import (
-    generate_csd_info_endpoint,
-    generate_csd_provider_fields,
-    generate_csd_provider_info,
-)
+from __future__ import annotations
 
 BAD_IDENTIFIERS = {
     "QIJZOB",  # hangs infinitely during mapping
 }
 
-import glob
-import gzip
 import itertools
-import json
 import logging
-import math
 import os
+import re
 import time
 import warnings
 from functools import partial
 from pathlib import Path
 from typing import TYPE_CHECKING, Callable
 
-import ccdc.crystal
-import ccdc.entry
-import ccdc.io
-import psutil
-import tqdm
-
 if TYPE_CHECKING:
     from collections.abc import Generator
 
+    import ccdc.entry
+    import ccdc.io
     from optimade.models import ReferenceResource, StructureResource
 
-from optimade_maker.convert import _construct_entry_type_info
-
-from csd_optimade.mappers import from_csd_entry_directly
+    from csd_optimade.stats import DatasetStats
 
 LOG = logging.getLogger(__name__)
 LOG.handlers = [logging.StreamHandler()]
 LOG.setLevel(logging.INFO)
 
+RSS_SAMPLE_INTERVAL = 100
+"""The number of entries between samples of the worker RSS."""
+
 
 def from_csd_database(
     reader: ccdc.io.EntryReader,
     range_: Generator = itertools.count(),  # type: ignore
     mapper: Callable[
         [ccdc.entry.Entry], tuple[StructureResource, list[ReferenceResource]]
-    ] = from_csd_entry_directly,
+    ]
+    | None = None,
+    stats: DatasetStats | None = None,
 ) -> Generator[str | RuntimeError]:
     """Loop through a chunk of the entry reader and map the entries to OPTIMADE
     structures, plus a list of any linked resources.
+
+    Linked resources (i.e., references, which have deterministic IDs) are only
+    yielded the first time they are seen in the chunk; any duplicates across
+    chunks are removed when the chunks are combined.
+
+    If `stats` are given, the facets of each mapped structure are counted.
     """
+    if mapper is None:
+        from csd_optimade.mappers import from_csd_entry_directly
+
+        mapper = from_csd_entry_directly
+
     chunked_structures = [entry for entry in [reader[r] for r in range_]]
+    seen_resources: set[tuple[str, str]] = set()
     for entry in chunked_structures:
         if entry.identifier in BAD_IDENTIFIERS:
             continue
         try:
             data, included = mapper(entry)
             yield data.model_dump_json(exclude_unset=True, exclude_none=True)
+            if stats is not None:
+                stats.add_structure(dict(data.attributes))
             for resource in included or []:
+                if (resource.type, resource.id) in seen_resources:
+                    continue
+                seen_resources.add((resource.type, resource.id))
                 yield resource.model_dump_json(exclude_unset=True, exclude_none=True)
         except Exception:
             yield RuntimeError(f"Bad entry: {entry.identifier!r}")
 
 
-def handle_chunk(args, run_name: str = "test", num_chunks: int | None = None):
-    """Handle a chunk of the CSD database, logging bad entries and showing a progress bar."""
+def handle_chunk(
+    args,
+    run_name: str = "test",
+    max_chunk_id: int | None = None,
+    output_dir: Path = Path("data"),
+    pipelined: bool = True,
+    compact: bool = False,
+):
+    """Handle a chunk of the CSD database, logging bad entries, and return a
+    record of the chunk including its memory usage and timings.
+
+    With `pipelined`, the mapped entries are compressed and written in a
+    separate thread while mapping continues; otherwise, the chunk is written
+    and then compressed in sequence. With `compact`, the unit cell is not packed,
+    and the asymmetric unit is stored instead (see `csd_optimade.symmetry`).
+
+    The RSS of the worker is sampled periodically while the chunk is processed,
+    so that the size of later chunks can be adapted to the observed peak, and
+    the facets of the mapped structures are counted (see `csd_optimade.stats`).
+
+    """
+    import ccdc.io
+    import psutil
+
+    from csd_optimade.chunk_writer import ChunkWriter
+    from csd_optimade.mappers import from_csd_entry_directly
+    from csd_optimade.stats import DatasetStats
+
     chunk_id, range_ = args
     bad_count: int = 0
     total_count: int = 0
-    str_chunk_id = f"{chunk_id:0{len(str(num_chunks))}d}"
-    chunk_path = Path(f"data/{run_name}-optimade-{str_chunk_id}.jsonl")
-    with open(chunk_path, "w") as f:
+    stats = DatasetStats()
+    process = psutil.Process()
+    start_rss = peak_rss = process.memory_info().rss
+    start_time = time.perf_counter()
+    str_chunk_id = f"{chunk_id:0{len(str(max_chunk_id))}d}"
+    chunk_path = output_dir / f"{run_name}-optimade-{str_chunk_id}.jsonl"
+    with ChunkWriter(chunk_path, pipelined=pipelined) as writer:
         try:
-            for entry in from_csd_database(ccdc.io.EntryReader("CSD"), range_):
+            for entry in from_csd_database(
+                ccdc.io.EntryReader("CSD"),
+                range_,
+                mapper=partial(from_csd_entry_directly, compact=compact),
+                stats=stats,
+            ):
+                # The first entry is only yielded once the whole chunk is loaded
+                if total_count % RSS_SAMPLE_INTERVAL == 0:
+                    peak_rss = max(peak_rss, process.memory_info().rss)
                 total_count += 1
                 if isinstance(entry, Exception):
                     bad_count += 1
                     LOG.warning("Skipping bad entry: %s", entry)
                     continue
                 else:
-                    f.write(entry + "\n")
+                    writer.write(entry)
         except RuntimeError:
             # The database iterator raises RuntimeError once we are out of bounds
             pass
+    peak_rss = max(peak_rss, process.memory_info().rss)
     if total_count == 0 and bad_count != 0:
         raise RuntimeError("No good entries found in chunk; something went wrong.")
 
-    # Gzip the chunked file
-    with open(chunk_path, "rb") as f_in:
-        with gzip.open(f"{chunk_path}.gz", "wb") as f_out:
-            f_out.writelines(f_in)
-
-    chunk_path.unlink()
+    LOG.info(
+        "Wrote chunk %s to %s (%.1f s: mapping %.0f%%, blocked %.0f%%, compressing/writing %.0f%%)",
+        chunk_id,
+        writer.path,
+        writer.stats["elapsed"],
+        100 * writer.stats["producer_utilisation"],
+        100 * writer.stats["blocked"] / (writer.stats["elapsed"] or 1),
+        100 * writer.stats["writer_utilisation"],
+    )
 
-    LOG.info(f"Wrote chunk {chunk_id} to {chunk_path}")
+    return {
+        "path": str(writer.path),
+        "index_range": [range_.start, range_.stop],
+        "entries": total_count - bad_count,
+        "bad_entries": bad_count,
+        "start_rss": start_rss,
+        "peak_rss": peak_rss,
+        "elapsed": time.perf_counter() - start_time,
+        "stages": writer.stats,
+        "stats": stats.to_dict(),
+    }
+
+
+def collect_chunk_files(
+    chunks: list[dict], chunk_dir: Path, run_name: str
+) -> list[Path]:
+    """Return the files written for the completed chunks, in index order, and
+    remove any other chunk files of the run from `chunk_dir` (e.g., written
+    in part by a worker that died, for a range that was then skipped).
 
-    return chunk_id, total_count, bad_count
+    """
+    paths = [
+        Path(chunk["path"])
+        for chunk in sorted(chunks, key=lambda chunk: chunk["index_range"][0])
+    ]
+    pattern = re.compile(rf"{re.escape(run_name)}-optimade-\d+\.jsonl\.gz")
+    for path in chunk_dir.iterdir():
+        if pattern.fullmatch(path.name) and path not in paths:
+            LOG.warning("Removing %s, which was not written by a completed chunk", path)
+            path.unlink()
+    return paths
 
 
 def cli():
     import argparse
-    from multiprocessing import Pool
+    import sys
+
+    if sys.argv[1:2] == ["merge"]:
+        from csd_optimade.merge import cli as merge_cli
+
+        return merge_cli(sys.argv[2:])
+
+    if sys.argv[1:2] == ["verify"]:
+        from csd_optimade.verify import cli as verify_cli
+
+        return verify_cli(sys.argv[2:])
 
-    parser = argparse.ArgumentParser()
+    import psutil
+
+    from csd_optimade.dedup import DEFAULT_MEMORY_LIMIT
+    from csd_optimade.merge import parse_shard
+
+    parser = argparse.ArgumentParser(
+        epilog="Use `csd-ingest merge --help` for merging the outputs of multiple nodes, and `csd-ingest verify --help` for validating the final output."
+    )
     parser.add_argument(
         "--num-processes",
         type=int,
@@ -118,7 +221,7 @@ def cli():
         "--chunk-size",
         type=int,
         default=None,
-        help="Number of structures to process in each chunk (DEFAULT: set automatically based on available memory and process count",
+        help="Number of structures to process in each chunk (DEFAULT: adapted to the memory usage observed while ingesting).",
     )
     parser.add_argument(
         "--num-structures",
@@ -128,10 +231,59 @@ def cli():
         default=int(1_290_000),
         help="Number of structures from the CSD to ingest (DEFAULT: all)",
     )
+    parser.add_argument(
+        "--memory-limit",
+        type=float,
+        default=None,
+        help="The total memory (in GB) that all workers may use; chunk sizes and the number of active workers are adapted to stay within it (DEFAULT: 80%% of the available memory).",
+    )
     parser.add_argument("--run-name", type=str, default="csd")
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Store each structure's asymmetric unit and symmetry operators instead of packing the unit cell, with the sites materialised by the server on request.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Compress and write each chunk in a writer thread alongside mapping, rather than after it (DEFAULT: only if there are more logical cores than processes, as the writer thread otherwise competes with the mapping for the same core).",
+    )
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=None,
+        help="Write this many deduplicated JSONL shards, partitioned by a hash of each entry's type and ID, plus a manifest, instead of a single combined file.",
+    )
+    parser.add_argument(
+        "--dedup-memory-limit",
+        type=float,
+        default=DEFAULT_MEMORY_LIMIT / 1024**2,
+        help="The memory (in MB) that the IDs held for deduplicating the output may use (per process, when sharding), beyond which they are spilled to disk (DEFAULT: %(default).0f).",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        metavar="i/N",
+        help="Run as node i (counting from 0) of N cooperating nodes, each ingesting a disjoint slice of the CSD into its own directory with a node manifest, to be combined with `csd-ingest merge`.",
+    )
 
     args = parser.parse_args()
 
+    import tqdm
+
+    from csd_optimade.chunking import AdaptiveChunker, ChunkStats, run_chunks
+    from csd_optimade.fields import generate_jsonl_headers
+    from csd_optimade.lookup import build_lookup_index, lookup_path
+    from csd_optimade.merge import (
+        combine_chunks,
+        node_dir,
+        node_index_range,
+        write_node_manifest,
+    )
+    from csd_optimade.stats import DatasetStats, merge_stats, stats_path, write_stats
+
     pool_size = args.num_processes
     if pool_size is None:
         pool_size = psutil.cpu_count(logical=False)
@@ -141,131 +293,174 @@ def cli():
         )
         time.sleep(5)
 
-    available_memory = 0.8 * psutil.virtual_memory().available / 1024**3 / pool_size
-
-    chunk_size = args.chunk_size
-    base_memory_gb = 0.5
-    memory_per_item_gb = 2.5 / 10_000
-    if chunk_size is None:
-        # Get available memory in GB and attempt to use 80%
-        # Assuming approximately 3 GB for chunk_size 10_000 and a minimum for 500 MB per process to load the DB
-        chunk_size = int((available_memory - base_memory_gb) / memory_per_item_gb)
-
     if args.num_structures > 1_300_000:
         args.num_structures = 1_300_000
 
-    estimated_peak_memory_usage = base_memory_gb + memory_per_item_gb * chunk_size
-    if estimated_peak_memory_usage > available_memory:
-        warnings.warn(
-            f"WARNING: Estimated peak memory usage per process {estimated_peak_memory_usage} GB for {chunk_size=} exceeds available memory per process {available_memory} GB. Waiting 5 seconds before continuing..."
-        )
-        time.sleep(5)
+    node, num_nodes = args.shard or (0, 1)
+    start, end = node_index_range(node, num_nodes, int(args.num_structures))
+
+    # Chunk sizes (and the number of active workers) are adapted to the
+    # memory usage observed as chunks complete, within this ceiling
+    memory_limit = (
+        args.memory_limit * 1024**3
+        if args.memory_limit
+        else 0.8 * psutil.virtual_memory().available
+    )
+    chunker = AdaptiveChunker(
+        start,
+        end or int(args.num_structures),
+        memory_limit=memory_limit,
+        max_workers=pool_size,
+        chunk_size=args.chunk_size,
+        open_ended=end is None,
+    )
+    chunking_log = logging.getLogger(chunker.__module__)
+    chunking_log.handlers = LOG.handlers
+    chunking_log.setLevel(logging.INFO)
 
-    if chunk_size > int(args.num_structures):
-        chunk_size = int(args.num_structures)
-        num_chunks = 1
-        pool_size = 1
-    else:
-        num_chunks = math.ceil(args.num_structures / chunk_size)
+    pipelined = args.pipeline
+    if pipelined is None:
+        pipelined = psutil.cpu_count(logical=True) > pool_size
 
     run_name = args.run_name
 
-    ranges = (range(i * chunk_size, (i + 1) * chunk_size) for i in range(num_chunks))
+    output_dir = Path("data")
+    chunk_dir = output_dir
+    if args.shard:
+        chunk_dir = node_dir(output_dir, run_name, node, num_nodes)
+        chunk_dir.mkdir(parents=True, exist_ok=True)
 
     # Prepare info to prevent errors after multiprocessing
-    info = generate_csd_info_endpoint()
-    provider = generate_csd_provider_info()
-
-    info_string = json.dumps(
-        {"data": info["data"].model_dump(exclude_unset=True, exclude_none=False)}
+    headers = generate_jsonl_headers()
+
+    worker = partial(
+        handle_chunk,
+        run_name=run_name,
+        max_chunk_id=chunker.end,
+        output_dir=chunk_dir,
+        pipelined=pipelined,
+        compact=args.compact,
     )
 
-    entry_info_structures = _construct_entry_type_info(
-        "structures",
-        properties=generate_csd_provider_fields()["structures"],
-        provider_prefix=provider["prefix"],
-    ).model_dump_json()
+    # Import the mapping dependencies before the pool is created, so that
+    # the forked workers inherit them rather than each importing them again
+    import ccdc.io  # noqa: F401
+    import optimade.models  # noqa: F401
 
-    entry_info_references = _construct_entry_type_info(
-        "references",
-        properties=[],
-        provider_prefix=provider["prefix"],
-    ).model_dump_json()
+    import csd_optimade.chunk_writer  # noqa: F401
+    import csd_optimade.mappers  # noqa: F401
+    import csd_optimade.symmetry  # noqa: F401
 
     total_bad = 0
     total = 0
-    with Pool(pool_size) as pool:
-        with tqdm.tqdm(
-            total=num_chunks * chunk_size,
-            desc=f"Processing CSD ({chunk_size=}, {pool_size=}",
-        ) as pbar:
-            for chunk_id, total_count, bad_count in pool.imap_unordered(
-                partial(handle_chunk, run_name=run_name, num_chunks=num_chunks),
-                enumerate(ranges),
-                chunksize=1,
-            ):
-                total_bad += bad_count
-                total += total_count
-                pbar.update(total_count)
-                try:
-                    pbar.set_postfix({"% bad": 100 * (total_bad / total)})
-                except ZeroDivisionError:
-                    pbar.set_postfix({"% bad": "???"})
-
-    # Combine all results into a single JSONL file, first temporary
-    output_dir = Path("data")
+    chunks = []
+    stage_times = dict.fromkeys(("elapsed", "producer", "blocked", "writer"), 0.0)
+    with tqdm.tqdm(
+        total=chunker.remaining, desc=f"Processing CSD ({pool_size=})"
+    ) as pbar:
+        for range_, chunk in run_chunks(
+            chunker,
+            worker,
+            pool_size,
+            available_memory=lambda: psutil.virtual_memory().available,
+        ):
+            chunker.record(
+                ChunkStats(
+                    size=len(range_),
+                    entries=chunk["entries"] + chunk["bad_entries"],
+                    start_rss=chunk["start_rss"],
+                    peak_rss=chunk["peak_rss"],
+                    elapsed=chunk["elapsed"],
+                )
+            )
+            chunks.append(chunk)
+            for stage in ("elapsed", "producer", "blocked", "writer"):
+                stage_times[stage] += chunk["stages"][stage]
+            total_bad += chunk["bad_entries"]
+            total += chunk["entries"] + chunk["bad_entries"]
+            pbar.update(len(range_))
+            pbar.set_postfix(
+                {
+                    "% bad": f"{100 * total_bad / total:.2f}" if total else "???",
+                    "chunk_size": chunker.chunk_size,
+                    "workers": chunker.active_workers,
+                }
+            )
+
+    if stage_times["elapsed"]:
+        LOG.info(
+            "Worker time: mapping %.0f%%, blocked on writer %.0f%%, compressing/writing %.0f%% (in parallel: %s)",
+            *(
+                100 * stage_times[stage] / stage_times["elapsed"]
+                for stage in ("producer", "blocked", "writer")
+            ),
+            pipelined,
+        )
+
+    if chunker.skipped:
+        LOG.error(
+            "Skipped CSD indices %s, which repeatedly killed their worker",
+            chunker.skipped,
+        )
+
+    input_files = collect_chunk_files(chunks, chunk_dir, run_name)
+
+    if args.shard:
+        manifest = write_node_manifest(
+            chunk_dir, run_name, node, num_nodes, (start, end), chunks
+        )
+        print(
+            f"Wrote {len(chunks)} chunks for node {node} of {num_nodes} to {chunk_dir}, described by {manifest}"
+        )
+        return
+
+    if args.num_shards:
+        from csd_optimade.shards import read_manifest, write_shards
+
+        manifest = write_shards(
+            input_files,
+            output_dir,
+            run_name,
+            args.num_shards,
+            headers,
+            pool_size=pool_size,
+            tmp_dir=Path(f"/tmp/csd-optimade/{run_name}-shards"),
+            dedup_memory_limit=int(args.dedup_memory_limit * 1024**2),
+        )
+        for path in input_files:
+            path.unlink()
+        shards = read_manifest(manifest)
+        lookup_index = build_lookup_index(
+            [shard["path"] for shard in shards["shards"]],
+            lookup_path(output_dir, run_name),
+        )
+        stats = write_stats(
+            merge_stats(chunk["stats"] for chunk in chunks) or DatasetStats(),
+            shards["entries"],
+            stats_path(output_dir, run_name),
+        )
+        print(
+            f"Wrote {len(input_files)} chunks into {args.num_shards} shards, described by {manifest}, with lookup index {lookup_index} and statistics {stats}"
+        )
+        return
+
+    # Combine all results into a single deduplicated JSONL file
     output_file = output_dir / f"{run_name}-optimade.jsonl"
-    tmp_dir = Path(f"/tmp/csd-optimade/{run_name}")
-    tmp_dir.mkdir(exist_ok=True, parents=True)
-    tmp_jsonl_path = tmp_dir / output_file.name
-
-    pattern = f"{run_name}-optimade-*.jsonl.gz"
-    input_files = sorted(
-        glob.glob(os.path.join(output_dir, pattern)),
-        key=lambda x: int(x.split("-")[-1].split(".")[0]),
+    counts = combine_chunks(
+        input_files,
+        output_file,
+        headers,
+        dedup_memory_limit=int(args.dedup_memory_limit * 1024**2),
+    )
+    for path in input_files:
+        path.unlink()
+    lookup_index = build_lookup_index([output_file], lookup_path(output_dir, run_name))
+    stats = write_stats(
+        merge_stats(chunk["stats"] for chunk in chunks) or DatasetStats(),
+        counts,
+        stats_path(output_dir, run_name),
     )
 
-    with open(tmp_jsonl_path, "w") as tmp_jsonl:
-        # Decompress and combine all files into a single temporary file that needs to be deduplicated
-        for filename in input_files:
-            file = Path(filename)
-            with gzip.open(file, "rb") as infile:
-                tmp_jsonl.write(infile.read().decode("utf-8"))
-            tmp_jsonl.write("\n")
-            file.unlink()
-
-    with open(tmp_jsonl_path) as tmp_jsonl:
-        ids_by_type: dict[str, set] = {}
-        with open(output_file, "w") as final_jsonl:
-            # Write headers and info endpoints
-            final_jsonl.write(
-                json.dumps({"x-optimade": {"meta": {"api_version": __api_version__}}})
-                + "\n"
-            )
-            final_jsonl.write(info_string + "\n")
-            final_jsonl.write(entry_info_structures + "\n")
-            final_jsonl.write(entry_info_references + "\n")
-
-            for line_entry in tmp_jsonl:
-                if not line_entry.strip():
-                    continue
-                json_entry = json.loads(line_entry)
-                if _type := json_entry.get("type"):
-                    if _type not in ids_by_type:
-                        ids_by_type[_type] = set()
-                    if _id := json_entry.get("id") in ids_by_type[_type]:
-                        continue
-                    ids_by_type[_type].add(json_entry["id"])
-                    final_jsonl.write(line_entry)
-
-    # Remove the temporary directory
-    try:
-        tmp_jsonl_path.unlink()
-        tmp_dir.rmdir()
-    except OSError:
-        raise OSError(f"Dir entries: {os.listdir(tmp_dir)}")
-
-    # Final scan to remove duplicates an empty lines
     print(
-        f"Combined {len(input_files)} files into {output_file} (total size of file: {os.path.getsize(output_file) / 1024**2:.1f} MB)"
+        f"Combined {len(input_files)} files into {output_file} (total size of file: {os.path.getsize(output_file) / 1024**2:.1f} MB), with lookup index {lookup_index} and statistics {stats}"
     )
@@ -0,0 +1,252 @@
+"""Pipelined insertion of OPTIMADE JSONL data into the database.
+
+The JSONL can be read from a plain or gzip-compressed file, or from a
+(possibly compressed) stream on stdin, so that a compressed artefact can be
+inserted without first writing the decompressed file to disk. Reading (and
+decompressing), JSON parsing and database writes run as three stages
+connected by bounded queues: decompression and database I/O release the
+GIL, so they overlap with parsing in the main thread.
+
+"""
+
+from __future__ import annotations
+
+import contextlib
+import gzip
+import json
+import queue
+import sys
+import threading
+from typing import IO, TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator
+    from pathlib import Path
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+INSERT_BATCH_SIZE = 1000
+QUEUE_SIZE = 8
+"""The maximum number of batches waiting between each stage of the pipeline."""
+
+_DONE = object()
+
+
+@contextlib.contextmanager
+def open_jsonl(path: Path | str) -> Iterator[IO[bytes]]:
+    """Open a JSONL file for reading as bytes, or stdin if `path` is `-`,
+    transparently decompressing gzip-compressed data.
+
+    """
+    from_stdin = str(path) == "-"
+    raw: Any = sys.stdin.buffer if from_stdin else open(path, "rb")
+    try:
+        if raw.peek(2)[:2] == GZIP_MAGIC:
+            with gzip.GzipFile(fileobj=raw, mode="rb") as handle:
+                yield handle  # type: ignore[misc]
+        else:
+            yield raw
+    finally:
+        if not from_stdin:
+            raw.close()
+
+
+def _to_database_format(entry: dict[str, Any]) -> tuple[str, dict[str, Any]] | None:
+    """Flatten an OPTIMADE JSONL entry into the format stored in the database,
+    returning `None` for any info endpoints.
+
+    """
+    _id = entry.get("id")
+    _type = entry.get("type")
+    if _id is None or _type == "info" or _type is None:
+        return None
+    doc = entry["attributes"]
+    doc["id"] = _id
+    for key in ("relationships", "links"):
+        if key in entry:
+            doc[key] = entry[key]
+    return _type, doc
+
+
+class _Stage(threading.Thread):
+    """A pipeline stage that runs `target` in a thread, keeping any exception
+    to be re-raised by the main thread.
+
+    """
+
+    def __init__(self, target: Callable[[], None], name: str):
+        super().__init__(name=name, daemon=True)
+        self._target_func = target
+        self.exception: BaseException | None = None
+
+    def run(self) -> None:
+        try:
+            self._target_func()
+        except BaseException as exc:
+            self.exception = exc
+
+    def check(self) -> None:
+        if self.exception is not None:
+            raise RuntimeError(
+                f"The {self.name!r} stage of the insert pipeline failed"
+            ) from self.exception
+
+
+def _put(
+    q: queue.Queue, item: Any, stop: threading.Event, consumer: _Stage | None = None
+) -> None:
+    """Put an item on a bounded queue, giving up if the pipeline is stopped or
+    the consuming stage has died.
+
+    """
+    while not stop.is_set():
+        if consumer is not None and not consumer.is_alive():
+            consumer.check()
+            return
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _read_batches(handle: IO[bytes], batch_size: int) -> Iterable[list[bytes]]:
+    batch: list[bytes] = []
+    for line in handle:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _create_default_indexes() -> None:
+    from optimade.server.routers import ENTRY_COLLECTIONS
+
+    for collection in ENTRY_COLLECTIONS.values():
+        try:
+            collection.create_default_index()
+        except NotImplementedError:
+            pass
+
+
+def insert_from_jsonl_stream(
+    path: Path | str,
+    create_default_index: bool = False,
+    batch_size: int = INSERT_BATCH_SIZE,
+) -> int:
+    """Insert the entries from an OPTIMADE JSONL file or stream into the
+    configured entry collections, returning the number of entries inserted.
+
+    Parameters:
+        path: The (optionally gzip-compressed) JSONL file, or `-` for stdin.
+        create_default_index: Whether to create the default indexes first.
+        batch_size: The number of lines to read, parse and insert at a time.
+
+    """
+    import bson.json_util
+    from optimade.server.logger import LOGGER
+    from optimade.server.routers import ENTRY_COLLECTIONS
+
+    if create_default_index:
+        _create_default_indexes()
+
+    with open_jsonl(path) as handle:
+        header = json.loads(handle.readline())
+        if not header.get("x-optimade"):
+            raise ValueError(
+                f"No x-optimade header found in {path}; is this a JSONL file?"
+            )
+
+        lines_queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+        docs_queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+        stop = threading.Event()
+
+        def _reader() -> None:
+            try:
+                for batch in _read_batches(handle, batch_size):
+                    _put(lines_queue, batch, stop)
+            finally:
+                _put(lines_queue, _DONE, stop)
+
+        def _writer() -> None:
+            while not stop.is_set():
+                try:
+                    docs_by_type = docs_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if docs_by_type is _DONE:
+                    return
+                for _type, docs in docs_by_type.items():
+                    ENTRY_COLLECTIONS[_type].insert(docs)
+
+        reader = _Stage(_reader, name="read")
+        writer = _Stage(_writer, name="write")
+        reader.start()
+        writer.start()
+
+        good_rows = 0
+        bad_rows = 0
+        line_no = 1
+        try:
+            while (batch := lines_queue.get()) is not _DONE:
+                docs_by_type: dict[str, list[dict[str, Any]]] = {}
+                for line in batch:
+                    line_no += 1
+                    if not line.strip():
+                        continue
+                    try:
+                        converted = _to_database_format(bson.json_util.loads(line))
+                    except Exception as exc:
+                        LOGGER.warning("Could not read entry L%s: %s", line_no, exc)
+                        bad_rows += 1
+                        continue
+                    if converted is not None:
+                        _type, doc = converted
+                        docs_by_type.setdefault(_type, []).append(doc)
+                        good_rows += 1
+                if docs_by_type:
+                    _put(docs_queue, docs_by_type, stop, consumer=writer)
+            reader.check()
+            _put(docs_queue, _DONE, stop, consumer=writer)
+            writer.join()
+            writer.check()
+        except BaseException:
+            stop.set()
+            # Let the reader finish with the file before it is closed
+            reader.join(timeout=1)
+            raise
+
+    if bad_rows:
+        LOGGER.warning("Could not read %d rows from %s", bad_rows, path)
+    LOGGER.info("Inserted %d entries from %s", good_rows, path)
+
+    return good_rows
+
+
+def insert_from_manifest(
+    path: Path,
+    create_default_index: bool = False,
+    max_workers: int = 1,
+) -> int:
+    """Insert all the shards described by a shard manifest (as written by
+    `csd-ingest --num-shards`), loading up to `max_workers` shards concurrently,
+    and return the total number of entries inserted.
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from csd_optimade.shards import read_manifest
+
+    if create_default_index:
+        _create_default_indexes()
+
+    manifest = read_manifest(path)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return sum(
+            executor.map(
+                insert_from_jsonl_stream,
+                [shard["path"] for shard in manifest["shards"]],
+            )
+        )
@@ -0,0 +1,471 @@
+"""A load generator for measuring the throughput and latency of `csd-serve`.
+
+A mix of OPTIMADE queries (filters on elements, formulae, space groups and
+`_csd_*` ranges, single-id lookups and deep keyset pagination) is generated
+from a sample of the served entries, and replayed by a number of concurrent
+clients for a fixed duration. Latency percentiles and request rates are
+reported per query class, optionally as JSON for comparing runs.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import math
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+from typing import Any
+
+API_PREFIX = "/v1"
+
+SAMPLE_FIELDS = (
+    "id",
+    "elements",
+    "chemical_formula_reduced",
+    "_csd_space_group_symbol_hermann_mauginn",
+    "_csd_ccdc_number",
+)
+
+DEFAULT_MIX = {
+    "elements": 4,
+    "formula": 2,
+    "space_group": 2,
+    "csd_range": 1,
+    "id_lookup": 4,
+    "deep_pagination": 1,
+}
+"""The default relative weights of each query class."""
+
+
+def _quote(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _filter_query(filter_: str, page_limit: int = 10, **params) -> str:
+    return "/structures?" + urllib.parse.urlencode(
+        {"filter": filter_, "page_limit": page_limit, **params}
+    )
+
+
+def generate_queries(
+    sample: list[dict[str, Any]], rng: random.Random, num_queries: int = 200
+) -> dict[str, list[str]]:
+    """Generate the candidate queries (paths relative to the versioned base
+    URL) for each query class from a sample of structure entries.
+
+    Query classes for which the sampled entries do not have the required
+    fields are left empty.
+
+    """
+    queries: dict[str, list[str]] = {name: [] for name in DEFAULT_MIX}
+    if not sample:
+        return queries
+
+    ccdc_numbers = sorted(
+        entry["attributes"]["_csd_ccdc_number"]
+        for entry in sample
+        if entry["attributes"].get("_csd_ccdc_number") is not None
+    )
+
+    for _ in range(num_queries):
+        entry = rng.choice(sample)
+        attributes = entry["attributes"]
+
+        if elements := attributes.get("elements"):
+            chosen = rng.sample(elements, rng.randint(1, min(len(elements), 3)))
+            queries["elements"].append(
+                _filter_query(
+                    "elements HAS ALL " + ",".join(_quote(e) for e in sorted(chosen))
+                )
+            )
+
+        if formula := attributes.get("chemical_formula_reduced"):
+            queries["formula"].append(
+                _filter_query(f"chemical_formula_reduced={_quote(formula)}")
+            )
+
+        if symbol := attributes.get("_csd_space_group_symbol_hermann_mauginn"):
+            queries["space_group"].append(
+                _filter_query(
+                    f"_csd_space_group_symbol_hermann_mauginn={_quote(symbol)}"
+                )
+            )
+
+        if len(ccdc_numbers) > 1:
+            low, high = sorted(rng.sample(ccdc_numbers, 2))
+            queries["csd_range"].append(
+                _filter_query(f"_csd_ccdc_number>={low} AND _csd_ccdc_number<{high}")
+            )
+
+        queries["id_lookup"].append(f"/structures/{urllib.parse.quote(entry['id'])}")
+        queries["deep_pagination"].append(
+            "/structures?"
+            + urllib.parse.urlencode({"page_above": entry["id"], "page_limit": 10})
+        )
+
+    return queries
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """Return the `q`th percentile (nearest-rank) of the given sorted values."""
+    if not sorted_values:
+        return float("nan")
+    rank = math.ceil(q / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def summarise(latencies: list[float], errors: int, duration: float) -> dict[str, Any]:
+    """Summarise the latencies (in seconds) of the successful requests in a query class."""
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "requests_per_second": round((len(latencies) + errors) / duration, 3),
+        "latency_ms": {
+            "mean": round(1e3 * sum(latencies) / len(latencies), 3)
+            if latencies
+            else None,
+            **{
+                f"p{q}": round(1e3 * percentile(latencies, q), 3) if latencies else None
+                for q in (50, 95, 99)
+            },
+            "max": round(1e3 * latencies[-1], 3) if latencies else None,
+        },
+    }
+
+
+class _Client:
+    """A persistent HTTP connection to the API, as used by a single worker thread."""
+
+    def __init__(self, base_url: str, timeout: float = 60):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port
+        self.prefix = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self.connection: http.client.HTTPConnection | None = None
+
+    def get(self, path: str) -> tuple[int, bytes]:
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout
+            )
+        try:
+            self.connection.request("GET", self.prefix + path)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def sample_entries(
+    base_url: str, sample_size: int, rng: random.Random
+) -> list[dict[str, Any]]:
+    """Fetch a sample of structure entries from a few random offsets into the
+    collection, to generate realistic queries from.
+
+    """
+    client = _Client(base_url)
+    fields = ",".join(SAMPLE_FIELDS)
+    _, body = client.get(f"{API_PREFIX}/structures?page_limit=1&response_fields=id")
+    data_available = json.loads(body)["meta"].get("data_available") or 0
+
+    page_limit = min(sample_size, 100)
+    sample: list[dict[str, Any]] = []
+    seen: set[str] = set()
+    for _ in range(max(1, sample_size // page_limit) * 2):
+        offset = rng.randint(0, max(0, data_available - page_limit))
+        status, body = client.get(
+            f"{API_PREFIX}/structures?page_limit={page_limit}&page_offset={offset}&response_fields={fields}"
+        )
+        if status != 200:
+            raise RuntimeError(f"Could not sample entries from the API: {body!r}")
+        for entry in json.loads(body).get("data", []):
+            if entry["id"] not in seen:
+                seen.add(entry["id"])
+                sample.append(entry)
+        if len(sample) >= sample_size:
+            break
+    client.close()
+    return sample[:sample_size]
+
+
+def run_load(
+    base_url: str,
+    queries: dict[str, list[str]],
+    mix: dict[str, float],
+    concurrency: int = 8,
+    duration: float = 30.0,
+    seed: int = 0,
+) -> dict[str, Any]:
+    """Replay the query mix against the API from `concurrency` threads for
+    `duration` seconds, and return the summary statistics per query class.
+
+    """
+    classes = [name for name in mix if mix[name] > 0 and queries.get(name)]
+    if not classes:
+        raise RuntimeError("No queries could be generated for the requested mix.")
+    weights = [mix[name] for name in classes]
+
+    lock = threading.Lock()
+    latencies: dict[str, list[float]] = {name: [] for name in classes}
+    errors: dict[str, int] = {name: 0 for name in classes}
+    deadline = time.perf_counter() + duration
+
+    def _worker(worker_id: int) -> None:
+        rng = random.Random(seed + worker_id)
+        client = _Client(base_url)
+        while time.perf_counter() < deadline:
+            name = rng.choices(classes, weights)[0]
+            path = API_PREFIX + rng.choice(queries[name])
+            start = time.perf_counter()
+            try:
+                status, _ = client.get(path)
+                ok = status == 200
+            except (OSError, http.client.HTTPException):
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies[name].append(elapsed)
+                else:
+                    errors[name] += 1
+        client.close()
+
+    start = time.perf_counter()
+    threads = [
+        threading.Thread(target=_worker, args=(i,), daemon=True)
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "duration_s": round(elapsed, 3),
+        "classes": {
+            name: summarise(latencies[name], errors[name], elapsed) for name in classes
+        },
+        "overall": summarise(
+            [latency for name in classes for latency in latencies[name]],
+            sum(errors.values()),
+            elapsed,
+        ),
+    }
+
+
+def launch_server(
+    jsonl_path: Path,
+    port: int,
+    workers: int = 1,
+    mongo_uri: str | None = None,
+    drop_first: bool = False,
+    startup_timeout: float = 600,
+) -> subprocess.Popen:
+    """Start `csd-serve` on the given JSONL file in a subprocess, returning
+    once the API is responding.
+
+    With `mongo_uri`, the database is only dropped before inserting the data
+    if `drop_first` is set.
+
+    """
+    args = [str(jsonl_path), "--port", str(port), "--workers", str(workers)]
+    if mongo_uri:
+        args += ["--mongo-uri", mongo_uri]
+        if drop_first:
+            args.append("--drop-first")
+    process = subprocess.Popen(
+        [sys.executable, "-c", "from csd_optimade.serve import cli; cli()", *args]
+    )
+
+    client = _Client(f"http://127.0.0.1:{port}", timeout=5)
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"csd-serve exited with {process.returncode}")
+        try:
+            client.get(f"{API_PREFIX}/info")
+            client.close()
+            return process
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"csd-serve did not start within {startup_timeout} s")
+
+
+def _parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(
+                f"Unknown query class {name!r}; must be one of {', '.join(DEFAULT_MIX)}"
+            )
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def _print_report(report: dict[str, Any]) -> None:
+    header = f"{'query class':<18}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, stats in [*report["classes"].items(), ("overall", report["overall"])]:
+        latency = stats["latency_ms"]
+        print(
+            f"{name:<18}{stats['requests']:>10}{stats['errors']:>8}{stats['requests_per_second']:>10.1f}"
+            + "".join(
+                f"{latency[q]:>10.1f}" if latency[q] is not None else f"{'-':>10}"
+                for q in ("p50", "p95", "p99")
+            )
+        )
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput and latency of `csd-serve` under a realistic query mix."
+    )
+    parser.add_argument(
+        "jsonl_path",
+        type=Path,
+        nargs="?",
+        help="An OPTIMADE JSONL file to launch `csd-serve` on (not required with `--url` or `--synthetic`).",
+    )
+    parser.add_argument(
+        "--url",
+        type=str,
+        help="The base URL of an already running API to test, instead of launching `csd-serve`.",
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        metavar="NUM_ENTRIES",
+        help="Launch `csd-serve` on a synthetic JSONL file with this many structures.",
+    )
+    parser.add_argument(
+        "--mongo-uri",
+        type=str,
+        help="A MongoDB URI for the launched `csd-serve` to use, instead of the in-memory database; its existing contents are kept unless `--drop-first` is given.",
+    )
+    parser.add_argument(
+        "--drop-first",
+        action="store_true",
+        help="Drop the database at `--mongo-uri` before inserting the data (DEFAULT: false).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes for the launched `csd-serve` (DEFAULT: 1).",
+    )
+    parser.add_argument(
+        "--port", type=int, default=5001, help="Port for the launched `csd-serve`."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Number of concurrent clients (DEFAULT: 8).",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=30.0,
+        help="How long to apply load for, in seconds (DEFAULT: 30).",
+    )
+    parser.add_argument(
+        "--mix",
+        type=_parse_mix,
+        default=DEFAULT_MIX,
+        help=f"Relative weights of the query classes, e.g., 'elements=4,id_lookup=1' (DEFAULT: {','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items())}).",
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=500,
+        help="Number of entries to sample for generating queries (DEFAULT: 500).",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="Write the results as JSON to this file, for comparing runs.",
+    )
+    args = parser.parse_args()
+
+    if sum(bool(option) for option in (args.jsonl_path, args.url, args.synthetic)) != 1:
+        parser.error(
+            "Exactly one of `jsonl_path`, `--url` or `--synthetic` is required"
+        )
+
+    process = None
+    base_url = args.url
+    if not base_url:
+        jsonl_path = args.jsonl_path
+        if args.synthetic:
+            from csd_optimade.synthetic import write_synthetic_jsonl
+
+            jsonl_path = Path(tempfile.mkdtemp()) / "synthetic-optimade.jsonl"
+            write_synthetic_jsonl(jsonl_path, num_entries=args.synthetic)
+        process = launch_server(
+            jsonl_path,
+            args.port,
+            workers=args.workers,
+            mongo_uri=args.mongo_uri,
+            drop_first=args.drop_first,
+        )
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    started = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    try:
+        rng = random.Random(args.seed)
+        sample = sample_entries(base_url, args.sample_size, rng)
+        queries = generate_queries(sample, rng)
+        report = run_load(
+            base_url,
+            queries,
+            args.mix,
+            concurrency=args.concurrency,
+            duration=args.duration,
+            seed=args.seed,
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report["config"] = {
+        "url": args.url,
+        "jsonl_path": str(args.jsonl_path) if args.jsonl_path else None,
+        "synthetic": args.synthetic,
+        "database_backend": ("mongodb" if args.mongo_uri else "mongomock")
+        if process
+        else None,
+        "workers": args.workers if process else None,
+        "concurrency": args.concurrency,
+        "duration_s": args.duration,
+        "mix": args.mix,
+        "sample_size": len(sample),
+        "seed": args.seed,
+        "started": started,
+    }
+
+    _print_report(report)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
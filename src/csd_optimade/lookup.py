@@ -0,0 +1,253 @@
+"""An exact-lookup index from common identifiers to structure IDs.
+
+Users often arrive with an InChIKey, CCDC deposition number or formula, but
+`_csd_inchi_key` is a list field and none of these fields are guaranteed to
+be indexed in the database. After combining the ingested chunks, `csd-ingest`
+therefore also writes a lookup index, mapping each
+
+- InChIKey (`_csd_inchi_key`),
+- InChIKey first block (the 14-character connectivity hash),
+- CCDC deposition number (`_csd_ccdc_number`), and
+- reduced formula (`chemical_formula_reduced`),
+
+to the IDs of the matching structures. The index is an SQLite database, which
+the server opens read-only and memory-maps, so that it is shared between
+workers via the page cache rather than loaded into each of them. Equality
+filters on these fields (also nested within `AND`/`OR`) are then rewritten to
+a filter on `id` before querying the database, which uses its unique index.
+
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+INCHI_KEY = "_csd_inchi_key"
+INCHI_KEY_FIRST_BLOCK = "_csd_inchi_key_first_block"
+CCDC_NUMBER = "_csd_ccdc_number"
+REDUCED_FORMULA = "chemical_formula_reduced"
+LOOKUP_FIELDS = (INCHI_KEY, INCHI_KEY_FIRST_BLOCK, CCDC_NUMBER, REDUCED_FORMULA)
+
+INSERT_BATCH_SIZE = 10_000
+MAX_LOOKUP_IDS = 10_000
+"""Lookups matching more structures than this are left to the database."""
+MMAP_SIZE = 1024**3
+"""The maximum number of bytes of the index to memory-map."""
+
+_FIRST_BLOCK_REGEX = re.compile(r"^\^([A-Z]{14})(?:\\?-)?$")
+
+LOOKUP_INDEX: LookupIndex | None = None
+"""The lookup index used by the server, if any."""
+
+LOG = logging.getLogger(__name__)
+
+
+def lookup_path(output_dir: Path, run_name: str) -> Path:
+    return output_dir / f"{run_name}-optimade-lookup.sqlite"
+
+
+def find_lookup_index(artefact: Path) -> Path | None:
+    """Return the path of the lookup index written alongside a JSONL file or
+    shard manifest by `csd-ingest`, if it exists.
+
+    """
+    name = re.sub(r"(-manifest\.json|\.jsonl(\.gz)?)$", "", artefact.name)
+    path = artefact.parent / f"{name}-lookup.sqlite"
+    return path if path.exists() else None
+
+
+def lookup_keys(entry: dict[str, Any]) -> Iterator[tuple[str, str]]:
+    """Yield the `(field, key)` pairs to index for a structure in the JSONL
+    format.
+
+    """
+    attributes = entry.get("attributes") or {}
+    for inchi_key in attributes.get(INCHI_KEY) or []:
+        if inchi_key:
+            yield INCHI_KEY, inchi_key
+            yield INCHI_KEY_FIRST_BLOCK, inchi_key[:14]
+    if (ccdc_number := attributes.get(CCDC_NUMBER)) is not None:
+        yield CCDC_NUMBER, str(ccdc_number)
+    if formula := attributes.get(REDUCED_FORMULA):
+        yield REDUCED_FORMULA, formula
+
+
+def build_lookup_index(jsonl_paths: Iterable[Path], output: Path) -> Path:
+    """Build the lookup index for the structures in the given (optionally
+    gzip-compressed) JSONL files, returning its path.
+
+    """
+    from csd_optimade.insert import open_jsonl
+
+    tmp_output = output.with_name(output.name + ".tmp")
+    tmp_output.unlink(missing_ok=True)
+    connection = sqlite3.connect(tmp_output)
+    try:
+        connection.executescript(
+            """
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE lookup (
+                field TEXT NOT NULL,
+                key TEXT NOT NULL,
+                id TEXT NOT NULL,
+                PRIMARY KEY (field, key, id)
+            ) WITHOUT ROWID;
+            CREATE TABLE metadata (name TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        num_structures = 0
+        rows: list[tuple[str, str, str]] = []
+        for path in jsonl_paths:
+            with open_jsonl(path) as handle:
+                for line in handle:
+                    if b'"structures"' not in line:
+                        continue
+                    entry = json.loads(line)
+                    if entry.get("type") != "structures":
+                        continue
+                    num_structures += 1
+                    rows.extend(
+                        (field, key, entry["id"]) for field, key in lookup_keys(entry)
+                    )
+                    if len(rows) >= INSERT_BATCH_SIZE:
+                        connection.executemany(
+                            "INSERT OR IGNORE INTO lookup VALUES (?, ?, ?)", rows
+                        )
+                        rows = []
+        connection.executemany("INSERT OR IGNORE INTO lookup VALUES (?, ?, ?)", rows)
+        connection.execute(
+            "INSERT INTO metadata VALUES ('num_structures', ?)", (num_structures,)
+        )
+        connection.commit()
+    finally:
+        connection.close()
+    tmp_output.replace(output)
+    return output
+
+
+class LookupIndex:
+    """Read-only access to a lookup index, with a connection per thread."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._local = threading.local()
+        # Fail early if the index is missing or invalid, without keeping the
+        # connection (which must not be shared with forked workers)
+        connection = self._connect()
+        try:
+            self.num_structures = int(
+                connection.execute(
+                    "SELECT value FROM metadata WHERE name = 'num_structures'"
+                ).fetchone()[0]
+            )
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            f"{self.path.absolute().as_uri()}?mode=ro", uri=True
+        )
+        connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        return connection
+
+    def _connection(self) -> sqlite3.Connection:
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.connection = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, field: str, keys: Iterable[str]) -> list[str]:
+        """Return the sorted IDs of the structures matching any of the keys."""
+        keys = list(keys)
+        if not keys:
+            return []
+        placeholders = ",".join("?" * len(keys))
+        rows = self._connection().execute(
+            f"SELECT DISTINCT id FROM lookup WHERE field = ? AND key IN ({placeholders}) ORDER BY id",
+            (field, *keys),
+        )
+        return [row[0] for row in rows]
+
+
+def configure_lookup_index(
+    path: Path | None, num_structures: int | None = None
+) -> None:
+    """Set (or unset) the lookup index used by the server, unless it was built
+    from a different number of structures than are in the database
+    (`num_structures`, if given), when it would return stale IDs.
+
+    """
+    global LOOKUP_INDEX
+    index = LookupIndex(path) if path else None
+    if (
+        index is not None
+        and num_structures is not None
+        and index.num_structures != num_structures
+    ):
+        LOG.warning(
+            "Ignoring the lookup index %s, as its %d structures do not match the %d in the database",
+            path,
+            index.num_structures,
+            num_structures,
+        )
+        index = None
+    LOOKUP_INDEX = index
+
+
+def _lookup(field: str, condition: Any) -> tuple[str, list[str]] | None:
+    """Return the lookup table and keys for an equality condition on a field,
+    or `None` if it cannot be looked up.
+
+    """
+    if not isinstance(condition, dict) or len(condition) != 1:
+        return None
+    (operator, value), *_ = condition.items()
+    if field == INCHI_KEY:
+        if operator == "$in" and all(isinstance(v, str) for v in value):
+            return INCHI_KEY, value
+        if operator == "$regex" and (match := _FIRST_BLOCK_REGEX.match(value)):
+            return INCHI_KEY_FIRST_BLOCK, [match.group(1)]
+    elif field == CCDC_NUMBER and operator == "$eq":
+        if isinstance(value, (int, float)) and float(value).is_integer():
+            return CCDC_NUMBER, [str(int(value))]
+    elif field == REDUCED_FORMULA and operator == "$eq" and isinstance(value, str):
+        return REDUCED_FORMULA, [value]
+    return None
+
+
+def rewrite_filter(
+    mongo_filter: dict[str, Any], index: LookupIndex, id_field: str = "id"
+) -> dict[str, Any]:
+    """Replace any equality conditions on the lookup fields in a MongoDB
+    filter (including within `$and`/`$or`) with conditions on `id`.
+
+    """
+    rewritten: dict[str, Any] = {}
+    for field, condition in mongo_filter.items():
+        if field in ("$and", "$or") and isinstance(condition, list):
+            rewritten.setdefault(field, []).extend(
+                rewrite_filter(clause, index, id_field) for clause in condition
+            )
+            continue
+        if (lookup := _lookup(field, condition)) is not None:
+            ids = index.get(*lookup)
+            # Very common keys are left to the database, rather than sending
+            # it a huge list of IDs
+            if len(ids) <= MAX_LOOKUP_IDS:
+                rewritten.setdefault("$and", []).append({id_field: {"$in": ids}})
+                continue
+        rewritten[field] = condition
+    if list(rewritten) == ["$and"] and len(rewritten["$and"]) == 1:
+        return rewritten["$and"][0]
+    return rewritten
@@ -1,27 +1,19 @@
 from __future__ import annotations
 
 import datetime
+import hashlib
 import math
-import random
-import string
 import warnings
 from typing import TYPE_CHECKING
 
-from optimade.models.utils import anonymize_formula
-
+# The OPTIMADE models (and numpy, via `csd_optimade.symmetry`) are only
+# imported when an entry is first mapped, so that importing this module is cheap
 if TYPE_CHECKING:
     import ccdc.crystal
     import ccdc.entry
     import ccdc.io
     import ccdc.molecule
-
-from optimade.models import (
-    ReferenceResource,
-    ReferenceResourceAttributes,
-    Species,
-    StructureResource,
-    StructureResourceAttributes,
-)
+    from optimade.models import ReferenceResource, StructureResource
 
 NOW = datetime.datetime.now()
 NOW = NOW.replace(microsecond=0)
@@ -30,20 +22,39 @@ CSD_OPTIMADE_SIDENTIFIER = "csd-optimade-psdi"
 """Identifier to use when reporting `sid` to CCDC services."""
 
 
+def _get_reference_id(citation) -> str:
+    """Return a deterministic OPTIMADE identifier for a citation: the DOI, if
+    available, otherwise the first author and year followed by a hash of the
+    authors, year, journal, volume and first page, so that every entry citing
+    the same paper links to the same reference.
+
+    """
+    if citation.doi:
+        return citation.doi
+    first_author = citation.authors.split(", ")[0].split(".")[-1].split(" ")[-1]
+    key = "|".join(
+        str(field).strip().lower()
+        for field in (
+            citation.authors,
+            citation.year,
+            citation.journal.full_name,
+            citation.volume,
+            citation.first_page,
+        )
+    )
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=5).hexdigest()
+    return f"{first_author}{citation.year}-{digest}"
+
+
 def _get_citations(entry) -> list[ReferenceResource]:
     """Return attached reference resources given the CSD API citation format."""
+    from optimade.models import ReferenceResource, ReferenceResourceAttributes
+
     citations = []
     for citation in entry.publications:
-        # Use the DOI as OPTIMADE identifier, if available, otherwise generate one
-        # from first author, year and random string (cannot detect duplicates)
-        _id = citation.doi
-        if _id is None:
-            first_author = citation.authors.split(", ")[0].split(".")[-1].split(" ")[-1]
-            _id = f"{first_author}{citation.year}-{''.join(random.choices(string.ascii_lowercase, k=6))}"
-
         citations.append(
             ReferenceResource(
-                id=_id,
+                id=_get_reference_id(citation),
                 type="references",
                 attributes=ReferenceResourceAttributes(
                     last_modified=NOW,
@@ -114,13 +125,46 @@ def _reduce_csd_formula(formula: str) -> tuple[str, set[str]]:
     return formula_str, elements
 
 
+def _get_asymmetric_unit(entry: ccdc.entry.Entry) -> dict | None:
+    """Return the compact representation of the entry's crystal (the
+    fractional coordinates of its asymmetric unit and the symmetry operators),
+    or `None` if any atom has no coordinates.
+
+    """
+    from csd_optimade.symmetry import compact_structure
+
+    atoms = entry.crystal.asymmetric_unit_molecule.atoms
+    if not atoms or any(atom.fractional_coordinates is None for atom in atoms):
+        return None
+    return compact_structure(
+        [list(atom.fractional_coordinates) for atom in atoms],
+        [atom.atomic_symbol for atom in atoms],
+        entry.crystal.symmetry_operators,
+    )
+
+
 def from_csd_entry_directly(
     entry: ccdc.entry.Entry,
+    compact: bool = False,
 ) -> tuple[StructureResource, list[ReferenceResource]]:
     """Convert a single `ccdc.entry.Entry` into an OPTIMADE structure,
     returning any attached citations as OPTIMADE references.
 
+    With `compact`, the unit cell is not packed; instead, the asymmetric unit
+    and symmetry operators are stored in the `_csd_asymmetric_unit` field, from
+    which the server materialises the sites on request.
+
     """
+    from optimade.models import (
+        Species,
+        StructureResource,
+        StructureResourceAttributes,
+    )
+    from optimade.models.utils import anonymize_formula
+    from optimade.warnings import MissingExpectedField
+
+    from csd_optimade.symmetry import site_multiplicities
+
     asym_unit = entry.crystal.asymmetric_unit_molecule
 
     dep_date: datetime.datetime | datetime.date | None = entry.deposition_date
@@ -132,19 +176,10 @@ def from_csd_entry_directly(
     lattice_params: list[list[float | None]] = [[None, None, None], [None, None, None]]
     cell_volume: float | None = None
     packed_mol: ccdc.molecule.Molecule | None = None
+    asymmetric_unit: dict | None = None
+    compact_species_at_sites: list[str] | None = None
     if entry.has_3d_structure:
-        packed_mol = entry.crystal.packing()
-        try:
-            positions = [
-                [atom.coordinates.x, atom.coordinates.y, atom.coordinates.z]
-                for atom in packed_mol.atoms
-            ]
-            # Handle case that atoms is []
-            if not positions:
-                positions = None
-        except AttributeError:
-            positions = None
-
+        # Needed by both layouts, as compact entries are expanded with them
         lattice_params = [
             [
                 entry.crystal.cell_lengths.a,
@@ -159,6 +194,34 @@ def from_csd_entry_directly(
         ]
         cell_volume = entry.crystal.cell_volume
 
+    if entry.has_3d_structure and compact:
+        asymmetric_unit = _get_asymmetric_unit(entry)
+        if asymmetric_unit:
+            # Only the species of the expanded sites are needed (for `nsites`)
+            compact_species_at_sites = [
+                label
+                for label, multiplicity in zip(
+                    asymmetric_unit["species_at_sites"],
+                    site_multiplicities(
+                        asymmetric_unit["fractional_site_positions"],
+                        asymmetric_unit["symmetry_operations_xyz"],
+                    ),
+                )
+                for _ in range(multiplicity)
+            ]
+    elif entry.has_3d_structure:
+        packed_mol = entry.crystal.packing()
+        try:
+            positions = [
+                [atom.coordinates.x, atom.coordinates.y, atom.coordinates.z]
+                for atom in packed_mol.atoms
+            ]
+            # Handle case that atoms is []
+            if not positions:
+                positions = None
+        except AttributeError:
+            positions = None
+
     references: list[ReferenceResource] = _get_citations(entry)
     relationships: dict[str, dict] | None = None
     if references:
@@ -218,61 +281,67 @@ def from_csd_entry_directly(
     if entry.has_disorder:
         structure_features += ["disorder"]
 
-    if optimade_species_at_sites:
+    sites = optimade_species_at_sites or compact_species_at_sites
+    if sites:
         for s in optimade_species:
-            if s.name not in optimade_species_at_sites:
+            if s.name not in sites:
                 structure_features += ["implicit_atoms"]
                 break
 
-    resource = StructureResource(
-        **{
-            "id": entry.identifier,
-            "type": "structures",
-            "relationships": relationships,
-            "links": {
-                "self": f"https://www.ccdc.cam.ac.uk/services/structures?pid=csd:{entry.identifier}&sid={CSD_OPTIMADE_SIDENTIFIER}"
-            },
-            "attributes": StructureResourceAttributes(
-                immutable_id=entry.identifier,
-                last_modified=NOW,
-                chemical_formula_anonymous=anonymize_formula(reduced_formula)
-                if reduced_formula
-                else None,
-                chemical_formula_descriptive=entry.formula,
-                chemical_formula_reduced=reduced_formula,
-                elements=sorted(list(optimade_elements)),
-                dimension_types=(1, 1, 1),
-                nperiodic_dimensions=3,
-                nelements=len(optimade_elements),
-                nsites=len(positions) if positions else None,
-                # Make sure the "D" is remapped to "H" in the species list, but continue using it in the sites list
-                species=optimade_species if positions else None,
-                species_at_sites=optimade_species_at_sites,
-                cartesian_site_positions=positions,
-                structure_features=structure_features,
-                space_group_int_number=space_group_int_number,
-                space_group_symbol_hermann_maugin=space_group_symbol,
-                # Add custom CSD-specific fields
-                _csd_lattice_parameter_a=lattice_params[0][0],
-                _csd_lattice_parameter_b=lattice_params[0][1],
-                _csd_lattice_parameter_c=lattice_params[0][2],
-                _csd_lattice_parameter_alpha=lattice_params[1][0],
-                _csd_lattice_parameter_beta=lattice_params[1][1],
-                _csd_lattice_parameter_gamma=lattice_params[1][2],
-                _csd_cell_volume=cell_volume,
-                _csd_crystal_system=entry.crystal.crystal_system,
-                _csd_space_group_symbol_hermann_mauginn=entry.crystal.spacegroup_symbol,  # Need to double-check if this matches OPTIMADE 1.2 definition
-                _csd_chemical_name=entry.chemical_name,
-                _csd_inchi=[inchi.inchi for inchi in inchis] if inchis else None,
-                _csd_inchi_key=[inchi.key for inchi in inchis] if inchis else None,
-                _csd_smiles=entry.crystal.molecule.smiles,
-                _csd_z_value=entry.crystal.z_value,
-                _csd_z_prime=entry.crystal.z_prime,
-                _csd_ccdc_number=entry.ccdc_number,
-                _csd_deposition_date={"$date": dep_date},
-                _csd_disorder_details=entry.disorder_details,
-                _csd_remarks=entry.remarks if entry.remarks else None,
-            ),
-        }
-    )
+    with warnings.catch_warnings():
+        if asymmetric_unit:
+            # The sites of compact entries are only materialised on request
+            warnings.simplefilter("ignore", MissingExpectedField)
+        resource = StructureResource(
+            **{
+                "id": entry.identifier,
+                "type": "structures",
+                "relationships": relationships,
+                "links": {
+                    "self": f"https://www.ccdc.cam.ac.uk/services/structures?pid=csd:{entry.identifier}&sid={CSD_OPTIMADE_SIDENTIFIER}"
+                },
+                "attributes": StructureResourceAttributes(
+                    immutable_id=entry.identifier,
+                    last_modified=NOW,
+                    chemical_formula_anonymous=anonymize_formula(reduced_formula)
+                    if reduced_formula
+                    else None,
+                    chemical_formula_descriptive=entry.formula,
+                    chemical_formula_reduced=reduced_formula,
+                    elements=sorted(list(optimade_elements)),
+                    dimension_types=(1, 1, 1),
+                    nperiodic_dimensions=3,
+                    nelements=len(optimade_elements),
+                    nsites=len(sites) if sites else None,
+                    # Make sure the "D" is remapped to "H" in the species list, but continue using it in the sites list
+                    species=optimade_species if sites else None,
+                    species_at_sites=optimade_species_at_sites,
+                    cartesian_site_positions=positions,
+                    structure_features=structure_features,
+                    space_group_int_number=space_group_int_number,
+                    space_group_symbol_hermann_maugin=space_group_symbol,
+                    # Add custom CSD-specific fields
+                    _csd_lattice_parameter_a=lattice_params[0][0],
+                    _csd_lattice_parameter_b=lattice_params[0][1],
+                    _csd_lattice_parameter_c=lattice_params[0][2],
+                    _csd_lattice_parameter_alpha=lattice_params[1][0],
+                    _csd_lattice_parameter_beta=lattice_params[1][1],
+                    _csd_lattice_parameter_gamma=lattice_params[1][2],
+                    _csd_cell_volume=cell_volume,
+                    _csd_crystal_system=entry.crystal.crystal_system,
+                    _csd_space_group_symbol_hermann_mauginn=entry.crystal.spacegroup_symbol,  # Need to double-check if this matches OPTIMADE 1.2 definition
+                    _csd_chemical_name=entry.chemical_name,
+                    _csd_inchi=[inchi.inchi for inchi in inchis] if inchis else None,
+                    _csd_inchi_key=[inchi.key for inchi in inchis] if inchis else None,
+                    _csd_smiles=entry.crystal.molecule.smiles,
+                    _csd_z_value=entry.crystal.z_value,
+                    _csd_z_prime=entry.crystal.z_prime,
+                    _csd_ccdc_number=entry.ccdc_number,
+                    _csd_deposition_date={"$date": dep_date},
+                    _csd_disorder_details=entry.disorder_details,
+                    _csd_remarks=entry.remarks if entry.remarks else None,
+                    _csd_asymmetric_unit=asymmetric_unit,
+                ),
+            }
+        )
     return resource, references
@@ -0,0 +1,314 @@
+"""Combining ingested chunks into the final JSONL artefact, including from
+multiple cooperating ingest nodes.
+
+With `csd-ingest --shard i/N`, each of N nodes ingests a disjoint slice of
+the CSD index space and writes its chunk files into its own directory,
+alongside a node manifest describing them. `csd-ingest merge` then reads the
+node manifests, checks that all nodes are present and their chunks intact,
+and combines the chunks (in index order, deduplicated) into either a single
+JSONL file or a set of hash-sharded files.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from csd_optimade.dedup import DEFAULT_MEMORY_LIMIT, DedupIndex
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from csd_optimade.stats import DatasetStats
+
+NODE_MANIFEST_NAME = "node-manifest.json"
+NODE_MANIFEST_VERSION = 1
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Parse a `--shard i/N` argument into `(i, N)`, with `0 <= i < N`."""
+    try:
+        index, num_nodes = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must be given as 'i/N', not {value!r}")
+    if num_nodes < 1 or not 0 <= index < num_nodes:
+        raise argparse.ArgumentTypeError(
+            f"Shard index must satisfy 0 <= i < N, not {value!r}"
+        )
+    return index, num_nodes
+
+
+def node_index_range(
+    index: int, num_nodes: int, num_structures: int
+) -> tuple[int, int | None]:
+    """Return the `[start, end)` slice of the CSD index space for a node.
+
+    The last node has no upper bound, so that it ingests any entries beyond
+    the (approximate) number of structures, as a single node would.
+
+    """
+    start = num_structures * index // num_nodes
+    if index == num_nodes - 1:
+        return start, None
+    return start, num_structures * (index + 1) // num_nodes
+
+
+def node_dir(output_dir: Path, run_name: str, index: int, num_nodes: int) -> Path:
+    return output_dir / f"{run_name}-node-{index}-of-{num_nodes}"
+
+
+def file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while data := f.read(1024**2):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def write_node_manifest(
+    directory: Path,
+    run_name: str,
+    index: int,
+    num_nodes: int,
+    index_range: tuple[int, int | None],
+    chunks: list[dict[str, Any]],
+) -> Path:
+    """Write the manifest describing the chunks ingested by a node.
+
+    Parameters:
+        directory: The node's output directory, containing the chunks.
+        run_name: The run name shared by all nodes.
+        index: The index of this node.
+        num_nodes: The total number of nodes.
+        index_range: The slice of the CSD index space ingested by this node.
+        chunks: A record for each chunk, with its `path`, `index_range`,
+            and number of `entries` and `bad_entries`.
+
+    """
+    records = []
+    for chunk in sorted(chunks, key=lambda chunk: chunk["index_range"][0]):
+        path = Path(chunk["path"])
+        records.append(
+            {
+                **chunk,
+                "path": path.name,
+                "size": path.stat().st_size,
+                "sha256": file_sha256(path),
+            }
+        )
+    manifest = {
+        "manifest_version": NODE_MANIFEST_VERSION,
+        "run_name": run_name,
+        "node": index,
+        "num_nodes": num_nodes,
+        "index_range": list(index_range),
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "chunks": records,
+    }
+    manifest_path = directory / NODE_MANIFEST_NAME
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+    return manifest_path
+
+
+def _read_node_manifest(path: Path) -> dict[str, Any]:
+    if path.is_dir():
+        path = path / NODE_MANIFEST_NAME
+    manifest = json.loads(path.read_text())
+    manifest["directory"] = path.parent
+    return manifest
+
+
+def read_node_manifests(paths: Iterable[Path], verify: bool = True) -> list[Path]:
+    """Read the manifests of all the nodes of a distributed ingest (given as
+    manifest files or node directories), check that they are complete and
+    consistent, and return the chunk paths in index order.
+
+    """
+    manifests = [_read_node_manifest(path) for path in paths]
+
+    if not manifests:
+        raise ValueError("No node manifests provided")
+
+    num_nodes = {manifest["num_nodes"] for manifest in manifests}
+    run_names = {manifest["run_name"] for manifest in manifests}
+    if len(num_nodes) != 1 or len(run_names) != 1:
+        raise ValueError(
+            f"Node manifests are from different runs: {run_names=}, {num_nodes=}"
+        )
+    nodes = sorted(manifest["node"] for manifest in manifests)
+    expected = list(range(num_nodes.pop()))
+    if nodes != expected:
+        missing = sorted(set(expected) - set(nodes))
+        duplicated = sorted({node for node in nodes if nodes.count(node) > 1})
+        raise ValueError(
+            f"Incomplete set of node manifests: missing nodes {missing}, duplicated nodes {duplicated}"
+        )
+
+    chunk_paths = []
+    for manifest in sorted(manifests, key=lambda manifest: manifest["node"]):
+        for chunk in manifest["chunks"]:
+            chunk_path = manifest["directory"] / chunk["path"]
+            if verify and file_sha256(chunk_path) != chunk["sha256"]:
+                raise ValueError(
+                    f"Checksum mismatch for chunk {chunk_path} from node {manifest['node']}"
+                )
+            chunk_paths.append(chunk_path)
+    return chunk_paths
+
+
+def read_node_stats(paths: Iterable[Path]) -> DatasetStats | None:
+    """Merge the facet counts of all chunks in the given node manifests, or
+    return `None` if any chunk has none.
+
+    """
+    from csd_optimade.stats import merge_stats
+
+    return merge_stats(
+        chunk.get("stats")
+        for path in paths
+        for chunk in _read_node_manifest(path)["chunks"]
+    )
+
+
+def combine_chunks(
+    chunk_paths: Iterable[Path],
+    output_file: Path,
+    headers: list[str],
+    dedup_memory_limit: int = DEFAULT_MEMORY_LIMIT,
+) -> dict[str, int]:
+    """Combine the given gzip-compressed JSONL chunks into a single JSONL file,
+    starting with the header lines and keeping only the first copy of each
+    entry, and return the number of entries written by type.
+
+    The IDs seen so far are held in a `DedupIndex`, which spills to disk
+    (alongside the output file) beyond `dedup_memory_limit` bytes.
+
+    """
+    with (
+        DedupIndex(memory_limit=dedup_memory_limit, tmp_dir=output_file.parent) as seen,
+        open(output_file, "w") as final_jsonl,
+    ):
+        for header in headers:
+            final_jsonl.write(header + "\n")
+
+        for chunk_path in chunk_paths:
+            with gzip.open(chunk_path, "rt") as chunk:
+                for line_entry in chunk:
+                    if not line_entry.strip():
+                        continue
+                    json_entry = json.loads(line_entry)
+                    if _type := json_entry.get("type"):
+                        if not seen.add(_type, json_entry["id"]):
+                            continue
+                        if not line_entry.endswith("\n"):
+                            line_entry += "\n"
+                        final_jsonl.write(line_entry)
+
+        return dict(sorted(seen.counts.items()))
+
+
+def cli(argv: list[str] | None = None):
+    """Merge the outputs of a distributed `csd-ingest --shard i/N` run."""
+    import psutil
+
+    from csd_optimade.fields import generate_jsonl_headers
+    from csd_optimade.lookup import build_lookup_index, lookup_path
+    from csd_optimade.stats import compute_stats, stats_path, write_stats
+
+    parser = argparse.ArgumentParser(
+        prog="csd-ingest merge",
+        description="Merge the outputs of the nodes of a distributed `csd-ingest --shard i/N` run into the final JSONL artefact.",
+    )
+    parser.add_argument(
+        "nodes",
+        type=Path,
+        nargs="+",
+        help="The output directories (or node manifests) of all the nodes.",
+    )
+    parser.add_argument("--run-name", type=str, default="csd")
+    parser.add_argument(
+        "--output-dir",
+        type=Path,
+        default=Path("data"),
+        help="The directory to write the merged output to (DEFAULT: data).",
+    )
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=None,
+        help="Write this many hash-sharded JSONL files plus a manifest, instead of a single combined file.",
+    )
+    parser.add_argument(
+        "--num-processes",
+        type=int,
+        default=psutil.cpu_count(logical=False),
+        help="Number of processes to use for writing shards (DEFAULT: all physical cores on machine).",
+    )
+    parser.add_argument(
+        "--dedup-memory-limit",
+        type=float,
+        default=DEFAULT_MEMORY_LIMIT / 1024**2,
+        help="The memory (in MB) that the IDs held for deduplicating the output may use (per process, when sharding), beyond which they are spilled to disk (DEFAULT: %(default).0f).",
+    )
+    parser.add_argument(
+        "--no-verify",
+        action="store_true",
+        help="Skip checking the chunk checksums against the node manifests.",
+    )
+    args = parser.parse_args(argv)
+
+    chunk_paths = read_node_manifests(args.nodes, verify=not args.no_verify)
+    headers = generate_jsonl_headers()
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.num_shards:
+        from csd_optimade.shards import read_manifest, write_shards
+
+        manifest = write_shards(
+            chunk_paths,
+            args.output_dir,
+            args.run_name,
+            args.num_shards,
+            headers,
+            pool_size=args.num_processes,
+            dedup_memory_limit=int(args.dedup_memory_limit * 1024**2),
+        )
+        shards = read_manifest(manifest)
+        shard_paths = [shard["path"] for shard in shards["shards"]]
+        lookup_index = build_lookup_index(
+            shard_paths, lookup_path(args.output_dir, args.run_name)
+        )
+        stats = write_stats(
+            read_node_stats(args.nodes) or compute_stats(shard_paths),
+            shards["entries"],
+            stats_path(args.output_dir, args.run_name),
+        )
+        print(
+            f"Merged {len(chunk_paths)} chunks from {len(args.nodes)} nodes into {args.num_shards} shards, described by {manifest}, with lookup index {lookup_index} and statistics {stats}"
+        )
+        return
+
+    output_file = args.output_dir / f"{args.run_name}-optimade.jsonl"
+    counts = combine_chunks(
+        chunk_paths,
+        output_file,
+        headers,
+        dedup_memory_limit=int(args.dedup_memory_limit * 1024**2),
+    )
+    lookup_index = build_lookup_index(
+        [output_file], lookup_path(args.output_dir, args.run_name)
+    )
+    stats = write_stats(
+        read_node_stats(args.nodes) or compute_stats([output_file]),
+        counts,
+        stats_path(args.output_dir, args.run_name),
+    )
+    print(
+        f"Merged {len(chunk_paths)} chunks from {len(args.nodes)} nodes into {output_file} ({counts}), with lookup index {lookup_index} and statistics {stats}"
+    )
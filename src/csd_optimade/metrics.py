@@ -0,0 +1,371 @@
+"""Per-request latency instrumentation and a slow-query log for the API.
+
+Each request is timed by an ASGI middleware, with the total broken down into
+the stages:
+
+- `filter_parse`: parsing and transforming the query parameters (including
+  the OPTIMADE filter) into a database query,
+- `database_query`: running the query (and counting the results),
+- `serialisation`: everything else until the response starts, i.e., mapping
+  and validating the results and encoding the JSON response,
+- `response_write`: sending the response body to the client.
+
+The timings are accumulated into histograms that are served in the
+Prometheus text format by the `/extensions/metrics` endpoint. With several
+worker processes, each worker also writes a snapshot of its histograms to a
+shared directory (see `configure_metrics_dir`) at most every
+`SNAPSHOT_INTERVAL` seconds, and the worker that handles a scrape merges the
+snapshots of the others with its own, so the metrics cover all workers.
+
+Requests that take longer than the configured threshold are written as
+single JSON lines to the slow-query log. Slow database queries are also run
+again with MongoDB's `explain`, and its output is added to the log record, so
+that each logged query comes with its plan; as this adds load to a database
+that is already slow, only a sample of them can be explained instead.
+
+"""
+
+from __future__ import annotations
+
+import contextvars
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Any
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from pathlib import Path
+
+METRICS_PATH = "/extensions/metrics"
+
+STAGES = ("filter_parse", "database_query", "serialisation", "response_write", "total")
+
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    math.inf,
+)
+"""Upper bounds (in seconds) of the histogram buckets."""
+
+router = APIRouter(redirect_slashes=True)
+
+SLOW_QUERY_THRESHOLD: float | None = 1.0
+"""Requests taking longer than this (in seconds) are written to the slow-query log."""
+
+EXPLAIN_SAMPLE_RATE: float = 1.0
+"""The fraction of slow database queries that are run again to `explain` them."""
+
+METRICS_DIR: Path | None = None
+"""A directory shared by the worker processes, in which each writes snapshots
+of its histograms for the others to merge.
+
+"""
+SNAPSHOT_INTERVAL = 1.0
+"""The minimum time (in seconds) between the snapshots written by a worker,
+i.e., how far behind the metrics of the other workers can be.
+
+"""
+
+SLOW_QUERY_LOG = logging.getLogger("csd_optimade.slow_queries")
+SLOW_QUERY_LOG.propagate = False
+SLOW_QUERY_LOG.handlers = [logging.StreamHandler()]
+SLOW_QUERY_LOG.setLevel(logging.INFO)
+
+_REQUEST_TIMINGS: contextvars.ContextVar[dict[str, Any] | None] = (
+    contextvars.ContextVar("request_timings", default=None)
+)
+
+
+class Histogram:
+    """A thread-safe histogram with fixed buckets, keyed by a tuple of label values."""
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...]):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, label_values: tuple[str, ...], value: float) -> None:
+        with self._lock:
+            counts = self._counts.setdefault(label_values, [0] * len(BUCKETS))
+            for ind, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[ind] += 1
+            self._sums[label_values] = self._sums.get(label_values, 0.0) + value
+
+    def snapshot(self) -> list[list]:
+        """Return the (JSON-serialisable) bucket counts and sum of each series."""
+        with self._lock:
+            return [
+                [list(label_values), list(counts), self._sums[label_values]]
+                for label_values, counts in self._counts.items()
+            ]
+
+    def render(self, snapshots: Iterable[list[list]] = ()) -> list[str]:
+        """Render the histogram in the Prometheus text exposition format,
+        adding the series of any snapshots (e.g., of other worker processes).
+
+        """
+        merged_counts: dict[tuple[str, ...], list[int]] = {}
+        merged_sums: dict[tuple[str, ...], float] = {}
+        for snapshot in (self.snapshot(), *snapshots):
+            for label_values, counts, total in snapshot:
+                key = tuple(label_values)
+                merged = merged_counts.setdefault(key, [0] * len(BUCKETS))
+                for ind, count in enumerate(counts):
+                    merged[ind] += count
+                merged_sums[key] = merged_sums.get(key, 0.0) + total
+
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_values, counts in sorted(merged_counts.items()):
+            labels = ",".join(
+                f'{label}="{value}"' for label, value in zip(self.labels, label_values)
+            )
+            for bound, count in zip(BUCKETS, counts):
+                le = "+Inf" if math.isinf(bound) else repr(bound)
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {merged_sums[label_values]}")
+            lines.append(f"{self.name}_count{{{labels}}} {counts[-1]}")
+        return lines
+
+
+REQUEST_STAGE_SECONDS = Histogram(
+    "csd_optimade_request_stage_seconds",
+    "Time spent in each stage of handling a request.",
+    labels=("endpoint", "stage"),
+)
+
+
+def configure_slow_query_log(
+    threshold: float | None = None,
+    log_path: Path | None = None,
+    explain_sample_rate: float = 1.0,
+) -> None:
+    """Set the threshold (in seconds; `None` to disable) above which requests
+    are logged as slow, optionally a file to write the slow-query log to, and
+    the fraction of slow database queries to `explain`.
+
+    """
+    global SLOW_QUERY_THRESHOLD, EXPLAIN_SAMPLE_RATE
+    SLOW_QUERY_THRESHOLD = threshold
+    EXPLAIN_SAMPLE_RATE = explain_sample_rate
+    if log_path is not None:
+        for handler in SLOW_QUERY_LOG.handlers:
+            handler.close()
+        SLOW_QUERY_LOG.handlers = [logging.FileHandler(log_path)]
+
+
+def is_slow(seconds: float) -> bool:
+    """Whether the given duration is above the slow-query threshold."""
+    return SLOW_QUERY_THRESHOLD is not None and seconds > SLOW_QUERY_THRESHOLD
+
+
+def should_explain(seconds: float) -> bool:
+    """Whether a database query that took the given duration should be run
+    again to `explain` it, i.e., if it is slow and sampled.
+
+    """
+    return is_slow(seconds) and random.random() < EXPLAIN_SAMPLE_RATE
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    """Add the time spent in a stage to the timings of the current request, if any."""
+    timings = _REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def record_explain(explain: dict[str, Any]) -> None:
+    """Attach the `explain` output of a slow database query to the current request, if any."""
+    timings = _REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings.setdefault("explain", []).append(explain)
+
+
+def configure_metrics_dir(path: Path | None) -> None:
+    """Set (or unset) the directory shared by the worker processes, which
+    must be done before they are forked.
+
+    """
+    global METRICS_DIR
+    METRICS_DIR = path
+
+
+class _SnapshotWriter:
+    """Writes the histograms of this process to `METRICS_DIR/<pid>.json`, from
+    a background thread, at most every `SNAPSHOT_INTERVAL` seconds while
+    requests are being recorded.
+
+    """
+
+    def __init__(self):
+        self._pid: int | None = None
+        self._dirty = threading.Event()
+
+    def mark_dirty(self) -> None:
+        if METRICS_DIR is None:
+            return
+        if self._pid != os.getpid():
+            # Started lazily, as threads do not survive the fork into the workers
+            self._pid = os.getpid()
+            self._dirty = threading.Event()
+            threading.Thread(target=self._run, args=(self._dirty,), daemon=True).start()
+        self._dirty.set()
+
+    def _run(self, dirty: threading.Event) -> None:
+        while True:
+            dirty.wait()
+            dirty.clear()
+            write_snapshot()
+            time.sleep(SNAPSHOT_INTERVAL)
+
+
+_SNAPSHOT_WRITER = _SnapshotWriter()
+
+
+def write_snapshot() -> None:
+    """Write the histograms of this process to the shared metrics directory."""
+    if METRICS_DIR is None:
+        return
+    path = METRICS_DIR / f"{os.getpid()}.json"
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(
+        json.dumps({REQUEST_STAGE_SECONDS.name: REQUEST_STAGE_SECONDS.snapshot()})
+    )
+    os.replace(tmp_path, path)
+
+
+def _read_snapshots() -> list[dict[str, list[list]]]:
+    """Read the latest snapshots of the other worker processes."""
+    if METRICS_DIR is None:
+        return []
+    snapshots = []
+    own = f"{os.getpid()}.json"
+    for path in sorted(METRICS_DIR.glob("*.json")):
+        if path.name == own:
+            continue
+        try:
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def render_metrics() -> str:
+    """Render the metrics of this process, merged with the latest snapshots of
+    any other workers.
+
+    """
+    snapshots = [
+        snapshot.get(REQUEST_STAGE_SECONDS.name, []) for snapshot in _read_snapshots()
+    ]
+    return "\n".join(REQUEST_STAGE_SECONDS.render(snapshots)) + "\n"
+
+
+class RequestTimingMiddleware:
+    """ASGI middleware that times each HTTP request, records the stage
+    timings in the histograms and writes slow requests to the slow-query log.
+
+    This is written as a plain ASGI middleware (rather than a Starlette
+    `BaseHTTPMiddleware`) so that it can observe the start and end of the
+    response without buffering it.
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings: dict[str, Any] = {}
+        token = _REQUEST_TIMINGS.set(timings)
+        start = time.perf_counter()
+        response_start: float | None = None
+        status: int | None = None
+
+        async def _send(message):
+            nonlocal response_start, status
+            if message["type"] == "http.response.start":
+                response_start = time.perf_counter()
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _REQUEST_TIMINGS.reset(token)
+            end = time.perf_counter()
+            if response_start is None:
+                response_start = end
+            self._record(scope, status, timings, start, response_start, end)
+
+    @staticmethod
+    def _record(
+        scope,
+        status: int | None,
+        timings: dict[str, Any],
+        start: float,
+        response_start: float,
+        end: float,
+    ) -> None:
+        endpoint = getattr(scope.get("endpoint"), "__name__", "unmatched")
+        stages = {
+            "filter_parse": timings.get("filter_parse", 0.0),
+            "database_query": timings.get("database_query", 0.0),
+        }
+        stages["serialisation"] = max(
+            0.0,
+            response_start - start - stages["filter_parse"] - stages["database_query"],
+        )
+        stages["response_write"] = end - response_start
+        stages["total"] = end - start
+
+        for stage in STAGES:
+            REQUEST_STAGE_SECONDS.observe((endpoint, stage), stages[stage])
+        _SNAPSHOT_WRITER.mark_dirty()
+
+        if is_slow(stages["total"]):
+            record = {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "method": scope.get("method"),
+                "path": scope.get("path"),
+                "query": scope.get("query_string", b"").decode("latin-1"),
+                "endpoint": endpoint,
+                "status": status,
+                "seconds": {stage: round(stages[stage], 6) for stage in STAGES},
+            }
+            if "explain" in timings:
+                record["explain"] = timings["explain"]
+            SLOW_QUERY_LOG.info(json.dumps(record, default=str))
+
+
+@router.get(METRICS_PATH, tags=["Extensions"], response_class=PlainTextResponse)
+def metrics():
+    """Request latency histograms of all workers, in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
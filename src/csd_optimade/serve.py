@@ -1,11 +1,16 @@
+"""The `csd-serve` CLI.
+
+optimade-maker, optimade-python-tools and the web stack are only imported
+once the arguments have been parsed, so that `--help` and argument errors
+return immediately.
+
+"""
+
 import argparse
 import os
-import tempfile
 import typing
 from pathlib import Path
 
-from optimade_maker.serve import OptimakeServer
-
 from csd_optimade.fields import (
     generate_csd_provider_fields,
     generate_csd_provider_info,
@@ -13,10 +18,18 @@ from csd_optimade.fields import (
     generate_license_link,
 )
 
+SHARD_INSERT_WORKERS = 4
+"""The number of shards to insert into MongoDB concurrently."""
+
 
 def cli():
     parser = argparse.ArgumentParser()
-    parser.add_argument("jsonl_path", type=str, default="optimade.jsonl")
+    parser.add_argument(
+        "jsonl_path",
+        type=str,
+        default="optimade.jsonl",
+        help="The OPTIMADE JSONL file to serve, optionally gzip-compressed, '-' to read it from stdin, or the JSON manifest of a sharded ingest.",
+    )
     parser.add_argument(
         "--port", type=int, default=5000, help="Port to run the OPTIMADE API on."
     )
@@ -40,24 +53,58 @@ def cli():
         type=str,
         help="An optional MongoDB URI to use, instead of the in-memory database.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of API worker processes to serve from (DEFAULT: 1). The data is inserted once before the workers are forked.",
+    )
+    parser.add_argument(
+        "--entry-cache-size",
+        type=float,
+        default=0,
+        help="Maximum size in MB of the in-memory cache of precompressed single-structure responses, per worker (DEFAULT: 0, i.e., disabled).",
+    )
+    parser.add_argument(
+        "--slow-query-threshold",
+        type=float,
+        default=1.0,
+        help="Log requests that take longer than this many seconds to the slow-query log (DEFAULT: 1.0). Set to 0 to disable.",
+    )
+    parser.add_argument(
+        "--slow-query-log",
+        type=Path,
+        help="A file to write the slow-query log to, as JSON lines (DEFAULT: stderr).",
+    )
+    parser.add_argument(
+        "--explain-sample-rate",
+        type=float,
+        default=1.0,
+        help="The fraction of slow database queries to run again with MongoDB's `explain`, adding its query plan and execution statistics to the slow-query log; lower it to reduce the load this adds to an already slow database (DEFAULT: 1, i.e., all).",
+    )
+    parser.add_argument(
+        "--lookup-index",
+        type=Path,
+        help="The lookup index written by `csd-ingest`, used to answer equality filters on InChIKeys, CCDC numbers and reduced formulae (DEFAULT: the `*-lookup.sqlite` file alongside the JSONL file or manifest, if present).",
+    )
+    parser.add_argument(
+        "--stats",
+        type=Path,
+        help="The statistics written by `csd-ingest`, served from `/extensions/stats` (DEFAULT: the `*-stats.json` file alongside the JSONL file or manifest, if present, or otherwise counted from the JSONL file, unless run with `--no-insert`).",
+    )
     args = parser.parse_args()
 
-    jsonl_path = Path(args.jsonl_path)
-    if jsonl_path.is_file() and jsonl_path.name != "optimade.jsonl":
-        # optimade-maker expects the file to be named `optimade.jsonl`
-        tmp_path = Path(tempfile.mkdtemp())
-        (tmp_path / "optimade.jsonl").symlink_to(jsonl_path.absolute())
-        jsonl_path = tmp_path
-    else:
-        jsonl_path = jsonl_path.parent
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    from_stdin = args.jsonl_path == "-"
+    jsonl_path = None if from_stdin else Path(args.jsonl_path).absolute()
 
     # kwargs to override optimade-maker defaults, if set
     override_kwargs: dict[str, typing.Any] = {}
-    if args.no_insert:
-        override_kwargs["insert_from_jsonl"] = None
-
-    if args.exit_after_insert:
-        override_kwargs["exit_after_insert"] = True
+    # Insertion is handled below, rather than when the app is first imported,
+    # so that it happens exactly once before any workers are forked
+    override_kwargs["insert_from_jsonl"] = None
 
     # Allow user to specify a real MongoDB
     mongo_uri = args.mongo_uri
@@ -89,10 +136,17 @@ def cli():
         if args.drop_first and test_client:
             test_client.drop_database(database_name)
 
+        if test_client:
+            test_client.close()
+
     override_kwargs["license"] = generate_license_link()
 
+    from optimade_maker.serve import OptimakeServer
+
+    # The data is inserted below rather than by optimade-maker, so it only
+    # needs an existing directory here
     optimake_server = OptimakeServer(
-        jsonl_path,
+        jsonl_path.parent if jsonl_path else Path.cwd(),
         host="0.0.0.0",
         port=args.port,
         override_config=dict(
@@ -104,4 +158,162 @@ def cli():
             **override_kwargs,
         ),
     )
-    optimake_server.start_api()
+    # Importing the app loads the config set above, so must happen after `OptimakeServer` init
+    from csd_optimade.app import create_app
+
+    app = create_app(entry_cache_size=int(args.entry_cache_size * 1024**2))
+
+    if not args.no_insert:
+        if jsonl_path and jsonl_path.suffix == ".json":
+            from csd_optimade.insert import insert_from_manifest
+
+            # The in-memory database is not thread-safe, so shards are only
+            # loaded concurrently into a real MongoDB
+            insert_from_manifest(
+                jsonl_path,
+                create_default_index=True,
+                max_workers=SHARD_INSERT_WORKERS if mongo_uri else 1,
+            )
+        else:
+            from csd_optimade.insert import insert_from_jsonl_stream
+
+            insert_from_jsonl_stream(args.jsonl_path, create_default_index=True)
+
+    if args.exit_after_insert:
+        return
+
+    # The file (or manifest) the database was loaded from, if it was loaded
+    # here; with `--no-insert`, the given path need not describe the database
+    inserted_path = None if args.no_insert else jsonl_path
+    app.state.inserted_from = inserted_path
+
+    from optimade.server.routers import ENTRY_COLLECTIONS
+
+    counts = {
+        name: len(ENTRY_COLLECTIONS[name]) for name in ("structures", "references")
+    }
+
+    from csd_optimade.lookup import configure_lookup_index, find_lookup_index
+
+    lookup_index = args.lookup_index or (
+        find_lookup_index(jsonl_path) if jsonl_path else None
+    )
+    configure_lookup_index(lookup_index, num_structures=counts["structures"])
+
+    from csd_optimade.stats import configure_stats, find_stats, load_stats
+
+    configure_stats(
+        load_stats(
+            args.stats or (find_stats(jsonl_path) if jsonl_path else None),
+            inserted_path,
+            counts,
+        )
+    )
+
+    from csd_optimade.metrics import configure_slow_query_log
+
+    configure_slow_query_log(
+        args.slow_query_threshold if args.slow_query_threshold > 0 else None,
+        args.slow_query_log,
+        explain_sample_rate=args.explain_sample_rate,
+    )
+
+    serve(
+        app, host=optimake_server.host, port=optimake_server.port, workers=args.workers
+    )
+
+
+def serve(app, host: str, port: int, workers: int = 1) -> None:
+    """Serve the app from one or more worker processes sharing the same port.
+
+    Multiple workers are forked from the current process *after* the data has
+    been loaded, so that an in-memory database is shared copy-on-write rather
+    than loaded once per worker. Any real MongoDB connections are re-opened
+    in each worker, as they cannot be shared across a fork.
+
+    """
+    import gc
+    import shutil
+    import signal
+    import tempfile
+
+    import uvicorn
+
+    config = uvicorn.Config(app, host=host, port=port)
+    if workers == 1:
+        uvicorn.Server(config).run()
+        return
+
+    import traceback
+
+    from csd_optimade.app import close_database, reconnect_database
+    from csd_optimade.metrics import configure_metrics_dir
+
+    # Each worker writes snapshots of its metrics here, to be merged on scrape
+    metrics_dir = Path(tempfile.mkdtemp(prefix="csd-optimade-metrics-"))
+    configure_metrics_dir(metrics_dir)
+
+    sock = config.bind_socket()
+    # The workers open their own connections, so the parent's are not inherited
+    close_database()
+    # Move all loaded objects out of the garbage collector's reach, so that
+    # collections in the workers do not trigger copies of the shared pages
+    gc.freeze()
+
+    pids: list[int] = []
+    stopping = False
+
+    def _stop_workers(signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # Installed before forking, so that a signal received while the workers
+    # are started still stops those already running; signals are blocked
+    # around each fork, until the new worker has been recorded
+    signal.signal(signal.SIGINT, _stop_workers)
+    signal.signal(signal.SIGTERM, _stop_workers)
+    handled = {signal.SIGINT, signal.SIGTERM}
+
+    for _ in range(workers):
+        if stopping:
+            break
+        signal.pthread_sigmask(signal.SIG_BLOCK, handled)
+        pid = os.fork()
+        if pid == 0:
+            # The child must never return into the parent's code (e.g., on an
+            # exception), so always leaves via `os._exit`
+            exit_code = 1
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, handled)
+                reconnect_database()
+                uvicorn.Server(config).run(sockets=[sock])
+                exit_code = 0
+            except SystemExit as exc:
+                exit_code = exc.code if isinstance(exc.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(exit_code)
+        pids.append(pid)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, handled)
+
+    exit_code = 0
+    while pids:
+        pid, status = os.wait()
+        pids.remove(pid)
+        if not stopping:
+            # If any worker exits unexpectedly, shut down the rest rather than serving at reduced capacity
+            exit_code = os.waitstatus_to_exitcode(status) or 1
+            _stop_workers(signal.SIGTERM, None)
+
+    sock.close()
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    if exit_code:
+        raise SystemExit(exit_code)
@@ -0,0 +1,222 @@
+"""Hash-sharded output of the ingested chunks, for parallel downstream loading.
+
+Instead of combining all chunks into a single JSONL file, each entry is
+assigned to one of N shards by a stable hash of its `(type, id)`, so that all
+copies of an entry land in the same shard. Each shard can then be
+deduplicated (and later loaded) independently of the others. Each shard is a
+complete OPTIMADE JSONL file with its own header lines, and a manifest
+describing the shards is written alongside them.
+
+Both stages are run in parallel: first each chunk is partitioned into
+per-shard pieces, then the pieces of each shard are deduplicated and
+combined into the shard file.
+
+"""
+
+from __future__ import annotations
+
+import datetime
+import gzip
+import hashlib
+import json
+import shutil
+from functools import partial
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from csd_optimade.dedup import DEFAULT_MEMORY_LIMIT, DedupIndex
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+MANIFEST_VERSION = 1
+SHARD_HASH = "blake2b-64(type/id) mod num_shards"
+
+
+def shard_index(entry_type: str, entry_id: str, num_shards: int) -> int:
+    """Return the shard that an entry belongs to, which is stable across runs,
+    machines and Python versions (unlike the built-in `hash`).
+
+    """
+    digest = hashlib.blake2b(f"{entry_type}/{entry_id}".encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), "big") % num_shards
+
+
+def shard_path(output_dir: Path, run_name: str, index: int, num_shards: int) -> Path:
+    width = len(str(num_shards - 1))
+    return (
+        output_dir
+        / f"{run_name}-optimade-shard-{index:0{width}d}-of-{num_shards}.jsonl"
+    )
+
+
+def manifest_path(output_dir: Path, run_name: str) -> Path:
+    return output_dir / f"{run_name}-optimade-manifest.json"
+
+
+def partition_chunk(
+    args: tuple[int, Path], tmp_dir: Path, num_shards: int
+) -> dict[int, Path]:
+    """Split a (gzip-compressed) JSONL chunk into one piece per shard, returning
+    the paths of the non-empty pieces by shard index.
+
+    """
+    chunk_id, chunk_path = args
+    pieces: dict[int, Any] = {}
+    try:
+        with gzip.open(chunk_path, "rt") as chunk:
+            for line in chunk:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if not (entry_type := entry.get("type")) or "id" not in entry:
+                    continue
+                index = shard_index(entry_type, entry["id"], num_shards)
+                if index not in pieces:
+                    piece_dir = tmp_dir / f"shard-{index}"
+                    piece_dir.mkdir(parents=True, exist_ok=True)
+                    pieces[index] = open(piece_dir / f"{chunk_id:08d}.jsonl", "w")
+                pieces[index].write(line if line.endswith("\n") else line + "\n")
+    finally:
+        for piece in pieces.values():
+            piece.close()
+    return {index: Path(piece.name) for index, piece in pieces.items()}
+
+
+def combine_shard(
+    args: tuple[int, list[Path]],
+    output_dir: Path,
+    run_name: str,
+    num_shards: int,
+    headers: list[str],
+    dedup_memory_limit: int = DEFAULT_MEMORY_LIMIT,
+) -> dict[str, Any]:
+    """Deduplicate and combine the pieces of a shard (in chunk order, keeping
+    the first copy of each entry) into the shard file, returning its manifest
+    record.
+
+    The IDs seen so far are held in a `DedupIndex`, which spills to disk
+    (alongside the pieces) beyond `dedup_memory_limit` bytes.
+
+    """
+    index, piece_paths = args
+    path = shard_path(output_dir, run_name, index, num_shards)
+    sha256 = hashlib.sha256()
+
+    with (
+        DedupIndex(
+            memory_limit=dedup_memory_limit,
+            tmp_dir=piece_paths[0].parent if piece_paths else None,
+        ) as seen,
+        open(path, "wb") as shard,
+    ):
+
+        def _write(line: str) -> None:
+            data = line.encode("utf-8")
+            sha256.update(data)
+            shard.write(data)
+
+        for header in headers:
+            _write(header + "\n")
+        for piece_path in sorted(piece_paths):
+            with open(piece_path) as piece:
+                for line in piece:
+                    entry = json.loads(line)
+                    if seen.add(entry["type"], entry["id"]):
+                        _write(line)
+            piece_path.unlink()
+        counts = dict(sorted(seen.counts.items()))
+
+    return {
+        "index": index,
+        "path": path.name,
+        "entries": counts,
+        "size": path.stat().st_size,
+        "sha256": sha256.hexdigest(),
+    }
+
+
+def write_shards(
+    chunk_paths: Iterable[Path],
+    output_dir: Path,
+    run_name: str,
+    num_shards: int,
+    headers: list[str],
+    pool_size: int = 1,
+    tmp_dir: Path | None = None,
+    dedup_memory_limit: int = DEFAULT_MEMORY_LIMIT,
+) -> Path:
+    """Partition the entries in the given JSONL chunks into `num_shards`
+    deduplicated shard files, returning the path to the manifest.
+
+    Parameters:
+        chunk_paths: The gzip-compressed JSONL chunks, in order.
+        output_dir: The directory to write the shards and manifest to.
+        run_name: The run name, used as the prefix for the output files.
+        num_shards: The number of shards to write.
+        headers: The JSONL header lines to start each shard with.
+        pool_size: The number of processes to use.
+        tmp_dir: A directory for intermediate files (DEFAULT: inside `output_dir`).
+        dedup_memory_limit: The memory limit (in bytes) of the IDs held for
+            deduplicating each shard, beyond which they are spilled to disk.
+
+    """
+    from multiprocessing import Pool
+
+    if num_shards < 1:
+        raise ValueError(f"Number of shards must be at least 1, not {num_shards}")
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    tmp_dir = tmp_dir or output_dir / f".{run_name}-shards"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    pieces_by_shard: dict[int, list[Path]] = {i: [] for i in range(num_shards)}
+    with Pool(pool_size) as pool:
+        for pieces in pool.imap_unordered(
+            partial(partition_chunk, tmp_dir=tmp_dir, num_shards=num_shards),
+            enumerate(chunk_paths),
+        ):
+            for index, piece_path in pieces.items():
+                pieces_by_shard[index].append(piece_path)
+
+        shards = sorted(
+            pool.imap_unordered(
+                partial(
+                    combine_shard,
+                    output_dir=output_dir,
+                    run_name=run_name,
+                    num_shards=num_shards,
+                    headers=headers,
+                    dedup_memory_limit=dedup_memory_limit,
+                ),
+                pieces_by_shard.items(),
+            ),
+            key=lambda shard: shard["index"],
+        )
+
+    shutil.rmtree(tmp_dir)
+
+    manifest = {
+        "manifest_version": MANIFEST_VERSION,
+        "run_name": run_name,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "num_shards": num_shards,
+        "shard_hash": SHARD_HASH,
+        "num_header_lines": len(headers),
+        "entries": {
+            entry_type: sum(shard["entries"].get(entry_type, 0) for shard in shards)
+            for entry_type in sorted({t for shard in shards for t in shard["entries"]})
+        },
+        "shards": shards,
+    }
+    path = manifest_path(output_dir, run_name)
+    path.write_text(json.dumps(manifest, indent=2))
+    return path
+
+
+def read_manifest(path: Path) -> dict[str, Any]:
+    """Read a shard manifest, resolving the shard paths relative to it."""
+    manifest = json.loads(path.read_text())
+    for shard in manifest["shards"]:
+        shard["path"] = path.parent / shard["path"]
+    return manifest
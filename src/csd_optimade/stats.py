@@ -0,0 +1,233 @@
+"""Precomputed dataset statistics and facet counts.
+
+Counting the structures per element, crystal system, space group, number of
+elements or deposition year requires an aggregation over the whole structures
+collection. Instead, each `csd-ingest` worker counts the facets of the
+structures it maps, and the counts of all chunks are merged (alongside the
+number of entries of each type in the deduplicated output) into
+`<run>-optimade-stats.json`, next to the combined JSONL file or manifest.
+
+`csd-serve` loads this file (or, failing that, counts the facets of the JSONL
+file it inserts), and serves it as-is from `/extensions/stats`; the numbers of
+entries also provide `meta.data_available` without counting the collections.
+
+"""
+
+from __future__ import annotations
+
+import collections
+import datetime
+import json
+import logging
+import re
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Mapping
+    from pathlib import Path
+
+    from fastapi import APIRouter
+
+STATS_PATH = "/extensions/stats"
+STATS_VERSION = 1
+
+FACETS = (
+    "elements",
+    "_csd_crystal_system",
+    "space_group_int_number",
+    "nelements",
+    "deposition_year",
+)
+
+LOG = logging.getLogger(__name__)
+
+STATS: DatasetStats | None = None
+"""The statistics of the loaded dataset, if any."""
+_STATS_JSON: bytes | None = None
+
+
+def stats_path(output_dir: Path, run_name: str) -> Path:
+    return output_dir / f"{run_name}-optimade-stats.json"
+
+
+def find_stats(artefact: Path) -> Path | None:
+    """Return the path of the statistics written alongside a JSONL file or
+    shard manifest by `csd-ingest`, if it exists.
+
+    """
+    name = re.sub(r"(-manifest\.json|\.jsonl(\.gz)?)$", "", artefact.name)
+    path = artefact.parent / f"{name}-stats.json"
+    return path if path.exists() else None
+
+
+def _deposition_year(value: Any) -> str | None:
+    """Return the year of a deposition date, whether stored as a date, as a
+    string, or wrapped in MongoDB extended JSON (`{"$date": ...}`).
+
+    """
+    if isinstance(value, dict):
+        value = value.get("$date")
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return str(value.year)
+    if isinstance(value, str) and value[:4].isdigit():
+        return value[:4]
+    return None
+
+
+class DatasetStats:
+    """The (mergeable) entry and facet counts of a dataset."""
+
+    def __init__(self):
+        self.entries: collections.Counter[str] = collections.Counter()
+        self.facets: dict[str, collections.Counter[str]] = {
+            facet: collections.Counter() for facet in FACETS
+        }
+
+    def add_structure(self, attributes: Mapping[str, Any]) -> None:
+        """Count the facets of a structure's attributes."""
+        self.entries["structures"] += 1
+        self.facets["elements"].update(attributes.get("elements") or [])
+        values = {
+            "_csd_crystal_system": attributes.get("_csd_crystal_system"),
+            "space_group_int_number": attributes.get("space_group_int_number")
+            or attributes.get("space_group_it_number"),
+            "nelements": attributes.get("nelements"),
+            "deposition_year": _deposition_year(attributes.get("_csd_deposition_date")),
+        }
+        for facet, value in values.items():
+            if value is not None:
+                self.facets[facet][str(value)] += 1
+
+    def add(self, entry: Mapping[str, Any]) -> None:
+        """Count an entry in the JSONL format, ignoring any header lines."""
+        entry_type = entry.get("type")
+        if entry_type == "structures":
+            self.add_structure(entry.get("attributes") or {})
+        elif entry_type not in (None, "info"):
+            self.entries[entry_type] += 1
+
+    def merge(self, other: DatasetStats) -> None:
+        self.entries.update(other.entries)
+        for facet, counts in other.facets.items():
+            self.facets.setdefault(facet, collections.Counter()).update(counts)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "stats_version": STATS_VERSION,
+            "entries": dict(sorted(self.entries.items())),
+            "facets": {
+                facet: dict(sorted(counts.items(), key=lambda item: _sort_key(item[0])))
+                for facet, counts in self.facets.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> DatasetStats:
+        stats = cls()
+        stats.entries.update(data.get("entries") or {})
+        for facet, counts in (data.get("facets") or {}).items():
+            stats.facets.setdefault(facet, collections.Counter()).update(counts)
+        return stats
+
+
+def _sort_key(value: str) -> tuple[int, int, str]:
+    """Sort numeric facet values numerically, and the rest alphabetically."""
+    return (0, int(value), "") if value.isdigit() else (1, 0, value)
+
+
+def merge_stats(records: Iterable[Mapping[str, Any] | None]) -> DatasetStats | None:
+    """Merge the statistics of several chunks, or return `None` if any of them
+    are missing (e.g., from a node manifest written before they were added).
+
+    """
+    merged = DatasetStats()
+    for record in records:
+        if record is None:
+            return None
+        merged.merge(DatasetStats.from_dict(record))
+    return merged
+
+
+def compute_stats(jsonl_paths: Iterable[Path]) -> DatasetStats:
+    """Count the entries and facets of the given (optionally gzip-compressed)
+    JSONL files.
+
+    """
+    from csd_optimade.insert import open_jsonl
+
+    stats = DatasetStats()
+    for path in jsonl_paths:
+        with open_jsonl(path) as handle:
+            for line in handle:
+                if line.strip():
+                    stats.add(json.loads(line))
+    return stats
+
+
+def write_stats(stats: DatasetStats, entries: Mapping[str, int], path: Path) -> Path:
+    """Write the statistics, with the given numbers of entries of each type
+    (i.e., after deduplication), to a JSON file.
+
+    """
+    stats.entries = collections.Counter(entries)
+    path.write_text(json.dumps(stats.to_dict(), indent=2))
+    return path
+
+
+def configure_stats(stats: DatasetStats | None) -> None:
+    """Set (or unset) the statistics served by the API."""
+    global STATS, _STATS_JSON
+    STATS = stats
+    _STATS_JSON = json.dumps(stats.to_dict()).encode() if stats else None
+
+
+def load_stats(
+    path: Path | None, jsonl_path: Path | None, counts: Mapping[str, int]
+) -> DatasetStats | None:
+    """Load the statistics of the served dataset from `path`, if they match the
+    numbers of entries loaded into the database (`counts`), or otherwise count
+    them from the JSONL file (or shard manifest) the data was just loaded
+    from, if any (`jsonl_path`).
+
+    """
+    if path:
+        stats = DatasetStats.from_dict(json.loads(path.read_text()))
+        if all(stats.entries.get(t, 0) == count for t, count in counts.items()):
+            return stats
+        LOG.warning(
+            "Ignoring the statistics in %s, as their entry counts %s do not match the database %s",
+            path,
+            dict(stats.entries),
+            dict(counts),
+        )
+    if jsonl_path is None:
+        return None
+    if jsonl_path.suffix == ".json":
+        from csd_optimade.shards import read_manifest
+
+        paths = [shard["path"] for shard in read_manifest(jsonl_path)["shards"]]
+    else:
+        paths = [jsonl_path]
+    return compute_stats(paths)
+
+
+def create_router() -> APIRouter:
+    """Return the router of the stats endpoint; as this module is also used by
+    the ingest workers, FastAPI is only imported here.
+
+    """
+    from fastapi import APIRouter
+    from fastapi.responses import Response
+
+    router = APIRouter(redirect_slashes=True)
+
+    @router.get(STATS_PATH, tags=["Extensions"])
+    def get_stats() -> Response:
+        """Return the precomputed entry and facet counts of the dataset."""
+        from optimade.exceptions import NotFound
+
+        if _STATS_JSON is None:
+            raise NotFound(detail="No statistics are available for this dataset.")
+        return Response(content=_STATS_JSON, media_type="application/json")
+
+    return router
@@ -0,0 +1,182 @@
+"""A compact representation of crystal structures as their asymmetric unit
+plus the space-group symmetry operators, and its expansion to the full unit
+cell.
+
+Packing the unit cell (`ccdc.crystal.Crystal.packing()`) is the slowest step
+of mapping a CSD entry, and the packed sites are the bulk of the ingested
+data. With `csd-ingest --compact`, only the fractional coordinates and
+species of the asymmetric unit are stored (in the `_csd_asymmetric_unit`
+provider field), alongside the symmetry operators, and the server expands
+them into `cartesian_site_positions` and `species_at_sites` on demand.
+
+Expanded sites are wrapped into the unit cell, with sites on special
+positions (i.e., mapped onto each other by the symmetry operators) merged,
+rather than grouped into whole molecules as by `packing()`.
+
+"""
+
+from __future__ import annotations
+
+import re
+from fractions import Fraction
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+ASYMMETRIC_UNIT_FIELD = "_csd_asymmetric_unit"
+SITE_FIELDS = {"cartesian_site_positions", "species_at_sites", "lattice_vectors"}
+"""The fields that are materialised by expanding the asymmetric unit."""
+SITE_TOLERANCE = 1e-3
+"""Sites closer than this (in fractional coordinates) are merged."""
+
+_TERM = re.compile(r"([+-]?)(?:(\d+(?:\.\d+)?(?:/\d+)?)\*?)?([xyz]?)")
+
+
+def parse_symmetry_operation(operation: str) -> tuple[np.ndarray, np.ndarray]:
+    """Parse a symmetry operation in the 'xyz' notation (e.g., `1/2-x,y,-z+1/2`)
+    into its rotation matrix and translation vector.
+
+    Raises:
+        ValueError: If the operation cannot be parsed.
+
+    """
+    rotation = np.zeros((3, 3))
+    translation = np.zeros(3)
+    components = operation.replace(" ", "").lower().split(",")
+    if len(components) != 3:
+        raise ValueError(f"Cannot parse symmetry operation {operation!r}")
+    for row, component in enumerate(components):
+        position = 0
+        while position < len(component):
+            match = _TERM.match(component, position)
+            if match is None or match.end() == position:
+                raise ValueError(f"Cannot parse symmetry operation {operation!r}")
+            sign, number, axis = match.groups()
+            value = float(Fraction(number)) if number else 1.0
+            value = -value if sign == "-" else value
+            if axis:
+                rotation[row, "xyz".index(axis)] += value
+            elif number:
+                translation[row] += value
+            else:
+                raise ValueError(f"Cannot parse symmetry operation {operation!r}")
+            position = match.end()
+    return rotation, translation
+
+
+def _site_images(
+    positions: Sequence[Sequence[float]], operations: Sequence[str]
+) -> np.ndarray:
+    """Return the images of each site under the symmetry operations, wrapped
+    into the unit cell, with shape `(sites, operations, 3)`.
+
+    """
+    asymmetric = np.asarray(positions, dtype=float).reshape(-1, 3)
+    expanded = []
+    for operation in operations or ["x,y,z"]:
+        rotation, translation = parse_symmetry_operation(operation)
+        expanded.append(asymmetric @ rotation.T + translation)
+    return np.stack(expanded, axis=1) % 1.0
+
+
+def _unique_images(images: np.ndarray, tolerance: float) -> np.ndarray:
+    """Return a mask of the images of a single site that do not coincide with
+    an earlier image of the same site.
+
+    """
+    delta = images[:, None, :] - images[None, :, :]
+    delta -= np.round(delta)
+    same = np.all(np.abs(delta) < tolerance, axis=-1)
+    return ~np.tril(same, k=-1).any(axis=1)
+
+
+def site_multiplicities(
+    positions: Sequence[Sequence[float]],
+    operations: Sequence[str],
+    tolerance: float = SITE_TOLERANCE,
+) -> list[int]:
+    """Return the number of sites in the unit cell generated from each site of
+    the asymmetric unit, i.e., the size of its orbit under the operations.
+
+    This only compares the images of each site with each other, so is linear
+    in the number of sites (and quadratic in the number of operations).
+
+    """
+    return [
+        int(_unique_images(images, tolerance).sum())
+        for images in _site_images(positions, operations)
+    ]
+
+
+def expand_fractional_sites(
+    positions: Sequence[Sequence[float]],
+    species: Sequence[str],
+    operations: Sequence[str],
+    tolerance: float = SITE_TOLERANCE,
+) -> tuple[np.ndarray, list[str]]:
+    """Apply the symmetry operations to the fractional positions of the
+    asymmetric unit, returning the unique sites within the unit cell and their
+    species, with the images of each site contiguous.
+
+    """
+    sites: list[np.ndarray] = []
+    site_species: list[str] = []
+    for images, label in zip(_site_images(positions, operations), species):
+        unique = images[_unique_images(images, tolerance)]
+        sites.extend(unique)
+        site_species.extend([label] * len(unique))
+    return np.asarray(sites).reshape(-1, 3), site_species
+
+
+def lattice_vectors(
+    a: float, b: float, c: float, alpha: float, beta: float, gamma: float
+) -> np.ndarray:
+    """Return the lattice vectors for the given cell parameters, with `a` along
+    x and `b` in the xy-plane.
+
+    """
+    from optimade.adapters.structures.utils import cellpar_to_cell
+
+    return np.asarray(cellpar_to_cell([a, b, c, alpha, beta, gamma]))
+
+
+def compact_structure(
+    positions: Sequence[Sequence[float]],
+    species: Sequence[str],
+    operations: Sequence[str],
+) -> dict[str, Any]:
+    """Return the value of the `_csd_asymmetric_unit` field."""
+    return {
+        "fractional_site_positions": [list(map(float, p)) for p in positions],
+        "species_at_sites": list(species),
+        "symmetry_operations_xyz": list(operations),
+    }
+
+
+def expand_attributes(attributes: dict[str, Any]) -> bool:
+    """Materialise the site fields of a structure's attributes from its
+    asymmetric unit (in place), returning whether it had one to expand.
+
+    """
+    compact = attributes.get(ASYMMETRIC_UNIT_FIELD)
+    if not compact:
+        return False
+    cell = lattice_vectors(
+        *(
+            attributes[f"_csd_lattice_parameter_{parameter}"]
+            for parameter in ("a", "b", "c", "alpha", "beta", "gamma")
+        )
+    )
+    fractional, species = expand_fractional_sites(
+        compact["fractional_site_positions"],
+        compact["species_at_sites"],
+        compact["symmetry_operations_xyz"],
+    )
+    attributes["lattice_vectors"] = cell.tolist()
+    attributes["cartesian_site_positions"] = (fractional @ cell).tolist()
+    attributes["species_at_sites"] = species
+    attributes["nsites"] = len(species)
+    return True
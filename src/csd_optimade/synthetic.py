@@ -0,0 +1,69 @@
+"""Deterministic, CSD-like synthetic OPTIMADE data, for testing and
+benchmarking the API without a CSD license.
+
+"""
+
+from __future__ import annotations
+
+import json
+import random
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def generate_synthetic_structures(num_entries: int = 100) -> list[dict]:
+    """Generate some CSD-like OPTIMADE structures in the JSONL format,
+    with deterministic contents and ids.
+
+    """
+    rng = random.Random(0)
+    elements = ["C", "H", "N", "O", "S", "Cl", "Br", "Cu", "Fe", "Zn"]
+    crystal_systems = ["triclinic", "monoclinic", "orthorhombic", "cubic"]
+    space_groups = ["P-1", "P21/c", "C2/c", "P212121", "P21", "Pbca", "Pna21"]
+    structures = []
+    for i in range(num_entries):
+        entry_elements = sorted(rng.sample(elements, rng.randint(1, 4)))
+        nsites = rng.randint(1, 8)
+        positions = [[rng.random(), rng.random(), rng.random()] for _ in range(nsites)]
+        species_at_sites = [rng.choice(entry_elements) for _ in range(nsites)]
+        structures.append(
+            {
+                "id": f"SYN{i:06d}",
+                "type": "structures",
+                "attributes": {
+                    "immutable_id": f"SYN{i:06d}",
+                    "last_modified": {"$date": "2025-01-01T00:00:00Z"},
+                    "elements": entry_elements,
+                    "nelements": len(entry_elements),
+                    "chemical_formula_reduced": "".join(entry_elements),
+                    "chemical_formula_descriptive": " ".join(entry_elements),
+                    "nsites": nsites,
+                    "cartesian_site_positions": positions,
+                    "species_at_sites": species_at_sites,
+                    "species": [
+                        {"name": e, "chemical_symbols": [e], "concentration": [1.0]}
+                        for e in entry_elements
+                    ],
+                    "structure_features": ["implicit_atoms"]
+                    if set(species_at_sites) != set(entry_elements)
+                    else [],
+                    "_csd_space_group_symbol_hermann_mauginn": rng.choice(space_groups),
+                    "_csd_crystal_system": rng.choice(crystal_systems),
+                    "_csd_ccdc_number": 100_000 + i,
+                    "_csd_deposition_date": {
+                        "$date": f"{rng.randint(1970, 2024)}-01-01T00:00:00Z"
+                    },
+                },
+            }
+        )
+    return structures
+
+
+def write_synthetic_jsonl(path: Path | str, num_entries: int = 100) -> None:
+    """Write synthetic structures to an OPTIMADE JSONL file at the given path."""
+    with open(path, "w") as f:
+        f.write(json.dumps({"x-optimade": {"meta": {"api_version": "1.1.0"}}}) + "\n")
+        for entry in generate_synthetic_structures(num_entries):
+            f.write(json.dumps(entry) + "\n")
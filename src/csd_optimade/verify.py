@@ -0,0 +1,298 @@
+"""Parallel validation of a finished OPTIMADE JSONL artefact.
+
+Full pydantic validation is too slow to run inline during ingest, so
+`csd-ingest verify` instead checks the combined file afterwards. A plain
+JSONL file is split into byte ranges, each validated by a separate process
+(which skips forward to the first full line in its range, and reads past the
+end of its range to finish its last line); a gzip-compressed file cannot be
+split, so it is decompressed in the main process and handed to the workers
+in batches of lines.
+
+Each entry is validated against the OPTIMADE `StructureResource` or
+`ReferenceResource` model, and the following CSD-specific invariants are
+checked for structures:
+
+- `nsites` matches the lengths of `cartesian_site_positions` and
+  `species_at_sites`;
+- every site's species is defined in `species`, and every chemical symbol
+  of each species is in `elements`.
+
+Finally, the IDs collected from all workers are checked to be unique per
+entry type, and all references linked to by structures are checked to exist.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import gzip
+import itertools
+import json
+import math
+import time
+import warnings
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+MAX_ERROR_SAMPLES = 20
+"""The maximum number of example errors kept for each kind of error."""
+RANGES_PER_PROCESS = 4
+"""The number of byte ranges per process, to balance the load between them."""
+GZIP_BATCH_SIZE = 5_000
+"""The number of lines per batch when verifying a gzip-compressed file."""
+NON_ELEMENT_SYMBOLS = {"X", "vacancy"}
+
+
+def split_byte_ranges(path: Path, num_ranges: int) -> list[tuple[int, int]]:
+    """Split a file into (at most) `num_ranges` contiguous `[start, end)`
+    byte ranges of approximately equal size.
+
+    """
+    size = path.stat().st_size
+    step = max(math.ceil(size / num_ranges), 1)
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def iter_byte_range(path: Path, start: int, end: int) -> Iterator[tuple[int, bytes]]:
+    """Yield `(offset, line)` for every line of the file that starts within the
+    byte range `[start, end)`.
+
+    """
+    with open(path, "rb") as f:
+        if start:
+            # Skip any partial line, which belongs to the previous range
+            f.seek(start - 1)
+            f.readline()
+        offset = f.tell()
+        while offset < end and (line := f.readline()):
+            yield offset, line
+            offset += len(line)
+
+
+class VerifyResult:
+    """The (mergeable) results of verifying some lines of a JSONL file."""
+
+    def __init__(self):
+        self.entries: collections.Counter[str] = collections.Counter()
+        self.header_lines = 0
+        self.bytes = 0
+        self.errors: collections.Counter[str] = collections.Counter()
+        self.warnings: collections.Counter[str] = collections.Counter()
+        self.error_samples: dict[str, list[dict[str, Any]]] = {}
+        self.ids: dict[str, list[str]] = {}
+        self.linked_references: set[str] = set()
+
+    def error(self, kind: str, offset: int, entry_id: str | None, message: str):
+        self.errors[kind] += 1
+        samples = self.error_samples.setdefault(kind, [])
+        if len(samples) < MAX_ERROR_SAMPLES:
+            samples.append({"offset": offset, "id": entry_id, "error": message})
+
+    def merge(self, other: VerifyResult) -> None:
+        self.entries.update(other.entries)
+        self.header_lines += other.header_lines
+        self.bytes += other.bytes
+        self.errors.update(other.errors)
+        self.warnings.update(other.warnings)
+        for kind, samples in other.error_samples.items():
+            merged = self.error_samples.setdefault(kind, [])
+            merged.extend(samples[: MAX_ERROR_SAMPLES - len(merged)])
+        for entry_type, ids in other.ids.items():
+            self.ids.setdefault(entry_type, []).extend(ids)
+        self.linked_references.update(other.linked_references)
+
+
+def _check_structure(attributes: dict[str, Any]) -> Iterator[tuple[str, str]]:
+    """Yield `(kind, message)` for any violated CSD-specific invariants."""
+    nsites = attributes.get("nsites")
+    positions = attributes.get("cartesian_site_positions")
+    species_at_sites = attributes.get("species_at_sites")
+    for field, values in (
+        ("cartesian_site_positions", positions),
+        ("species_at_sites", species_at_sites),
+    ):
+        if values is not None and len(values) != nsites:
+            yield "nsites", f"nsites={nsites} but {len(values)} {field}"
+
+    species = attributes.get("species") or []
+    names = {s["name"] for s in species}
+    if missing := set(species_at_sites or []) - names:
+        yield "species", f"species_at_sites {sorted(missing)} not defined in species"
+    elements = set(attributes.get("elements") or [])
+    symbols = {symbol for s in species for symbol in s["chemical_symbols"]}
+    if missing := symbols - elements - NON_ELEMENT_SYMBOLS:
+        yield "elements", f"species symbols {sorted(missing)} not in elements"
+
+
+def verify_lines(lines: Iterable[tuple[int, bytes]]) -> VerifyResult:
+    """Validate each `(offset, line)` of an OPTIMADE JSONL file, parsing any
+    MongoDB extended JSON (e.g., `{"$date": ...}`) as it is on insertion.
+
+    """
+    import bson.json_util
+    from optimade.models import ReferenceResource, StructureResource
+
+    models = {"structures": StructureResource, "references": ReferenceResource}
+    result = VerifyResult()
+
+    for offset, line in lines:
+        result.bytes += len(line)
+        if not line.strip():
+            continue
+        try:
+            entry = bson.json_util.loads(line)
+        except ValueError as exc:
+            result.error("json", offset, None, str(exc))
+            continue
+
+        entry_type = entry.get("type")
+        if "x-optimade" in entry or entry_type in (None, "info"):
+            result.header_lines += 1
+            continue
+        entry_id = entry.get("id")
+        if entry_type not in models:
+            result.error("type", offset, entry_id, f"Unknown type {entry_type!r}")
+            continue
+
+        result.entries[entry_type] += 1
+        result.ids.setdefault(entry_type, []).append(entry_id)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            try:
+                models[entry_type](**entry)
+            except Exception as exc:
+                result.error("validation", offset, entry_id, str(exc))
+        for warning in caught:
+            result.warnings[warning.category.__name__] += 1
+
+        if entry_type == "structures":
+            for kind, message in _check_structure(entry.get("attributes") or {}):
+                result.error(kind, offset, entry_id, message)
+            references = (entry.get("relationships") or {}).get("references") or {}
+            result.linked_references.update(
+                link["id"] for link in references.get("data") or []
+            )
+
+    return result
+
+
+def _verify_byte_range(args: tuple[Path, int, int]) -> VerifyResult:
+    return verify_lines(iter_byte_range(*args))
+
+
+def _iter_gzip_batches(path: Path) -> Iterator[list[tuple[int, bytes]]]:
+    with gzip.open(path, "rb") as f:
+        offset = 0
+        while batch := list(itertools.islice(f, GZIP_BATCH_SIZE)):
+            lines = []
+            for line in batch:
+                lines.append((offset, line))
+                offset += len(line)
+            yield lines
+
+
+def verify(path: Path, num_processes: int = 1) -> dict[str, Any]:
+    """Verify an OPTIMADE JSONL file (optionally gzip-compressed) in parallel,
+    returning a summary of the results.
+
+    """
+    from multiprocessing import Pool
+
+    start = time.perf_counter()
+    result = VerifyResult()
+
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    with gzip.open(path, "rb") if compressed else open(path, "rb") as f:
+        header = json.loads(f.readline() or b"{}")
+    if not header.get("x-optimade"):
+        result.error("header", 0, None, "First line is not an x-optimade header")
+
+    with Pool(num_processes) as pool:
+        if compressed:
+            results = pool.imap_unordered(verify_lines, _iter_gzip_batches(path))
+        else:
+            ranges = split_byte_ranges(path, num_processes * RANGES_PER_PROCESS)
+            results = pool.imap_unordered(
+                _verify_byte_range, [(path, *range_) for range_ in ranges]
+            )
+        for partial_result in results:
+            result.merge(partial_result)
+
+    for entry_type, ids in result.ids.items():
+        counts = collections.Counter(ids)
+        for entry_id, count in counts.items():
+            if count > 1:
+                result.error(
+                    "duplicate_id", -1, entry_id, f"{count} {entry_type} with this ID"
+                )
+    reference_ids = set(result.ids.get("references", []))
+    for entry_id in sorted(result.linked_references - reference_ids):
+        result.error("unresolved_reference", -1, entry_id, "Linked reference not found")
+
+    elapsed = time.perf_counter() - start
+    num_entries = sum(result.entries.values())
+    return {
+        "path": str(path),
+        "ok": not result.errors,
+        "entries": dict(sorted(result.entries.items())),
+        "header_lines": result.header_lines,
+        "errors": dict(sorted(result.errors.items())),
+        "warnings": dict(sorted(result.warnings.items())),
+        "error_samples": result.error_samples,
+        "elapsed": elapsed,
+        "entries_per_second": num_entries / elapsed if elapsed else 0.0,
+        "megabytes_per_second": result.bytes / 1024**2 / elapsed if elapsed else 0.0,
+        "num_processes": num_processes,
+    }
+
+
+def cli(argv: list[str] | None = None) -> int:
+    """Verify a finished `csd-ingest` artefact, returning a non-zero exit code
+    if any errors are found.
+
+    """
+    import psutil
+
+    parser = argparse.ArgumentParser(
+        prog="csd-ingest verify",
+        description="Validate a finished OPTIMADE JSONL file (optionally gzip-compressed) in parallel against the OPTIMADE models and CSD-specific invariants.",
+    )
+    parser.add_argument("path", type=Path, help="The JSONL file to verify.")
+    parser.add_argument(
+        "--num-processes",
+        type=int,
+        default=psutil.cpu_count(logical=False),
+        help="Number of processes to use (DEFAULT: all physical cores on machine).",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help="Also write the summary, including example errors, as JSON to this file.",
+    )
+    args = parser.parse_args(argv)
+
+    summary = verify(args.path, num_processes=args.num_processes)
+    if args.output:
+        args.output.write_text(json.dumps(summary, indent=2))
+
+    print(
+        f"Verified {summary['entries']} in {args.path} in {summary['elapsed']:.1f} s "
+        f"({summary['entries_per_second']:.0f} entries/s, {summary['megabytes_per_second']:.1f} MB/s, {args.num_processes} processes)"
+    )
+    if summary["warnings"]:
+        print(f"Warnings: {summary['warnings']}")
+    if summary["ok"]:
+        print("No errors found.")
+        return 0
+    print(f"Errors: {summary['errors']}")
+    for kind, samples in summary["error_samples"].items():
+        for sample in samples[:5]:
+            print(f"  {kind}: {sample}")
+    return 1
@@ -1,3 +1,11 @@
+import gzip
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
 import pytest
 
 
@@ -11,3 +19,153 @@ def csd_available():
         return True
     except (ImportError, Exception):
         return False
+
+
+@pytest.fixture(scope="session")
+def optimade_config():
+    """Set the optimade-python-tools config for a test server.
+
+    Uses an in-memory database unless `OPTIMAKE_MONGO_URI` is set. As the
+    config is loaded only once on first import, it is shared across the session.
+
+    """
+    from optimade_maker.serve import set_config_env_variables
+
+    from csd_optimade.fields import (
+        generate_csd_provider_fields,
+        generate_csd_provider_info,
+        generate_implementation_info,
+    )
+
+    config = dict(
+        database_backend="mongomock",
+        mongo_database="csd_optimade_test",
+        insert_test_data=False,
+        base_url="http://localhost:5000",
+        provider=generate_csd_provider_info(),
+        provider_fields=generate_csd_provider_fields(),
+        implementation=generate_implementation_info(),
+    )
+    if mongo_uri := os.getenv("OPTIMAKE_MONGO_URI"):
+        config["database_backend"] = "mongodb"
+        config["mongo_uri"] = mongo_uri
+
+    set_config_env_variables(config)
+
+    from optimade.server.config import CONFIG
+
+    return CONFIG
+
+
+@pytest.fixture(scope="session")
+def app(optimade_config):
+    """The CSD OPTIMADE API app."""
+    from csd_optimade.app import create_app
+
+    return create_app()
+
+
+@pytest.fixture(scope="session")
+def synthetic_structures():
+    from csd_optimade.synthetic import generate_synthetic_structures
+
+    return generate_synthetic_structures(num_entries=105)
+
+
+@pytest.fixture(scope="session")
+def entry_collections(app, synthetic_structures):
+    """The entry collections of the test app, populated with synthetic structures."""
+    from optimade.server.routers import ENTRY_COLLECTIONS
+
+    from .utils import to_database_format
+
+    ENTRY_COLLECTIONS["structures"].collection.drop()
+    ENTRY_COLLECTIONS["structures"].insert(
+        [to_database_format(entry) for entry in synthetic_structures]
+    )
+    ENTRY_COLLECTIONS["structures"].create_default_index()
+    return ENTRY_COLLECTIONS
+
+
+@pytest.fixture
+def csd_serve(tmp_path):
+    """Launch `csd-serve` in a subprocess on a synthetic JSONL file, yielding
+    a function that returns the base URL of the running API.
+
+    """
+    from csd_optimade.synthetic import write_synthetic_jsonl
+
+    from .utils import free_port, http_get
+
+    processes = []
+
+    def _launch(
+        *args,
+        num_entries: int = 50,
+        compressed_copy: bool = False,
+        source: str = "jsonl",
+    ) -> str:
+        """Launch the API, loading the data from the plain JSONL file
+        (`source="jsonl"`), its gzip-compressed copy (`"gz"`) or a
+        compressed stream on stdin (`"stdin"`), or pointing it at an empty
+        placeholder file (`"empty"`, for use with `--no-insert`).
+
+        """
+        jsonl_path = tmp_path / "synthetic-optimade.jsonl"
+        if source == "empty":
+            jsonl_path.touch()
+        else:
+            write_synthetic_jsonl(jsonl_path, num_entries=num_entries)
+        if compressed_copy or source in ("gz", "stdin"):
+            with open(jsonl_path, "rb") as f_in:
+                with gzip.open(f"{jsonl_path}.gz", "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+
+        path_arg = {
+            "jsonl": str(jsonl_path),
+            "empty": str(jsonl_path),
+            "gz": f"{jsonl_path}.gz",
+            "stdin": "-",
+        }
+        port = free_port()
+        with open(
+            f"{jsonl_path}.gz" if source == "stdin" else os.devnull, "rb"
+        ) as stdin:
+            process = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    # Skip the network check of the license URL when loading the config
+                    "import csd_optimade.serve as serve; serve.generate_license_link = lambda: ''; serve.cli()",
+                    path_arg[source],
+                    "--port",
+                    str(port),
+                    *args,
+                ],
+                stdin=stdin,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        processes.append(process)
+
+        base_url = f"http://127.0.0.1:{port}"
+        for _ in range(120):
+            if process.poll() is not None:
+                raise RuntimeError(f"csd-serve exited with {process.returncode}")
+            try:
+                http_get(f"{base_url}/v1/info")
+                break
+            except OSError:
+                time.sleep(0.5)
+        else:
+            raise RuntimeError("csd-serve did not start in time")
+
+        return base_url
+
+    yield _launch
+
+    for process in processes:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+        # uvicorn re-raises the signal after shutting down gracefully
+        assert process.returncode in (0, -signal.SIGTERM)
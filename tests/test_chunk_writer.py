@@ -0,0 +1,66 @@
+import gzip
+import json
+import os
+import time
+import warnings
+
+import pytest
+
+from csd_optimade.chunk_writer import ChunkWriter
+from csd_optimade.synthetic import generate_synthetic_structures
+
+
+@pytest.mark.parametrize("pipelined", [True, False])
+def test_chunk_writer(tmp_path, pipelined):
+    lines = [json.dumps(entry) for entry in generate_synthetic_structures(250)]
+    with ChunkWriter(
+        tmp_path / "chunk.jsonl", pipelined=pipelined, batch_size=7, queue_size=2
+    ) as writer:
+        for line in lines:
+            writer.write(line)
+
+    assert writer.path == tmp_path / "chunk.jsonl.gz"
+    assert not (tmp_path / "chunk.jsonl").exists()
+    with gzip.open(writer.path, "rt") as f:
+        assert f.read().splitlines() == lines
+    assert set(writer.stats) >= {"elapsed", "producer", "blocked", "writer"}
+    assert writer.stats["writer"] > 0
+    assert 0 < writer.stats["producer_utilisation"] <= 1
+
+
+def test_chunk_writer_failure(tmp_path):
+    writer = ChunkWriter(tmp_path / "missing" / "chunk.jsonl", batch_size=1)
+    with pytest.raises(RuntimeError, match="Writer thread"):
+        for _ in range(100):
+            writer.write("{}")
+        writer.close()
+
+
+def test_chunk_writer_benchmark(tmp_path):
+    """Compare writing a chunk of mapped entries with the writer thread and
+    sequentially (writing the plain chunk, then compressing it).
+
+    """
+    if not os.getenv("CSD_BENCHMARK") == "1":
+        pytest.skip("Skipping chunk writer benchmark as `CSD_BENCHMARK` unset.")
+
+    from optimade.models import StructureResource
+
+    entries = generate_synthetic_structures(20_000)
+    for entry in entries:
+        entry["attributes"]["last_modified"] = "2024-01-01T00:00:00Z"
+
+    timings = {}
+    warnings.simplefilter("ignore")
+    for pipelined in (False, True):
+        start = time.perf_counter()
+        with ChunkWriter(tmp_path / f"{pipelined}.jsonl", pipelined=pipelined) as w:
+            for entry in entries:
+                # Stand-in for mapping a CSD entry, which holds the GIL
+                resource = StructureResource(**entry)
+                w.write(resource.model_dump_json(exclude_unset=True, exclude_none=True))
+        timings[pipelined] = time.perf_counter() - start
+        print(
+            f"{'pipelined' if pipelined else 'sequential'}: {timings[pipelined]:.2f} s",
+            {k: round(v, 2) for k, v in w.stats.items()},
+        )
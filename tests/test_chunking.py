@@ -0,0 +1,147 @@
+import gzip
+import json
+import os
+from functools import partial
+
+import pytest
+
+from csd_optimade.chunking import (
+    INITIAL_CHUNK_SIZE,
+    MAX_CHUNK_SIZE,
+    MEMORY_SAFETY_FACTOR,
+    AdaptiveChunker,
+    ChunkStats,
+    run_chunks,
+)
+from csd_optimade.ingest import collect_chunk_files
+from csd_optimade.merge import combine_chunks
+
+GB = 1024**3
+
+
+def _simulate(chunker, base=0.4 * GB, per_entry=200 * 1024, seconds_per_entry=0.01):
+    """Run the chunker to completion against workers with a linear memory
+    profile, returning the dispatched ranges and the peak RSS of each.
+
+    """
+    ranges = []
+    peaks = []
+    while (range_ := chunker.next_range()) is not None:
+        peak = base + per_entry * len(range_)
+        ranges.append(range_)
+        peaks.append(peak)
+        chunker.record(
+            ChunkStats(
+                size=len(range_),
+                entries=len(range_),
+                start_rss=int(base),
+                peak_rss=int(peak),
+                elapsed=seconds_per_entry * len(range_),
+            )
+        )
+    return ranges, peaks
+
+
+def _assert_contiguous(ranges, start, end):
+    assert ranges[0].start == start
+    assert ranges[-1].stop == end
+    for previous, current in zip(ranges, ranges[1:]):
+        assert previous.stop == current.start
+
+
+def test_chunks_grow_within_memory_limit():
+    memory_limit = 16 * GB
+    chunker = AdaptiveChunker(0, 500_000, memory_limit=memory_limit, max_workers=4)
+    ranges, peaks = _simulate(chunker)
+
+    _assert_contiguous(ranges, 0, 500_000)
+    assert len(ranges[0]) == INITIAL_CHUNK_SIZE
+    assert max(len(r) for r in ranges) > 4 * INITIAL_CHUNK_SIZE
+    assert max(len(r) for r in ranges) <= MAX_CHUNK_SIZE
+    assert max(peaks) <= MEMORY_SAFETY_FACTOR * memory_limit / chunker.active_workers
+    assert chunker.active_workers == 4
+    assert chunker.throughput == pytest.approx(100)
+
+
+def test_workers_reduced_when_memory_is_tight():
+    # Each worker needs at least 0.4 GB + 500 entries * 1 MB
+    chunker = AdaptiveChunker(0, 20_000, memory_limit=3 * GB, max_workers=8)
+    ranges, peaks = _simulate(chunker, per_entry=1024**2)
+
+    _assert_contiguous(ranges, 0, 20_000)
+    assert chunker.active_workers < 8
+    assert max(peaks) * chunker.active_workers <= 3 * GB
+
+
+def test_fixed_chunk_size():
+    chunker = AdaptiveChunker(
+        100, 1_050, memory_limit=16 * GB, max_workers=2, chunk_size=100
+    )
+    ranges, _ = _simulate(chunker)
+    _assert_contiguous(ranges, 100, 1_050)
+    assert [len(r) for r in ranges] == [100] * 9 + [50]
+
+
+def test_open_ended_final_chunk():
+    chunker = AdaptiveChunker(
+        0, 1_050, memory_limit=16 * GB, max_workers=1, chunk_size=100, open_ended=True
+    )
+    ranges, _ = _simulate(chunker)
+    assert ranges[-1] == range(1_000, 1_100)
+
+
+def test_failed_chunks_are_retried_in_halves():
+    chunker = AdaptiveChunker(0, 10_000, memory_limit=16 * GB, max_workers=2)
+    first, second = chunker.next_range(), chunker.next_range()
+    per_entry = chunker.memory_per_entry
+
+    chunker.record_failure([second, first])
+    assert chunker.memory_per_entry == 2 * per_entry
+    assert chunker.next_range() == range(first.start, first.start + len(first) // 2)
+    assert chunker.next_range() == range(first.start + len(first) // 2, first.stop)
+    assert chunker.next_range().start == second.start
+
+    chunker.record_failure([range(5, 6)], pending=range(6, 7))
+    assert chunker.skipped == [5]
+    assert chunker.retries[-1] == range(6, 7)
+
+
+def _write_chunk(args, output_dir, fatal_index):
+    """Write a chunk of entries, dying part-way through the entry at
+    `fatal_index`, as a worker killed by the OOM killer would.
+
+    """
+    chunk_id, range_ = args
+    path = output_dir / f"test-optimade-{chunk_id}.jsonl.gz"
+    with gzip.open(path, "wt") as handle:
+        for index in range_:
+            if index == fatal_index:
+                handle.flush()
+                os._exit(1)
+            handle.write(json.dumps({"type": "structures", "id": str(index)}) + "\n")
+    return {"path": str(path), "index_range": [range_.start, range_.stop]}
+
+
+def test_worker_killed_on_single_entry(tmp_path):
+    chunker = AdaptiveChunker(0, 8, memory_limit=16 * GB, max_workers=1, chunk_size=4)
+    worker = partial(_write_chunk, output_dir=tmp_path, fatal_index=3)
+    chunks = [
+        chunk
+        for _, chunk in run_chunks(
+            chunker, worker, 1, available_memory=lambda: float("inf")
+        )
+    ]
+    assert chunker.skipped == [3]
+    # Every other index was ingested, once
+    ingested = [i for chunk in chunks for i in range(*chunk["index_range"])]
+    assert sorted(ingested) == [0, 1, 2, 4, 5, 6, 7]
+    # The failed chunk left a truncated file behind
+    assert (tmp_path / "test-optimade-3.jsonl.gz").exists()
+
+    chunk_files = collect_chunk_files(chunks, tmp_path, "test")
+    chunk_ids = [int(path.name.split("-")[-1].split(".")[0]) for path in chunk_files]
+    assert chunk_ids == sorted(chunk_ids)
+    assert set(tmp_path.iterdir()) == set(chunk_files)
+    assert not (tmp_path / "test-optimade-3.jsonl.gz").exists()
+    counts = combine_chunks(chunk_files, tmp_path / "test-optimade.jsonl", ["{}"])
+    assert counts == {"structures": 7}
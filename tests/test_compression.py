@@ -0,0 +1,241 @@
+import asyncio
+import gzip
+import threading
+import zlib
+
+import pytest
+
+from csd_optimade import compression
+from csd_optimade.compression import (
+    CompressionMiddleware,
+    EntryCache,
+    negotiate_encoding,
+    supported_encodings,
+)
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        ("", None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("gzip, deflate", "gzip"),
+        ("gzip;q=0", None),
+        ("*", supported_encodings()[0]),
+        ("*, gzip;q=0", "br" if "br" in supported_encodings() else None),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, expected):
+    assert negotiate_encoding(accept_encoding) == expected
+
+
+def test_entry_cache_eviction():
+    cache = EntryCache(max_bytes=10)
+    cache.put(("a",), 200, [], b"1234")
+    cache.put(("b",), 200, [], b"1234")
+    assert cache.get(("a",)) is not None
+    cache.put(("c",), 200, [], b"1234")
+    # "b" was the least recently used
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) is not None
+    assert cache.size == 8
+    cache.put(("d",), 200, [], b"x" * 11)
+    assert len(cache) == 2
+
+
+def _run(middleware, path, accept_encoding="gzip"):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": b"",
+        "headers": [(b"accept-encoding", accept_encoding.encode())],
+    }
+    asyncio.run(middleware(scope, None, send))
+    headers = dict(messages[0]["headers"])
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return messages[0]["status"], headers, body
+
+
+def _app(chunks, content_type=b"application/json", calls=None, status=200):
+    async def app(scope, receive, send):
+        if calls is not None:
+            calls.append(scope["path"])
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", content_type)],
+            }
+        )
+        for ind, chunk in enumerate(chunks):
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": ind < len(chunks) - 1,
+                }
+            )
+
+    return app
+
+
+def test_compression_middleware():
+    payload = b'{"data": [' + b", ".join([b"[0.1, 0.2, 0.3]"] * 1000) + b"]}"
+
+    status, headers, body = _run(CompressionMiddleware(_app([payload])), "/structures")
+    assert status == 200
+    assert headers[b"content-encoding"] == b"gzip"
+    assert headers[b"vary"] == b"Accept-Encoding"
+    assert int(headers[b"content-length"]) == len(body) < len(payload)
+    assert gzip.decompress(body) == payload
+
+    # Streamed
+    chunks = [payload[:5000], payload[5000:10000], payload[10000:]]
+    _, headers, body = _run(CompressionMiddleware(_app(chunks)), "/export")
+    assert headers[b"content-encoding"] == b"gzip"
+    assert b"content-length" not in headers
+    assert gzip.decompress(body) == payload
+
+    # Not accepted, too small or already compressed
+    _, headers, body = _run(CompressionMiddleware(_app([payload])), "/structures", "")
+    assert b"content-encoding" not in headers
+    assert body == payload
+    _, headers, body = _run(CompressionMiddleware(_app([b"{}"])), "/structures")
+    assert b"content-encoding" not in headers
+    assert body == b"{}"
+    _, headers, body = _run(
+        CompressionMiddleware(_app([payload], content_type=b"application/gzip")),
+        "/extensions/export",
+    )
+    assert b"content-encoding" not in headers
+    assert body == payload
+
+
+def test_compression_middleware_entry_cache():
+    payload = b'{"data": {"id": "a", "positions": ' + b"[0.1, 0.2, 0.3], " * 500 + b"}}"
+    calls: list[str] = []
+    middleware = CompressionMiddleware(
+        _app([payload], calls=calls), entry_cache=EntryCache(max_bytes=1024**2)
+    )
+
+    for _ in range(3):
+        _, headers, body = _run(middleware, "/v1/structures/a")
+        assert headers[b"content-encoding"] == b"gzip"
+        assert gzip.decompress(body) == payload
+    _, headers, body = _run(middleware, "/v1/structures/a", "")
+    assert b"content-encoding" not in headers
+    assert body == payload
+
+    # Compressed once per encoding, then served from the cache
+    assert calls == ["/v1/structures/a", "/v1/structures/a"]
+    assert middleware.entry_cache is not None
+    assert middleware.entry_cache.hits == 2
+
+    # Listings are not cached
+    _run(middleware, "/v1/structures")
+    _run(middleware, "/v1/structures")
+    assert len(calls) == 4
+
+
+def _gzip(data, level):
+    compressor = zlib.compressobj(level, wbits=31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def test_entry_cache_recompressed_in_background():
+    payload = b'{"data": {"id": "a", "positions": ' + b"[0.1, 0.2, 0.3], " * 500 + b"}}"
+    middleware = CompressionMiddleware(
+        _app([payload]), entry_cache=EntryCache(max_bytes=1024**2)
+    )
+
+    # A miss is compressed at the usual level...
+    _, headers, body = _run(middleware, "/v1/structures/a")
+    assert body == _gzip(payload, compression.GZIP_LEVEL)
+
+    # ...then swapped for the more compressed body once that is ready
+    assert middleware._recompressor is not None
+    middleware._recompressor.shutdown(wait=True)
+    _, headers, body = _run(middleware, "/v1/structures/a")
+    assert body == _gzip(payload, compression.CACHED_GZIP_LEVEL)
+    assert int(headers[b"content-length"]) == len(body)
+    assert headers[b"content-encoding"] == b"gzip"
+    assert middleware.entry_cache is not None
+    assert middleware.entry_cache.hits == 1
+    assert middleware.entry_cache.size == len(body)
+
+
+def test_entry_cache_only_successful_responses():
+    payload = b'{"errors": [' + b'{"detail": "Not found"}, ' * 100 + b"]}"
+    calls: list[str] = []
+    middleware = CompressionMiddleware(
+        _app([payload], calls=calls, status=404),
+        entry_cache=EntryCache(max_bytes=1024**2),
+    )
+    for _ in range(2):
+        status, _, body = _run(middleware, "/v1/structures/missing")
+        assert status == 404
+        assert body == _gzip(payload, compression.GZIP_LEVEL)
+    assert len(calls) == 2
+    assert middleware.entry_cache is not None
+    assert len(middleware.entry_cache) == 0
+    assert middleware._recompressor is None
+
+
+def test_compression_middleware_brotli():
+    brotli = pytest.importorskip("brotli")
+    payload = b'{"data": [' + b", ".join([b"[0.1, 0.2, 0.3]"] * 1000) + b"]}"
+
+    _, headers, body = _run(
+        CompressionMiddleware(_app([payload])), "/structures", "gzip, br"
+    )
+    assert headers[b"content-encoding"] == b"br"
+    assert brotli.decompress(body) == payload
+
+    chunks = [payload[:5000], payload[5000:]]
+    _, headers, body = _run(CompressionMiddleware(_app(chunks)), "/export", "br")
+    assert headers[b"content-encoding"] == b"br"
+    assert brotli.decompress(body) == payload
+
+    middleware = CompressionMiddleware(
+        _app([payload]), entry_cache=EntryCache(max_bytes=1024**2)
+    )
+    for _ in range(2):
+        _, headers, body = _run(middleware, "/v1/structures/a", "br")
+        assert headers[b"content-encoding"] == b"br"
+        assert brotli.decompress(body) == payload
+
+
+def test_large_bodies_compressed_in_thread(monkeypatch):
+    threads = set()
+    compressor = compression._compressor
+
+    def _recording_compressor(encoding, cached=False):
+        compress, flush = compressor(encoding, cached)
+
+        def _compress(data):
+            threads.add(threading.get_ident())
+            return compress(data)
+
+        return _compress, flush
+
+    monkeypatch.setattr(compression, "_compressor", _recording_compressor)
+    payload = b"[0.1, 0.2, 0.3], " * 10_000
+    assert len(payload) > compression.THREADED_COMPRESSION_SIZE
+
+    for chunks in ([payload], [payload, payload]):
+        threads.clear()
+        _, _, body = _run(CompressionMiddleware(_app(chunks)), "/structures")
+        assert gzip.decompress(body) == b"".join(chunks)
+        assert threads and threading.get_ident() not in threads
+
+    # Small bodies are compressed directly on the event loop
+    threads.clear()
+    _run(CompressionMiddleware(_app([payload[:2000]])), "/structures")
+    assert threads == {threading.get_ident()}
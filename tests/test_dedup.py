@@ -0,0 +1,79 @@
+import gzip
+import json
+import os
+import time
+
+import pytest
+
+from csd_optimade.dedup import DedupIndex
+from csd_optimade.merge import combine_chunks
+
+KEYS = [("structures", f"SYN{i:06d}") for i in range(500)] + [
+    ("references", f"ref-{i % 50}") for i in range(500)
+]
+
+
+@pytest.mark.parametrize("memory_limit", [10**9, 10_000, 1])
+def test_dedup_index(tmp_path, memory_limit):
+    with DedupIndex(memory_limit=memory_limit, tmp_dir=tmp_path) as seen:
+        added = [seen.add(*key) for key in KEYS]
+        assert seen.spilled == (memory_limit < 10**9)
+        assert sum(added) == 550
+        assert not any(seen.add(*key) for key in KEYS)
+        assert ("references", "ref-7") in seen
+        assert ("structures", "ref-7") not in seen
+        assert seen.counts == {"structures": 500, "references": 50}
+        assert len(seen) == 550
+    # The temporary on-disk index is removed on close
+    assert not list(tmp_path.iterdir())
+
+
+def test_persistent_dedup_index(tmp_path):
+    path = tmp_path / "seen.sqlite"
+    with DedupIndex(path) as seen:
+        assert all(seen.add(*key) for key in KEYS[:100])
+
+    with DedupIndex(path, memory_limit=1) as seen:
+        assert seen.counts == {"structures": 100}
+        assert KEYS[0] in seen
+        assert not seen.add(*KEYS[99])
+        assert seen.add(*KEYS[100])
+    assert path.exists()
+
+
+def test_combine_chunks_within_memory_limit(tmp_path):
+    chunk_paths = []
+    for chunk_id in range(4):
+        path = tmp_path / f"test-optimade-{chunk_id}.jsonl.gz"
+        with gzip.open(path, "wt") as f:
+            # Overlapping chunks, with a reference linked from every structure
+            for key in KEYS[chunk_id * 100 : chunk_id * 100 + 120] + KEYS[500:510]:
+                f.write(json.dumps({"type": key[0], "id": key[1]}) + "\n")
+        chunk_paths.append(path)
+
+    outputs = {}
+    for memory_limit in (10**9, 1000):
+        output = tmp_path / f"{memory_limit}.jsonl"
+        counts = combine_chunks(
+            chunk_paths, output, ["{}"], dedup_memory_limit=memory_limit
+        )
+        assert counts == {"references": 10, "structures": 420}
+        outputs[memory_limit] = output.read_text()
+    assert outputs[10**9] == outputs[1000]
+
+
+def test_dedup_index_benchmark(tmp_path):
+    """Compare the throughput of the in-memory and on-disk dedup index."""
+    if not os.getenv("CSD_BENCHMARK") == "1":
+        pytest.skip("Skipping dedup index benchmark as `CSD_BENCHMARK` unset.")
+
+    keys = [("structures", f"ABCDEF{i:07d}") for i in range(1_000_000)]
+    for memory_limit in (10**10, 1):
+        with DedupIndex(memory_limit=memory_limit, tmp_dir=tmp_path) as seen:
+            start = time.perf_counter()
+            for key in keys:
+                seen.add(*key)
+            elapsed = time.perf_counter() - start
+        print(
+            f"{'on-disk' if memory_limit == 1 else 'in-memory'}: {1e6 * elapsed / len(keys):.2f} us/id"
+        )
@@ -0,0 +1,131 @@
+import os
+import time
+
+import pytest
+
+
+def _params(**kwargs):
+    from optimade.server.query_params import EntryListingQueryParams
+
+    return EntryListingQueryParams(**kwargs)
+
+
+def test_keyset_pagination(entry_collections, synthetic_structures):
+    structures = entry_collections["structures"]
+    expected_ids = sorted(entry["id"] for entry in synthetic_structures)
+
+    ids: list[str] = []
+    query: dict[str, list[str]] = {}
+    while True:
+        params = _params(page_limit=10, **{k: v[0] for k, v in query.items()})
+        results, data_returned, more_data_available, _, _ = structures.find(params)
+        assert data_returned == len(expected_ids)
+        ids.extend(doc["id"] for doc in results)
+        if not more_data_available:
+            break
+        query = structures.get_next_query_params(params, results)
+        assert list(query) == ["page_above"]
+
+    assert ids == expected_ids
+
+
+def test_keyset_pagination_with_filter(entry_collections, synthetic_structures):
+    structures = entry_collections["structures"]
+    expected_ids = sorted(
+        entry["id"]
+        for entry in synthetic_structures
+        if "C" in entry["attributes"]["elements"]
+    )
+
+    params = _params(filter='elements HAS "C"', page_limit=5)
+    results, data_returned, more_data_available, _, _ = structures.find(params)
+    assert data_returned == len(expected_ids)
+    assert more_data_available
+    assert [doc["id"] for doc in results] == expected_ids[:5]
+
+    page_above = structures.get_next_query_params(params, results)["page_above"][0]
+    params = _params(filter='elements HAS "C"', page_limit=5, page_above=page_above)
+    results, data_returned, _, _, _ = structures.find(params)
+    assert data_returned == len(expected_ids)
+    assert [doc["id"] for doc in results] == expected_ids[5:10]
+
+
+def test_offset_pagination_fallback(entry_collections):
+    from optimade.exceptions import BadRequest
+
+    structures = entry_collections["structures"]
+
+    params = _params(page_limit=10, page_offset=20)
+    results, _, _, _, _ = structures.find(params)
+    assert structures.get_next_query_params(params, results) == {"page_offset": ["30"]}
+
+    params = _params(page_limit=10, sort="-nelements")
+    results, _, _, _, _ = structures.find(params)
+    assert "page_above" not in structures.get_next_query_params(params, results)
+
+    with pytest.raises(BadRequest):
+        structures.find(_params(sort="-nelements", page_above="SYN000010"))
+
+    # Rather than silently ignoring `page_above`
+    with pytest.raises(BadRequest, match="page_offset"):
+        structures.find(_params(page_offset=20, page_above="SYN000010"))
+    with pytest.raises(BadRequest, match="page_number"):
+        structures.find(_params(page_number=2, page_above="SYN000010"))
+
+
+def test_keyset_pagination_benchmark(optimade_config, app):
+    """Compare fetching the first and 10,000th page with offset and keyset pagination.
+
+    Only meaningful against a real MongoDB (set `OPTIMAKE_MONGO_URI`), as the
+    in-memory database has no indexes.
+
+    """
+    if not os.getenv("CSD_BENCHMARK") == "1":
+        pytest.skip("Skipping pagination benchmark as `CSD_BENCHMARK` unset.")
+
+    from optimade.models import StructureResource
+    from optimade.server.mappers import StructureMapper
+
+    from csd_optimade.entry_collections import CSDMongoCollection
+    from csd_optimade.synthetic import generate_synthetic_structures
+
+    from .utils import to_database_format
+
+    page_limit = 10
+    num_pages = 10_000
+    structures = CSDMongoCollection(
+        name="structures_benchmark",
+        resource_cls=StructureResource,
+        resource_mapper=StructureMapper,
+    )
+    structures.collection.drop()
+    structures.insert(
+        [
+            to_database_format(entry)
+            for entry in generate_synthetic_structures(page_limit * (num_pages + 1))
+        ]
+    )
+    structures.create_default_index()
+    # Synthetic ids are sequential, so the cursor for the last page is known in advance
+    cursor = f"SYN{page_limit * (num_pages - 1) - 1:06d}"
+
+    timings = {}
+    for label, params in (
+        ("page 1", _params(page_limit=page_limit)),
+        (
+            f"page {num_pages} (page_offset)",
+            _params(page_limit=page_limit, page_offset=page_limit * (num_pages - 1)),
+        ),
+        (
+            f"page {num_pages} (page_above)",
+            _params(page_limit=page_limit, page_above=cursor),
+        ),
+    ):
+        start = time.monotonic_ns()
+        results, _, _, _, _ = structures.find(params)
+        timings[label] = (time.monotonic_ns() - start) / 1e6
+        assert len(results) == page_limit
+
+    structures.collection.drop()
+    for label, elapsed in timings.items():
+        print(f"{label}: {elapsed:.1f} ms")
@@ -0,0 +1,90 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = (
+    "ccdc",
+    "fastapi",
+    "numpy",
+    "optimade.models",
+    "optimade_maker",
+    "pymongo",
+    "tqdm",
+    "uvicorn",
+)
+"""Modules that should only be imported on the code paths that need them."""
+
+STARTUP = {
+    "csd-ingest --help": "import sys; sys.argv = ['csd-ingest', '--help']; from csd_optimade.ingest import cli; cli()",
+    "csd-ingest merge --help": "import sys; sys.argv = ['csd-ingest', 'merge', '--help']; from csd_optimade.ingest import cli; cli()",
+    "csd-ingest verify --help": "import sys; sys.argv = ['csd-ingest', 'verify', '--help']; from csd_optimade.ingest import cli; cli()",
+    "csd-serve --help": "import sys; sys.argv = ['csd-serve', '--help']; from csd_optimade.serve import cli; cli()",
+    "csd-loadtest --help": "import sys; sys.argv = ['csd-loadtest', '--help']; from csd_optimade.loadtest import cli; cli()",
+}
+"""Code run on startup by each entry point, up to argument parsing."""
+
+WORKER = "from csd_optimade.ingest import handle_chunk; import csd_optimade.mappers, csd_optimade.chunk_writer, csd_optimade.stats, optimade.models"
+"""The imports of an ingest worker spawned afresh (i.e., not forked), without
+the CSD Python API, which is not available here.
+
+"""
+
+
+def import_times(code: str) -> dict[str, tuple[int, int]]:
+    """Run the code in a fresh interpreter with `-X importtime`, returning the
+    cumulative import time (in microseconds) and nesting depth of each module
+    imported.
+
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    assert result.returncode == 0, result.stderr
+    times: dict[str, tuple[int, int]] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        times[name.strip()] = (int(cumulative), depth)
+    return times
+
+
+@pytest.mark.parametrize("entry_point", list(STARTUP))
+def test_cli_startup_is_lazy(entry_point):
+    modules = import_times(STARTUP[entry_point])
+    assert "csd_optimade" in modules
+    heavy = {
+        module
+        for module in modules
+        for prefix in HEAVY_MODULES
+        if module == prefix or module.startswith(f"{prefix}.")
+    }
+    assert not heavy, f"{entry_point} imports {sorted(heavy)}"
+
+
+def test_import_time_benchmark():
+    """Report the import time of each entry point (up to argument parsing) and
+    of a spawned ingest worker, and the heaviest imports of each.
+
+    """
+    if not os.getenv("CSD_BENCHMARK") == "1":
+        pytest.skip("Skipping import time benchmark as `CSD_BENCHMARK` unset.")
+
+    for name, code in {**STARTUP, "ingest worker": WORKER}.items():
+        # Only count the top-level imports, which include their nested imports
+        times = {
+            module: us
+            for module, (us, depth) in import_times(code).items()
+            if depth == 0
+        }
+        heaviest = sorted(times.items(), key=lambda item: -item[1])[:5]
+        print(
+            f"{name}: {sum(times.values()) / 1e3:.0f} ms",
+            ", ".join(f"{module} {us / 1e3:.0f} ms" for module, us in heaviest),
+        )
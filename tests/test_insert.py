@@ -0,0 +1,106 @@
+import gzip
+import io
+import shutil
+import sys
+
+import pytest
+
+from csd_optimade.synthetic import write_synthetic_jsonl
+
+
+@pytest.fixture
+def collections(app, monkeypatch):
+    """Swap fresh, empty structures and references collections into the app."""
+    from optimade.models import ReferenceResource, StructureResource
+    from optimade.server.mappers import ReferenceMapper, StructureMapper
+    from optimade.server.routers import ENTRY_COLLECTIONS
+
+    from csd_optimade.entry_collections import CSDMongoCollection
+
+    collections = {
+        "structures": CSDMongoCollection(
+            name="structures_insert_test",
+            resource_cls=StructureResource,
+            resource_mapper=StructureMapper,
+        ),
+        "references": CSDMongoCollection(
+            name="references_insert_test",
+            resource_cls=ReferenceResource,
+            resource_mapper=ReferenceMapper,
+        ),
+    }
+    for entry_type, collection in collections.items():
+        collection.collection.drop()
+        monkeypatch.setitem(ENTRY_COLLECTIONS, entry_type, collection)
+    yield collections
+    for collection in collections.values():
+        collection.collection.drop()
+
+
+@pytest.fixture
+def structures_collection(collections):
+    return collections["structures"]
+
+
+@pytest.fixture
+def jsonl_path(tmp_path):
+    path = tmp_path / "synthetic-optimade.jsonl"
+    write_synthetic_jsonl(path, num_entries=250)
+    with open(path, "rb") as f_in, gzip.open(f"{path}.gz", "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    return path
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_insert_from_jsonl_stream(structures_collection, jsonl_path, compressed):
+    from csd_optimade.insert import insert_from_jsonl_stream
+
+    path = f"{jsonl_path}.gz" if compressed else jsonl_path
+    assert insert_from_jsonl_stream(path, batch_size=32) == 250
+    assert len(structures_collection) == 250
+    doc = structures_collection.collection.find_one({"id": "SYN000123"})
+    assert doc["nsites"] == len(doc["cartesian_site_positions"])
+    assert doc["_csd_deposition_date"].year >= 1970
+
+
+def test_insert_from_stdin(structures_collection, jsonl_path, monkeypatch):
+    from csd_optimade.insert import insert_from_jsonl_stream
+
+    with open(f"{jsonl_path}.gz", "rb") as f:
+        stdin = io.TextIOWrapper(io.BufferedReader(io.BytesIO(f.read())))
+    monkeypatch.setattr(sys, "stdin", stdin)
+    assert insert_from_jsonl_stream("-", batch_size=100) == 250
+    assert len(structures_collection) == 250
+
+
+def test_insert_errors(structures_collection, jsonl_path, tmp_path, monkeypatch):
+    from csd_optimade.insert import insert_from_jsonl_stream
+
+    bad_path = tmp_path / "bad.jsonl"
+    bad_path.write_text('{"id": "SYN000000"}\n')
+    with pytest.raises(ValueError, match="x-optimade"):
+        insert_from_jsonl_stream(bad_path)
+
+    def _insert(_):
+        raise RuntimeError("Database unavailable")
+
+    monkeypatch.setattr(structures_collection, "insert", _insert)
+    with pytest.raises(RuntimeError, match="'write' stage") as exc_info:
+        insert_from_jsonl_stream(jsonl_path, batch_size=10)
+    assert "Database unavailable" in str(exc_info.value.__cause__)
+
+
+def test_insert_from_manifest(collections, tmp_path):
+    from csd_optimade.insert import insert_from_manifest
+    from csd_optimade.shards import write_shards
+
+    from .test_shards import HEADERS, _write_chunks
+
+    chunk_paths, structure_ids = _write_chunks(tmp_path)
+    manifest_path = write_shards(chunk_paths, tmp_path / "output", "test", 3, HEADERS)
+
+    assert (
+        insert_from_manifest(manifest_path, max_workers=1) == len(structure_ids) + 100
+    )
+    assert len(collections["structures"]) == len(structure_ids)
+    assert len(collections["references"]) == 100
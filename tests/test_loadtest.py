@@ -0,0 +1,115 @@
+import json
+import random
+import sys
+import urllib.parse
+
+import pytest
+
+from csd_optimade import loadtest
+from csd_optimade.loadtest import (
+    DEFAULT_MIX,
+    generate_queries,
+    launch_server,
+    percentile,
+    run_load,
+    sample_entries,
+)
+from csd_optimade.synthetic import generate_synthetic_structures
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 95) == 95.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([3.0], 99) == 3.0
+
+
+def test_generate_queries():
+    sample = generate_synthetic_structures(20)
+    queries = generate_queries(sample, random.Random(0), num_queries=50)
+    assert set(queries) == set(DEFAULT_MIX)
+    for name, paths in queries.items():
+        assert len(paths) == 50, name
+
+    assert all(
+        path.startswith("/structures?")
+        and "filter" in urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        for name in ("elements", "formula", "space_group", "csd_range")
+        for path in queries[name]
+    )
+    assert queries["id_lookup"][0].startswith("/structures/SYN")
+    assert "page_above=SYN" in queries["deep_pagination"][0]
+
+
+def test_run_load(csd_serve):
+    base_url = csd_serve(num_entries=50)
+    sample = sample_entries(base_url, sample_size=30, rng=random.Random(0))
+    assert len(sample) == 30
+
+    queries = generate_queries(sample, random.Random(0))
+    report = run_load(base_url, queries, DEFAULT_MIX, concurrency=4, duration=2)
+    json.dumps(report)
+
+    assert set(report["classes"]) == set(DEFAULT_MIX)
+    assert report["overall"]["errors"] == 0, report
+    assert report["overall"]["requests"] > 0
+    for stats in report["classes"].values():
+        latency = stats["latency_ms"]
+        if stats["requests"]:
+            assert latency["p50"] <= latency["p95"] <= latency["p99"] <= latency["max"]
+
+
+def test_cli_against_url(csd_serve, tmp_path, monkeypatch, capsys):
+    from csd_optimade.loadtest import cli
+
+    base_url = csd_serve(num_entries=20)
+    output = tmp_path / "report.json"
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "csd-loadtest",
+            "--url",
+            base_url,
+            "--duration",
+            "1",
+            "--concurrency",
+            "2",
+            "--mix",
+            "elements=1,id_lookup=2",
+            "--output",
+            str(output),
+        ],
+    )
+    cli()
+
+    report = json.loads(output.read_text())
+    assert set(report["classes"]) == {"elements", "id_lookup"}
+    assert report["config"]["mix"] == {"elements": 1.0, "id_lookup": 2.0}
+    assert "p99" in capsys.readouterr().out
+
+
+def test_launch_server_drop_first(tmp_path, monkeypatch):
+    launched = []
+
+    class _ExitedProcess:
+        returncode = 1
+
+        def __init__(self, args):
+            launched.append(args)
+
+        def poll(self):
+            return self.returncode
+
+    monkeypatch.setattr(loadtest.subprocess, "Popen", _ExitedProcess)
+    uri = "mongodb://localhost:27017/csd_optimade"
+    for drop_first in (False, True):
+        with pytest.raises(RuntimeError):
+            launch_server(
+                tmp_path / "data.jsonl", 5001, mongo_uri=uri, drop_first=drop_first
+            )
+
+    # The existing database is only dropped if requested
+    assert "--mongo-uri" in launched[0] and "--drop-first" not in launched[0]
+    assert "--drop-first" in launched[1]
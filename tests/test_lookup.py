@@ -0,0 +1,146 @@
+import json
+
+import pytest
+
+from csd_optimade import lookup
+from csd_optimade.lookup import (
+    LookupIndex,
+    build_lookup_index,
+    find_lookup_index,
+    lookup_path,
+    rewrite_filter,
+)
+from csd_optimade.synthetic import generate_synthetic_structures
+
+INCHI_KEY = "BSYNRYMUTXBXSQ-UHFFFAOYSA-N"
+
+
+@pytest.fixture
+def lookup_index(tmp_path):
+    structures = generate_synthetic_structures(20)
+    structures[0]["attributes"]["_csd_inchi_key"] = [INCHI_KEY]
+    structures[1]["attributes"]["_csd_inchi_key"] = [
+        "BSYNRYMUTXBXSQ-UHFFFAOYSA-M",
+        "XLYOFNOQVPJJNP-UHFFFAOYSA-N",
+    ]
+    path = tmp_path / "test-optimade.jsonl"
+    with open(path, "w") as f:
+        f.write(json.dumps({"x-optimade": {"meta": {"api_version": "1.1.0"}}}) + "\n")
+        for entry in structures:
+            f.write(json.dumps(entry) + "\n")
+    build_lookup_index([path], lookup_path(tmp_path, "test"))
+    return LookupIndex(lookup_path(tmp_path, "test")), structures
+
+
+def test_lookup_index(lookup_index):
+    index, structures = lookup_index
+    assert index.num_structures == 20
+    assert index.get("_csd_inchi_key", [INCHI_KEY]) == [structures[0]["id"]]
+    assert index.get("_csd_inchi_key_first_block", [INCHI_KEY[:14]]) == sorted(
+        [structures[0]["id"], structures[1]["id"]]
+    )
+    assert index.get("_csd_ccdc_number", ["100005"]) == [structures[5]["id"]]
+    assert index.get("_csd_ccdc_number", ["1"]) == []
+    formula = structures[3]["attributes"]["chemical_formula_reduced"]
+    assert index.get("chemical_formula_reduced", [formula]) == sorted(
+        s["id"]
+        for s in structures
+        if s["attributes"]["chemical_formula_reduced"] == formula
+    )
+
+
+def test_find_lookup_index(tmp_path):
+    path = lookup_path(tmp_path, "run")
+    assert find_lookup_index(tmp_path / "run-optimade.jsonl") is None
+    path.touch()
+    for artefact in ("run-optimade.jsonl", "run-optimade.jsonl.gz"):
+        assert find_lookup_index(tmp_path / artefact) == path
+    assert find_lookup_index(tmp_path / "run-optimade-manifest.json") == path
+
+
+def test_configure_stale_lookup_index(lookup_index, caplog):
+    index, structures = lookup_index
+    try:
+        lookup.configure_lookup_index(index.path, num_structures=len(structures))
+        assert lookup.LOOKUP_INDEX is not None
+
+        lookup.configure_lookup_index(index.path, num_structures=len(structures) + 1)
+        assert lookup.LOOKUP_INDEX is None
+        assert "Ignoring the lookup index" in caplog.text
+    finally:
+        lookup.configure_lookup_index(None)
+
+
+def test_rewrite_filter(lookup_index):
+    index, structures = lookup_index
+    first, second = structures[0]["id"], structures[1]["id"]
+
+    assert rewrite_filter({"_csd_inchi_key": {"$in": [INCHI_KEY]}}, index) == {
+        "id": {"$in": [first]}
+    }
+    assert rewrite_filter(
+        {"_csd_inchi_key": {"$regex": f"^{INCHI_KEY[:14]}"}}, index
+    ) == {"id": {"$in": sorted([first, second])}}
+    assert rewrite_filter({"_csd_ccdc_number": {"$eq": 100_000}}, index) == {
+        "id": {"$in": [first]}
+    }
+
+    # Nested conditions are rewritten, others are left alone
+    assert rewrite_filter(
+        {
+            "$and": [
+                {"nelements": {"$gt": 1}},
+                {
+                    "$or": [
+                        {"_csd_ccdc_number": {"$eq": 100_001}},
+                        {"_csd_ccdc_number": {"$gt": 100_010}},
+                    ]
+                },
+            ]
+        },
+        index,
+    ) == {
+        "$and": [
+            {"nelements": {"$gt": 1}},
+            {
+                "$or": [
+                    {"id": {"$in": [second]}},
+                    {"_csd_ccdc_number": {"$gt": 100_010}},
+                ]
+            },
+        ]
+    }
+    unchanged = {"_csd_inchi_key": {"$regex": "^BSYN.*"}}
+    assert rewrite_filter(unchanged, index) == unchanged
+
+
+def test_lookup_matches_database_query(
+    entry_collections, synthetic_structures, tmp_path
+):
+    from optimade.server.query_params import EntryListingQueryParams
+
+    path = tmp_path / "synthetic-optimade.jsonl"
+    with open(path, "w") as f:
+        for entry in synthetic_structures:
+            f.write(json.dumps(entry) + "\n")
+    build_lookup_index([path], lookup_path(tmp_path, "synthetic"))
+
+    formula = synthetic_structures[7]["attributes"]["chemical_formula_reduced"]
+    filters = [
+        "_csd_ccdc_number=100042",
+        f'chemical_formula_reduced="{formula}"',
+        f'chemical_formula_reduced="{formula}" AND nelements>=1',
+        f'_csd_ccdc_number=100001 OR chemical_formula_reduced="{formula}"',
+    ]
+    structures = entry_collections["structures"]
+    for filter_ in filters:
+        params = EntryListingQueryParams(filter=filter_, page_limit=100)
+        expected, *_ = structures.find(params)
+        lookup.configure_lookup_index(lookup_path(tmp_path, "synthetic"))
+        try:
+            assert "$in" in str(structures.handle_query_params(params)["filter"])
+            results, *_ = structures.find(params)
+        finally:
+            lookup.configure_lookup_index(None)
+        assert expected
+        assert [r["id"] for r in results] == [r["id"] for r in expected]
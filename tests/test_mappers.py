@@ -2,13 +2,14 @@ import os
 import time
 import traceback
 import warnings
+from types import SimpleNamespace
 from typing import TYPE_CHECKING
 
 import numpy as np
 import pytest
 from optimade.adapters.structures.utils import cellpar_to_cell
 
-from csd_optimade.mappers import _reduce_csd_formula
+from csd_optimade.mappers import _get_reference_id, _reduce_csd_formula
 
 from .utils import generate_same_random_csd_entries
 
@@ -161,3 +162,24 @@ def test_reduce_formula():
     jatfet01 = "C65 H45 Au2 N3 O1,C35 H40 N3 Pt1 1+,B1 F4 1-"
     with pytest.raises(ValueError, match="multi-component"):
         _reduce_csd_formula(jatfet01)
+
+
+def test_reference_ids_are_deterministic():
+    def citation(**kwargs):
+        fields = dict(
+            authors="A.B.Smith, C.Jones",
+            year=1999,
+            journal=SimpleNamespace(full_name="Acta Crystallographica"),
+            volume="55",
+            first_page="123",
+            doi=None,
+        )
+        fields.update(kwargs)
+        return SimpleNamespace(**fields)
+
+    _id = _get_reference_id(citation())
+    assert _id.startswith("Smith1999-")
+    assert _id == _get_reference_id(citation())
+    assert _id != _get_reference_id(citation(first_page="124"))
+    assert _id != _get_reference_id(citation(volume="56"))
+    assert _get_reference_id(citation(doi="10.1000/xyz")) == "10.1000/xyz"
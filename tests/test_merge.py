@@ -0,0 +1,137 @@
+import argparse
+import gzip
+import json
+
+import pytest
+
+from csd_optimade.merge import (
+    cli,
+    node_dir,
+    node_index_range,
+    parse_shard,
+    read_node_manifests,
+    read_node_stats,
+    write_node_manifest,
+)
+from csd_optimade.synthetic import generate_synthetic_structures
+
+
+def test_parse_shard():
+    assert parse_shard("0/1") == (0, 1)
+    assert parse_shard("3/4") == (3, 4)
+    for bad in ("4/4", "-1/4", "1/0", "1", "a/b"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(bad)
+
+
+@pytest.mark.parametrize("num_nodes", [1, 3, 7])
+def test_node_index_ranges(num_nodes):
+    num_structures = 1_290_000
+    ranges = [node_index_range(i, num_nodes, num_structures) for i in range(num_nodes)]
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] is None
+    # Contiguous and disjoint
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+
+
+def _write_node_outputs(tmp_path, num_nodes=3, num_structures=90, chunk_size=10):
+    """Write the chunks and manifests that `csd-ingest --shard i/N` would
+    produce for synthetic structures, where the last chunk of each node
+    overlaps with the next node to create duplicates.
+
+    """
+    structures = generate_synthetic_structures(num_structures)
+    node_dirs = []
+    for node in range(num_nodes):
+        start, end = node_index_range(node, num_nodes, num_structures)
+        end = end or num_structures
+        directory = node_dir(tmp_path, "test", node, num_nodes)
+        directory.mkdir()
+        chunks = []
+        for chunk_id, chunk_start in enumerate(range(start, end, chunk_size)):
+            chunk_end = min(chunk_start + chunk_size, end)
+            path = directory / f"test-optimade-{chunk_id}.jsonl.gz"
+            with gzip.open(path, "wt") as f:
+                for entry in structures[chunk_start : chunk_end + 1]:
+                    f.write(json.dumps(entry) + "\n")
+            chunks.append(
+                {
+                    "path": str(path),
+                    "index_range": [chunk_start, chunk_end],
+                    "entries": chunk_end - chunk_start,
+                    "bad_entries": 0,
+                }
+            )
+        write_node_manifest(
+            directory,
+            "test",
+            node,
+            num_nodes,
+            node_index_range(node, num_nodes, num_structures),
+            chunks,
+        )
+        node_dirs.append(directory)
+    return node_dirs, [entry["id"] for entry in structures]
+
+
+def test_merge(tmp_path, capsys):
+    node_dirs, ids = _write_node_outputs(tmp_path)
+    output_dir = tmp_path / "output"
+    # Nodes can be given in any order
+    cli(
+        [
+            *map(str, reversed(node_dirs)),
+            "--run-name",
+            "test",
+            "--output-dir",
+            str(output_dir),
+        ]
+    )
+
+    lines = (output_dir / "test-optimade.jsonl").read_text().splitlines()
+    assert "x-optimade" in json.loads(lines[0])
+    assert json.loads(lines[1])["data"]["attributes"]["api_version"]
+    entries = [json.loads(line) for line in lines[4:]]
+    assert [entry["id"] for entry in entries] == ids
+
+    # Without facet counts in the node manifests, they are counted from the output
+    assert read_node_stats(node_dirs) is None
+    stats = json.loads((output_dir / "test-optimade-stats.json").read_text())
+    assert stats["entries"] == {"structures": len(ids)}
+    assert sum(stats["facets"]["nelements"].values()) == len(ids)
+
+
+def test_merge_sharded(tmp_path):
+    from csd_optimade.shards import read_manifest
+
+    node_dirs, ids = _write_node_outputs(tmp_path)
+    output_dir = tmp_path / "output"
+    cli(
+        [
+            *map(str, node_dirs),
+            "--run-name",
+            "test",
+            "--output-dir",
+            str(output_dir),
+            "--num-shards",
+            "4",
+            "--num-processes",
+            "2",
+        ]
+    )
+    manifest = read_manifest(output_dir / "test-optimade-manifest.json")
+    assert manifest["entries"] == {"structures": len(ids)}
+
+
+def test_merge_errors(tmp_path):
+    node_dirs, _ = _write_node_outputs(tmp_path)
+
+    with pytest.raises(ValueError, match=r"missing nodes \[1\]"):
+        read_node_manifests([node_dirs[0], node_dirs[2]])
+
+    chunk_path = next(node_dirs[1].glob("*.jsonl.gz"))
+    chunk_path.write_bytes(chunk_path.read_bytes()[:-10])
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        read_node_manifests(node_dirs)
+    assert len(read_node_manifests(node_dirs, verify=False)) == 9
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import logging
+import os
+
+from csd_optimade import metrics
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram("test_seconds", "A test histogram.", ("stage",))
+    histogram.observe(("a",), 0.003)
+    histogram.observe(("a",), 0.3)
+    histogram.observe(("a",), 100.0)
+
+    lines = histogram.render()
+    assert lines[:2] == [
+        "# HELP test_seconds A test histogram.",
+        "# TYPE test_seconds histogram",
+    ]
+    assert 'test_seconds_bucket{stage="a",le="0.001"} 0' in lines
+    assert 'test_seconds_bucket{stage="a",le="0.005"} 1' in lines
+    assert 'test_seconds_bucket{stage="a",le="0.5"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+    assert 'test_seconds_sum{stage="a"} 100.303' in lines
+
+
+def test_request_timing_middleware(tmp_path):
+    async def structures(scope, receive, send):
+        metrics.record_stage("filter_parse", 0.01)
+        metrics.record_stage("database_query", 0.2)
+        metrics.record_explain({"n_returned": 1})
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    async def send(message):
+        pass
+
+    log_path = tmp_path / "slow.jsonl"
+    metrics.configure_slow_query_log(threshold=0.0, log_path=log_path)
+    try:
+        middleware = metrics.RequestTimingMiddleware(structures)
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/v1/structures",
+            "query_string": b"filter=nelements=2",
+            "endpoint": structures,
+        }
+        asyncio.run(middleware(scope, None, send))
+    finally:
+        metrics.configure_slow_query_log(threshold=1.0)
+        metrics.SLOW_QUERY_LOG.handlers[0].close()
+        metrics.SLOW_QUERY_LOG.handlers = [logging.StreamHandler()]
+
+    rendered = metrics.render_metrics()
+    assert (
+        'csd_optimade_request_stage_seconds_bucket{endpoint="structures",stage="database_query",le="0.25"} 1'
+        in rendered
+    )
+    assert (
+        'csd_optimade_request_stage_seconds_bucket{endpoint="structures",stage="filter_parse",le="0.005"} 0'
+        in rendered
+    )
+
+    record = json.loads(log_path.read_text().splitlines()[-1])
+    assert record["path"] == "/v1/structures"
+    assert record["query"] == "filter=nelements=2"
+    assert record["status"] == 200
+    assert record["seconds"]["database_query"] == 0.2
+    assert record["explain"] == [{"n_returned": 1}]
+
+
+def test_metrics_merged_across_workers(tmp_path, monkeypatch):
+    histogram = metrics.Histogram("test_seconds", "A test histogram.", ("stage",))
+    histogram.observe(("a",), 0.003)
+    other = metrics.Histogram("test_seconds", "A test histogram.", ("stage",))
+    other.observe(("a",), 0.3)
+    other.observe(("b",), 0.3)
+    lines = histogram.render(
+        [other.snapshot(), json.loads(json.dumps(other.snapshot()))]
+    )
+    assert 'test_seconds_bucket{stage="a",le="0.005"} 1' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+    assert 'test_seconds_count{stage="b"} 2' in lines
+
+    # Snapshots written by other workers are merged into this one's metrics
+    monkeypatch.setattr(metrics, "REQUEST_STAGE_SECONDS", histogram)
+    metrics.configure_metrics_dir(tmp_path)
+    try:
+        metrics.write_snapshot()
+        assert (tmp_path / f"{os.getpid()}.json").exists()
+        (tmp_path / "1.json").write_text(json.dumps({"test_seconds": other.snapshot()}))
+        (tmp_path / "2.json").write_text("{")
+        rendered = metrics.render_metrics()
+    finally:
+        metrics.configure_metrics_dir(None)
+    assert 'test_seconds_count{stage="a"} 2' in rendered
+    assert 'test_seconds_count{stage="b"} 1' in rendered
+
+
+def test_explain_sampling():
+    try:
+        # Every slow query is explained by default
+        metrics.configure_slow_query_log(threshold=1.0)
+        assert metrics.should_explain(2.0)
+        assert not metrics.should_explain(0.5)
+        metrics.configure_slow_query_log(threshold=1.0, explain_sample_rate=0.0)
+        assert not metrics.should_explain(2.0)
+    finally:
+        metrics.configure_slow_query_log(threshold=1.0)
@@ -0,0 +1,220 @@
+import gzip
+import json
+import subprocess
+import sys
+import time
+import urllib.parse
+
+import pytest
+
+from .utils import free_port, get_json, http_get
+
+
+def test_serve_multiple_workers(csd_serve):
+    base_url = csd_serve("--workers", "3", num_entries=50)
+    for _ in range(10):
+        response = get_json(f"{base_url}/v1/structures?page_limit=5")
+        assert response["meta"]["data_returned"] == 50
+        assert response["meta"]["data_available"] == 50
+        assert len(response["data"]) == 5
+    assert get_json(f"{base_url}/v1/structures/SYN000007")["data"]["id"] == "SYN000007"
+
+
+def test_export_from_disk(csd_serve, tmp_path):
+    base_url = csd_serve(num_entries=20, compressed_copy=True)
+    with open(tmp_path / "synthetic-optimade.jsonl.gz", "rb") as f:
+        expected = f.read()
+
+    status, headers, body = http_get(f"{base_url}/v1/extensions/export")
+    assert status == 200
+    assert headers["content-type"] == "application/gzip"
+    assert body == expected
+
+    status, _, body = http_get(
+        f"{base_url}/v1/extensions/export", headers={"Range": "bytes=10-109"}
+    )
+    assert status == 206
+    assert body == expected[10:110]
+
+
+def test_export_from_plain_jsonl(csd_serve, tmp_path):
+    base_url = csd_serve(num_entries=20)
+    assert not (tmp_path / "synthetic-optimade.jsonl.gz").exists()
+
+    status, headers, body = http_get(f"{base_url}/v1/extensions/export")
+    assert status == 200
+    assert headers["content-type"] == "application/gzip"
+    assert gzip.decompress(body) == (tmp_path / "synthetic-optimade.jsonl").read_bytes()
+
+
+def test_export_not_inserted_from_disk(csd_serve, tmp_path):
+    # Data streamed from stdin is exported from the database
+    base_url = csd_serve(num_entries=20, source="stdin")
+    _, _, body = http_get(f"{base_url}/v1/extensions/export")
+    lines = gzip.decompress(body).decode("utf-8").splitlines()
+    assert len([line for line in lines if '"type":"structures"' in line]) == 20
+
+    # With `--no-insert`, the placeholder file is not served either
+    base_url = csd_serve("--no-insert", source="empty")
+    _, _, body = http_get(f"{base_url}/v1/extensions/export")
+    lines = gzip.decompress(body).decode("utf-8").splitlines()
+    assert lines and not any('"type":"structures"' in line for line in lines)
+
+
+def test_export_lines_match_ingest():
+    import bson.json_util
+
+    from csd_optimade.export import to_jsonl_line
+    from csd_optimade.insert import _to_database_format
+
+    # As written by `csd-ingest`, i.e., by pydantic from the mapped resource
+    line = (
+        '{"id":"ABCDEF","type":"structures","attributes":{"last_modified":"2025-01-01T00:00:00",'
+        '"_csd_deposition_date":{"$date":"2001-02-03T00:00:00"},"nelements":2}}'
+    )
+    _, doc = _to_database_format(bson.json_util.loads(line))
+    entry = {"id": doc.pop("id"), "type": "structures", "attributes": doc}
+    assert to_jsonl_line(entry) == line
+
+
+def test_export_filtered(csd_serve):
+    from csd_optimade.synthetic import generate_synthetic_structures
+
+    base_url = csd_serve(num_entries=60)
+    expected_ids = {
+        entry["id"]
+        for entry in generate_synthetic_structures(60)
+        if "C" in entry["attributes"]["elements"]
+    }
+
+    query = urllib.parse.urlencode({"filter": 'elements HAS "C"'})
+    status, headers, body = http_get(f"{base_url}/v1/extensions/export?{query}")
+    assert status == 200
+    assert headers["content-type"] == "application/gzip"
+
+    lines = gzip.decompress(body).decode("utf-8").splitlines()
+    assert "x-optimade" in json.loads(lines[0])
+    entries = [json.loads(line) for line in lines[4:]]
+    assert {entry["id"] for entry in entries} == expected_ids
+    # Dates are written as extended JSON, as in the JSONL file that was loaded
+    assert all("$date" in entry["attributes"]["last_modified"] for entry in entries)
+    assert all(entry["type"] == "structures" for entry in entries)
+    assert all("C" in entry["attributes"]["elements"] for entry in entries)
+
+
+def test_metrics_and_slow_query_log(csd_serve, tmp_path):
+    log_path = tmp_path / "slow-queries.jsonl"
+    base_url = csd_serve(
+        "--slow-query-threshold",
+        "1e-9",
+        "--slow-query-log",
+        str(log_path),
+    )
+    query = urllib.parse.urlencode({"filter": 'elements HAS "C"'})
+    get_json(f"{base_url}/v1/structures?{query}")
+
+    # The timings are recorded just after the response has been sent
+    for _ in range(20):
+        status, headers, body = http_get(f"{base_url}/v1/extensions/metrics")
+        metrics = body.decode("utf-8")
+        if 'endpoint="get_structures"' in metrics:
+            break
+        time.sleep(0.1)
+    assert status == 200
+    assert headers["content-type"].startswith("text/plain")
+    for stage in ("filter_parse", "database_query", "serialisation", "total"):
+        assert (
+            f'csd_optimade_request_stage_seconds_count{{endpoint="get_structures",stage="{stage}"}} 1'
+            in metrics
+        )
+
+    records = [json.loads(line) for line in log_path.read_text().splitlines()]
+    structures_record = next(r for r in records if r["path"] == "/v1/structures")
+    assert structures_record["status"] == 200
+    assert structures_record["seconds"]["database_query"] > 0
+    # Slow queries are logged with their query plan by default
+    assert "explain" in structures_record
+
+
+def test_compressed_single_entry_cache(csd_serve):
+    base_url = csd_serve("--entry-cache-size", "1", num_entries=20)
+    url = f"{base_url}/v1/structures/SYN000003"
+    _, _, uncompressed = http_get(url)
+
+    for _ in range(2):
+        status, headers, body = http_get(url, headers={"Accept-Encoding": "gzip"})
+        assert status == 200
+        assert headers["content-encoding"] == "gzip"
+        assert (
+            json.loads(gzip.decompress(body))["data"]
+            == json.loads(uncompressed)["data"]
+        )
+
+    status, headers, body = http_get(
+        f"{base_url}/v1/structures?page_limit=20", headers={"Accept-Encoding": "gzip"}
+    )
+    assert headers["content-encoding"] == "gzip"
+    assert len(json.loads(gzip.decompress(body))["data"]) == 20
+
+
+@pytest.mark.parametrize("source", ["gz", "stdin"])
+def test_serve_compressed_jsonl(csd_serve, source):
+    base_url = csd_serve(num_entries=30, source=source)
+    response = get_json(f"{base_url}/v1/structures?page_limit=5")
+    assert response["meta"]["data_returned"] == 30
+    assert get_json(f"{base_url}/v1/structures/SYN000029")["data"]["id"] == "SYN000029"
+
+
+def test_metrics_aggregated_across_workers(csd_serve):
+    base_url = csd_serve("--workers", "2", num_entries=10)
+    for _ in range(10):
+        get_json(f"{base_url}/v1/structures?page_limit=1")
+
+    # Whichever worker answers, its metrics include the requests of both, once
+    # their snapshots have been written
+    expected = 'csd_optimade_request_stage_seconds_count{endpoint="get_structures",stage="total"} 10'
+    for _ in range(30):
+        _, _, body = http_get(f"{base_url}/v1/extensions/metrics")
+        if expected in body.decode("utf-8"):
+            break
+        time.sleep(0.2)
+    else:
+        raise AssertionError(f"{expected!r} not in metrics:\n{body.decode('utf-8')}")
+
+
+def test_failed_worker_does_not_return(tmp_path):
+    """A worker that fails to start exits, rather than returning into the
+    parent's code, and the server shuts down the other workers and exits.
+
+    """
+    script = """
+import csd_optimade.app
+
+def _fail():
+    raise RuntimeError("Cannot connect")
+
+csd_optimade.app.close_database = lambda: None
+csd_optimade.app.reconnect_database = _fail
+
+from csd_optimade.serve import serve
+
+async def app(scope, receive, send):
+    pass
+
+try:
+    serve(app, host="127.0.0.1", port={port}, workers=2)
+except SystemExit as exc:
+    print("exit code", exc.code)
+except Exception as exc:
+    # Only reached if the failure escapes the worker
+    print("error", exc)
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", script.format(port=free_port())],
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines() == ["exit code 1"]
+    assert "RuntimeError: Cannot connect" in result.stderr
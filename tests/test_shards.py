@@ -0,0 +1,91 @@
+import gzip
+import hashlib
+import json
+
+import pytest
+
+from csd_optimade.shards import read_manifest, shard_index, write_shards
+from csd_optimade.synthetic import generate_synthetic_structures
+
+HEADERS = [
+    json.dumps({"x-optimade": {"meta": {"api_version": "1.1.0"}}}),
+    json.dumps({"type": "info", "id": "/"}),
+]
+
+
+def _write_chunks(tmp_path, num_chunks=5, chunk_size=40):
+    """Write gzip-compressed chunks of synthetic structures and references,
+    where each chunk overlaps with the next to create duplicates.
+
+    """
+    structures = generate_synthetic_structures(num_chunks * chunk_size + 10)
+    chunk_paths = []
+    for chunk_id in range(num_chunks):
+        path = tmp_path / f"test-optimade-{chunk_id}.jsonl.gz"
+        entries = structures[chunk_id * chunk_size : (chunk_id + 1) * chunk_size + 10]
+        with gzip.open(path, "wt") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+                f.write(
+                    json.dumps(
+                        {
+                            "id": f"ref-{entry['id'][-2:]}",
+                            "type": "references",
+                            "attributes": {},
+                        }
+                    )
+                    + "\n"
+                )
+        chunk_paths.append(path)
+    return chunk_paths, {entry["id"] for entry in structures}
+
+
+def test_shard_index_stable():
+    assert shard_index("structures", "ABEBUF", 1) == 0
+    indices = {shard_index("structures", f"SYN{i:06d}", 8) for i in range(1000)}
+    assert indices == set(range(8))
+    # Independent of the process (e.g., hash randomisation)
+    assert shard_index("structures", "ABEBUF", 1024) == (
+        int.from_bytes(
+            hashlib.blake2b(b"structures/ABEBUF", digest_size=8).digest(), "big"
+        )
+        % 1024
+    )
+
+
+@pytest.mark.parametrize("num_shards", [1, 4])
+def test_write_shards(tmp_path, num_shards):
+    chunk_paths, structure_ids = _write_chunks(tmp_path)
+    output_dir = tmp_path / "output"
+    manifest_path = write_shards(
+        chunk_paths, output_dir, "test", num_shards, HEADERS, pool_size=2
+    )
+
+    manifest = read_manifest(manifest_path)
+    assert manifest["num_shards"] == num_shards
+    assert len(manifest["shards"]) == num_shards
+    assert manifest["entries"] == {"references": 100, "structures": 210}
+    # Intermediate files are cleaned up
+    assert sorted(p.name for p in output_dir.iterdir()) == sorted(
+        [manifest_path.name, *(shard["path"].name for shard in manifest["shards"])]
+    )
+
+    seen = set()
+    for shard in manifest["shards"]:
+        data = shard["path"].read_bytes()
+        assert hashlib.sha256(data).hexdigest() == shard["sha256"]
+        assert len(data) == shard["size"]
+
+        lines = data.decode("utf-8").splitlines()
+        assert lines[: len(HEADERS)] == HEADERS
+        entries = [json.loads(line) for line in lines[len(HEADERS) :]]
+        counts: dict[str, int] = {}
+        for entry in entries:
+            key = (entry["type"], entry["id"])
+            assert key not in seen
+            seen.add(key)
+            assert shard_index(*key, num_shards) == shard["index"]
+            counts[entry["type"]] = counts.get(entry["type"], 0) + 1
+        assert counts == shard["entries"]
+
+    assert {_id for _type, _id in seen if _type == "structures"} == structure_ids
@@ -0,0 +1,103 @@
+import datetime
+import json
+import urllib.error
+
+import pytest
+
+from csd_optimade.stats import (
+    DatasetStats,
+    compute_stats,
+    find_stats,
+    load_stats,
+    merge_stats,
+    stats_path,
+    write_stats,
+)
+from csd_optimade.synthetic import generate_synthetic_structures, write_synthetic_jsonl
+
+from .utils import get_json
+
+
+def test_dataset_stats():
+    structures = generate_synthetic_structures(40)
+    structures[0]["attributes"]["space_group_int_number"] = 14
+    structures[0]["attributes"]["_csd_deposition_date"] = {
+        "$date": datetime.date(1999, 5, 1)
+    }
+
+    halves = [DatasetStats(), DatasetStats()]
+    for i, entry in enumerate(structures):
+        halves[i % 2].add(entry)
+    halves[0].add({"type": "references", "id": "ref"})
+    halves[0].add({"id": "structures", "type": "info"})
+    stats = merge_stats(half.to_dict() for half in halves)
+    assert stats is not None
+    assert merge_stats([halves[0].to_dict(), None]) is None
+
+    assert stats.entries == {"structures": 40, "references": 1}
+    facets = stats.to_dict()["facets"]
+    assert sum(facets["nelements"].values()) == 40
+    assert sum(facets["_csd_crystal_system"].values()) == 40
+    assert facets["elements"]["C"] == sum(
+        "C" in s["attributes"]["elements"] for s in structures
+    )
+    assert facets["space_group_int_number"] == {"14": 1}
+    assert facets["deposition_year"]["1999"] >= 1
+    years = list(facets["deposition_year"])
+    assert years == sorted(years, key=int)
+
+    assert DatasetStats.from_dict(stats.to_dict()).to_dict() == stats.to_dict()
+
+
+def test_compute_and_load_stats(tmp_path, caplog):
+    jsonl_path = tmp_path / "test-optimade.jsonl"
+    write_synthetic_jsonl(jsonl_path, 30)
+    stats = compute_stats([jsonl_path])
+    assert stats.entries == {"structures": 30}
+
+    assert find_stats(jsonl_path) is None
+    path = write_stats(DatasetStats(), {"structures": 30}, stats_path(tmp_path, "test"))
+    assert find_stats(jsonl_path) == path
+    assert find_stats(tmp_path / "test-optimade-manifest.json") == path
+
+    # Statistics are only used if they match the loaded data
+    loaded = load_stats(path, jsonl_path, {"structures": 30, "references": 0})
+    assert loaded is not None and not loaded.facets["elements"]
+    loaded = load_stats(path, jsonl_path, {"structures": 31})
+    assert loaded is not None and loaded.to_dict() == stats.to_dict()
+    assert "do not match" in caplog.text
+    assert load_stats(None, None, {"structures": 30}) is None
+
+
+def test_serve_stats(csd_serve, tmp_path):
+    base_url = csd_serve(num_entries=25)
+    stats = get_json(f"{base_url}/extensions/stats")
+    assert stats["entries"] == {"structures": 25}
+    assert sum(stats["facets"]["nelements"].values()) == 25
+    assert get_json(f"{base_url}/v1/extensions/stats") == stats
+
+    # Precomputed statistics alongside the JSONL file are served as-is
+    stats["facets"]["elements"] = {"Xx": 25}
+    (tmp_path / "synthetic-optimade-stats.json").write_text(json.dumps(stats))
+    base_url = csd_serve(num_entries=25)
+    assert get_json(f"{base_url}/extensions/stats")["facets"]["elements"] == {"Xx": 25}
+    response = get_json(f"{base_url}/v1/structures?page_limit=1")
+    assert response["meta"]["data_available"] == 25
+
+
+def test_serve_stats_no_insert(csd_serve, tmp_path):
+    # With `--no-insert`, the placeholder file does not describe the database,
+    # so no statistics are counted from it
+    base_url = csd_serve("--no-insert", source="empty")
+    with pytest.raises(urllib.error.HTTPError) as exc_info:
+        get_json(f"{base_url}/extensions/stats")
+    exc_info.value.close()
+    assert exc_info.value.code == 404
+
+    # ...but the given statistics are served if they match the database
+    stats = DatasetStats()
+    write_stats(stats, {"structures": 0}, tmp_path / "stats.json")
+    base_url = csd_serve(
+        "--no-insert", "--stats", str(tmp_path / "stats.json"), source="empty"
+    )
+    assert get_json(f"{base_url}/extensions/stats")["entries"] == {"structures": 0}
@@ -0,0 +1,185 @@
+import datetime
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from csd_optimade.symmetry import (
+    compact_structure,
+    expand_attributes,
+    expand_fractional_sites,
+    parse_symmetry_operation,
+    site_multiplicities,
+)
+
+P21_C = ["x,y,z", "-x,1/2+y,1/2-z", "-x,-y,-z", "x,1/2-y,1/2+z"]
+
+
+def test_parse_symmetry_operation():
+    rotation, translation = parse_symmetry_operation("x,y,z")
+    np.testing.assert_array_equal(rotation, np.eye(3))
+    np.testing.assert_array_equal(translation, np.zeros(3))
+
+    rotation, translation = parse_symmetry_operation("1/2-x, y+1/2, -z+0.5")
+    np.testing.assert_array_equal(rotation, np.diag([-1, 1, -1]))
+    np.testing.assert_array_equal(translation, [0.5, 0.5, 0.5])
+
+    rotation, translation = parse_symmetry_operation("-x+y,-X,z+1/3")
+    np.testing.assert_array_equal(rotation, [[-1, 1, 0], [-1, 0, 0], [0, 0, 1]])
+    np.testing.assert_allclose(translation, [0, 0, 1 / 3])
+
+    for bad in ("x,y", "x,y,w", "x,y,z+"):
+        with pytest.raises(ValueError):
+            parse_symmetry_operation(bad)
+
+
+def test_expand_fractional_sites():
+    # A general position has 4 images in P2_1/c
+    sites, species = expand_fractional_sites([[0.1, 0.2, 0.3]], ["C"], P21_C)
+    assert species == ["C"] * 4
+    np.testing.assert_allclose(sites[2], [0.9, 0.8, 0.7])
+    assert np.all((sites >= 0) & (sites < 1))
+
+    # An atom on an inversion centre has only 2
+    sites, species = expand_fractional_sites([[0.0, 0.0, 0.0]], ["Cu"], P21_C)
+    np.testing.assert_allclose(sites, [[0, 0, 0], [0, 0.5, 0.5]])
+
+    # Without operators, the asymmetric unit is the unit cell
+    sites, species = expand_fractional_sites([[0.1, 0.2, 0.3]], ["C"], [])
+    assert species == ["C"]
+
+
+def test_site_multiplicities():
+    positions = [[0.1, 0.2, 0.3], [0.0, 0.0, 0.0], [0.5, 0.0, 0.5]]
+    assert site_multiplicities(positions, P21_C) == [4, 2, 2]
+    assert site_multiplicities(positions, []) == [1, 1, 1]
+    _, species = expand_fractional_sites(positions, ["C", "Cu", "O"], P21_C)
+    assert species == ["C"] * 4 + ["Cu"] * 2 + ["O"] * 2
+
+
+def _compact_entry():
+    return {
+        "id": "COMPACT",
+        "type": "structures",
+        "attributes": {
+            "immutable_id": "COMPACT",
+            "last_modified": "2025-01-01T00:00:00Z",
+            "elements": ["C", "Cu"],
+            "nelements": 2,
+            "nsites": 6,
+            "species": [
+                {"name": e, "chemical_symbols": [e], "concentration": [1.0]}
+                for e in ("C", "Cu")
+            ],
+            "_csd_lattice_parameter_a": 5.0,
+            "_csd_lattice_parameter_b": 6.0,
+            "_csd_lattice_parameter_c": 7.0,
+            "_csd_lattice_parameter_alpha": 90.0,
+            "_csd_lattice_parameter_beta": 100.0,
+            "_csd_lattice_parameter_gamma": 90.0,
+            "_csd_asymmetric_unit": compact_structure(
+                [[0.1, 0.2, 0.3], [0.0, 0.0, 0.0]], ["C", "Cu"], P21_C
+            ),
+        },
+    }
+
+
+def test_expand_attributes():
+    attributes = _compact_entry()["attributes"]
+    assert expand_attributes(attributes)
+    assert attributes["nsites"] == 6
+    assert attributes["species_at_sites"] == ["C"] * 4 + ["Cu"] * 2
+    cell = np.array(attributes["lattice_vectors"])
+    np.testing.assert_allclose(np.linalg.norm(cell, axis=1), [5, 6, 7])
+    np.testing.assert_allclose(
+        attributes["cartesian_site_positions"][0], np.array([0.1, 0.2, 0.3]) @ cell
+    )
+    assert not expand_attributes({"nsites": 1})
+
+
+def test_compact_structures_expanded_on_request(entry_collections):
+    from optimade.models import StructureResource
+    from optimade.server.mappers import StructureMapper
+    from optimade.server.query_params import (
+        EntryListingQueryParams,
+        SingleEntryQueryParams,
+    )
+
+    from csd_optimade.entry_collections import CSDMongoCollection
+
+    from .utils import to_database_format
+
+    structures = CSDMongoCollection(
+        name="structures_compact",
+        resource_cls=StructureResource,
+        resource_mapper=StructureMapper,
+    )
+    structures.collection.drop()
+    structures.insert([to_database_format(_compact_entry())])
+    try:
+        result, *_ = structures.find(SingleEntryQueryParams())
+        assert len(result["attributes"]["cartesian_site_positions"]) == 6
+
+        results, *_ = structures.find(EntryListingQueryParams())
+        assert "cartesian_site_positions" not in results[0]["attributes"]
+
+        results, *_ = structures.find(
+            EntryListingQueryParams(response_fields="cartesian_site_positions")
+        )
+        assert len(results[0]["attributes"]["cartesian_site_positions"]) == 6
+    finally:
+        structures.collection.drop()
+
+
+def _mock_csd_entry():
+    """A CSD entry with just the attributes read by the mapper."""
+    atoms = [
+        SimpleNamespace(atomic_symbol="C", fractional_coordinates=(0.1, 0.2, 0.3)),
+        SimpleNamespace(atomic_symbol="Cu", fractional_coordinates=(0.0, 0.0, 0.0)),
+    ]
+    crystal = SimpleNamespace(
+        asymmetric_unit_molecule=SimpleNamespace(atoms=atoms, formula="C1 Cu0.5"),
+        symmetry_operators=P21_C,
+        cell_lengths=SimpleNamespace(a=5.0, b=6.0, c=7.0),
+        cell_angles=SimpleNamespace(alpha=90.0, beta=100.0, gamma=90.0),
+        cell_volume=206.8,
+        spacegroup_number_and_setting=(14, 1),
+        spacegroup_symbol="P21/c",
+        crystal_system="monoclinic",
+        molecule=SimpleNamespace(smiles="C.[Cu]"),
+        z_value=2,
+        z_prime=0.5,
+    )
+    return SimpleNamespace(
+        identifier="COMPACT",
+        deposition_date=datetime.date(2001, 2, 3),
+        has_3d_structure=True,
+        has_disorder=False,
+        publications=[],
+        component_inchis=[],
+        formula="C2 Cu1",
+        chemical_name="copper carbide",
+        ccdc_number=123456,
+        disorder_details=None,
+        remarks=None,
+        crystal=crystal,
+    )
+
+
+def test_compact_entry_mapped_and_expanded():
+    from csd_optimade.mappers import from_csd_entry_directly
+
+    resource, _ = from_csd_entry_directly(_mock_csd_entry(), compact=True)
+    attributes = json.loads(resource.model_dump_json())["attributes"]
+    assert attributes["cartesian_site_positions"] is None
+    assert attributes["nsites"] == 6
+    assert attributes["_csd_lattice_parameter_beta"] == 100.0
+    assert attributes["_csd_cell_volume"] == 206.8
+
+    assert expand_attributes(attributes)
+    assert attributes["nsites"] == 6
+    assert attributes["species_at_sites"] == ["C"] * 4 + ["Cu"] * 2
+    np.testing.assert_allclose(
+        np.linalg.norm(attributes["lattice_vectors"], axis=1), [5, 6, 7]
+    )
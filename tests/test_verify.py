@@ -0,0 +1,89 @@
+import gzip
+import json
+import shutil
+
+import pytest
+
+from csd_optimade.synthetic import generate_synthetic_structures, write_synthetic_jsonl
+from csd_optimade.verify import cli, iter_byte_range, split_byte_ranges, verify
+
+REFERENCE = {
+    "id": "10.1000/xyz",
+    "type": "references",
+    "attributes": {
+        "last_modified": "2025-01-01T00:00:00Z",
+        "authors": [{"name": "A.B.Smith"}],
+        "year": "1999",
+    },
+}
+
+
+@pytest.mark.parametrize("num_ranges", [1, 3, 7, 1000])
+def test_byte_ranges_cover_every_line_once(tmp_path, num_ranges):
+    path = tmp_path / "test.jsonl"
+    write_synthetic_jsonl(path, 50)
+    lines = path.read_bytes().splitlines(keepends=True)
+
+    seen = []
+    for start, end in split_byte_ranges(path, num_ranges):
+        seen.extend(line for _, line in iter_byte_range(path, start, end))
+    assert seen == lines
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_verify_valid_file(tmp_path, compressed):
+    path = tmp_path / "test.jsonl"
+    structures = generate_synthetic_structures(200)
+    structures[0]["relationships"] = {
+        "references": {"data": [{"type": "references", "id": REFERENCE["id"]}]}
+    }
+    with open(path, "w") as f:
+        f.write(json.dumps({"x-optimade": {"meta": {"api_version": "1.1.0"}}}) + "\n")
+        for entry in [*structures, REFERENCE]:
+            f.write(json.dumps(entry) + "\n")
+    if compressed:
+        with open(path, "rb") as f_in, gzip.open(f"{path}.gz", "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        path = tmp_path / "test.jsonl.gz"
+
+    summary = verify(path, num_processes=2)
+    assert summary["ok"], summary["error_samples"]
+    assert summary["entries"] == {"references": 1, "structures": 200}
+    assert summary["header_lines"] == 1
+    assert summary["entries_per_second"] > 0
+
+
+def test_verify_invalid_file(tmp_path):
+    path = tmp_path / "test.jsonl"
+    structures = generate_synthetic_structures(20)
+    structures[1]["attributes"]["nsites"] += 1
+    structures[2]["attributes"]["species"] = structures[2]["attributes"]["species"][1:]
+    structures[2]["attributes"]["species_at_sites"] = ["Xx"]
+    structures[2]["attributes"]["nsites"] = 1
+    structures[2]["attributes"]["cartesian_site_positions"] = [[0, 0, 0]]
+    structures[3]["relationships"] = {
+        "references": {"data": [{"type": "references", "id": "missing"}]}
+    }
+    structures[4]["id"] = structures[5]["id"]
+    del structures[6]["attributes"]["last_modified"]
+    with open(path, "w") as f:
+        f.write(json.dumps({"x-optimade": {"meta": {"api_version": "1.1.0"}}}) + "\n")
+        for entry in structures:
+            f.write(json.dumps(entry) + "\n")
+        f.write("{not json\n")
+
+    summary = verify(path, num_processes=2)
+    assert not summary["ok"]
+    assert summary["errors"]["nsites"] == 2
+    assert summary["errors"]["species"] == 1
+    assert summary["errors"]["unresolved_reference"] == 1
+    assert summary["errors"]["duplicate_id"] == 1
+    assert summary["errors"]["json"] == 1
+    assert summary["errors"]["validation"] >= 1
+    assert [sample["id"] for sample in summary["error_samples"]["nsites"]] == [
+        structures[1]["id"]
+    ] * 2
+
+    output = tmp_path / "summary.json"
+    assert cli([str(path), "--num-processes", "1", "--output", str(output)]) == 1
+    assert json.loads(output.read_text())["errors"] == summary["errors"]
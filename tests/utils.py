@@ -1,6 +1,9 @@
 """Some testing utilities for environments without a valid CCDC/CSD license."""
 
 import datetime
+import json
+import socket
+import urllib.request
 import warnings
 from typing import NamedTuple
 
@@ -90,3 +93,32 @@ def generate_same_random_csd_entries(csd_available=True, num_entries=1000):
                             entry_indices.add(i)
                     except Exception:
                         continue
+
+
+def to_database_format(entry: dict) -> dict:
+    """Flatten an OPTIMADE JSONL entry into the format stored in MongoDB."""
+    import bson.json_util
+
+    entry = bson.json_util.loads(bson.json_util.dumps(entry))
+    doc = entry["attributes"]
+    doc["id"] = entry["id"]
+    for key in ("relationships", "links"):
+        if key in entry:
+            doc[key] = entry[key]
+    return doc
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def http_get(url: str, headers: dict | None = None) -> tuple[int, dict, bytes]:
+    request = urllib.request.Request(url, headers=headers or {})
+    with urllib.request.urlopen(request) as response:
+        return response.status, dict(response.headers), response.read()
+
+
+def get_json(url: str) -> dict:
+    return json.loads(http_get(url)[2])